@@ -0,0 +1,86 @@
+"""Offline benchmarks of the export stages against the recorded DaRUS/PUMA responses.
+
+Run with: python -m pytest benchmarks/bench_exporter.py
+"""
+import pytest
+
+from pumaExport import Exporter
+from pumaExporter import pumaExport
+from stubServer import CATALOG_SIZES, ROOT_DATAVERSE, loadFixture
+
+
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_listing(benchmark, catalogFactory, size):
+    credentials, catalog = catalogFactory(size)
+    exporter = Exporter(credentials)
+
+    datasets = benchmark(exporter.getDatasetsByDataverse, ROOT_DATAVERSE)
+    assert len(datasets) == size
+
+
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_pumaDownload(benchmark, catalogFactory, size):
+    credentials, catalog = catalogFactory(size)
+    exporter = Exporter(credentials)
+    catalog.getPosts()
+
+    pumaDatasets = benchmark(exporter.getAllDatasetsFromUniBiblio)
+    assert len(pumaDatasets) == len(catalog.pumaIndexes)
+
+
+def test_parseDarusSet(benchmark):
+    resFields = loadFixture("dataset.json")["data"]
+    exporter = Exporter({"export": {"cacheFile": None}})
+
+    record = benchmark(exporter.parseDarusSet, resFields, "doi:10.18419/darus-452")
+    assert record.doi == "10.18419/DARUS-452"
+
+
+def test_loadDarusSet(benchmark, catalogFactory):
+    credentials, catalog = catalogFactory(100)
+    exporter = Exporter(credentials)
+
+    record = benchmark(exporter.loadDarusSet, catalog.getDOI(1))
+    assert record.authors[0] == "Stegmüller, Michael"
+
+
+def test_genBibTex(benchmark, catalogFactory):
+    credentials, catalog = catalogFactory(100)
+    exporter = Exporter(credentials)
+
+    bibtex = benchmark(exporter.genBibTex, catalog.getDOI(1))
+    assert bibtex.startswith("@misc")
+
+
+def test_getChanges(benchmark, catalogFactory):
+    credentials, catalog = catalogFactory(100)
+    exporter = Exporter(credentials)
+    darusSet = exporter.getDarusSet(catalog.getDOI(1))
+    pumaDataset = exporter.genDatasetFromPost(catalog.genPost(1))
+
+    changes = benchmark(exporter.getChanges, darusSet, pumaDataset)
+    assert changes[0].startswith("Geändertes Feld: Titel")
+
+
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_writeExportFiles(benchmark, catalogFactory, size):
+    credentials, catalog = catalogFactory(size)
+    exporter = Exporter(credentials)
+    datasets = exporter.getDatasetsByDataverse(ROOT_DATAVERSE)
+    pumaDatasets = exporter.getAllDatasetsFromUniBiblio()
+
+    files = benchmark.pedantic(exporter.writeExportFiles, args=(datasets, pumaDatasets, ROOT_DATAVERSE), rounds=3)
+    with open(files[0], "r", encoding="utf_8") as bib:
+        assert bib.read().count("@misc") == size - len(catalog.pumaIndexes)
+
+
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_pumaExport(benchmark, catalogFactory, size):
+    credentials, catalog = catalogFactory(size)
+    catalog.getPosts()
+
+    def run():
+        return pumaExport(ROOT_DATAVERSE, full=True, exporter=Exporter(credentials))
+
+    msg = benchmark.pedantic(run, rounds=3)
+    assert "message" in msg
@@ -0,0 +1,43 @@
+"""Start-up time of the command line entry point: "pumaExporter.py render" and "mail" must not pay for
+requests or the mail modules, which are only imported by the commands that use them.
+
+Run with: python -m pytest benchmarks/bench_importTime.py
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATEMENTS = {"interpreter": "pass", "pumaExporter": "import pumaExporter", "pumaExport": "import pumaExport",
+              "requests": "import requests"}
+
+
+def getCumulativeImportTimes(statement):
+    """Cumulative import times in microseconds per top-level module, from python -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=REPO, capture_output=True,
+                            text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  ") and cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("name", STATEMENTS)
+def test_startup(benchmark, name):
+    benchmark.pedantic(subprocess.run, args=([sys.executable, "-c", STATEMENTS[name]],),
+                       kwargs={"cwd": REPO, "check": True}, rounds=10, iterations=1)
+
+
+def test_entryPointImportsLessThanRequests():
+    times = getCumulativeImportTimes("import pumaExporter, pumaExport; import requests")
+
+    assert "smtplib" not in times
+    print("import pumaExporter: {:.1f} ms, import requests: {:.1f} ms".format(times["pumaExporter"] / 1000,
+                                                                            times["requests"] / 1000))
+    assert times["pumaExporter"] < times["requests"]
@@ -0,0 +1,67 @@
+"""Micro-benchmark of the HTML stripping used for DaRUS descriptions.
+
+Run with: python -m pytest benchmarks/bench_textSanitizer.py
+"""
+import pytest
+
+from textSanitizer import stripHTML
+
+PARAGRAPH = ('<p>This dataset contains the simulation results of the <b>coupled flow &amp; transport</b> model '
+             'described in <a href="https://doi.org/10.18419/darus-452" target="_blank">Stegm&uuml;ller et al. (2021)</a>. '
+             'The files are organised per scenario:</p>\r\n<ul><li>scenario_1: reference case, 10&nbsp;GB</li>'
+             '<li>scenario_2: "high permeability" case with <i>k</i> &gt; 10<sup>-12</sup> m&sup2;</li></ul>\r\n')
+PLAIN = ("This dataset contains the simulation results of the coupled flow and transport model described in "
+         "Stegmueller et al. (2021). The files are organised per scenario. ")
+
+# a typical DaRUS description has a few kB, long ones with file listings reach ~100 kB
+SIZES = {"2kB": 5, "20kB": 50, "100kB": 250}
+
+
+def remove_html_markup_quadratic(s):
+    """The previous implementation, kept as baseline"""
+    tag = False
+    quote = False
+    out = ""
+    for c in s:
+        if c == "<" and not quote:
+            tag = True
+        elif c == ">" and not quote:
+            tag = False
+        elif (c == '"' or c == "'") and tag:
+            quote = not quote
+        elif not tag:
+            out = out + c
+    return out
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_stripHTML(benchmark, size):
+    description = PARAGRAPH * SIZES[size]
+    result = benchmark(stripHTML, description)
+    assert "<" not in result
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_stripHTMLPlainText(benchmark, size):
+    description = PLAIN * SIZES[size] * 2
+    assert benchmark(stripHTML, description) == description
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_stripHTMLUnclosedLessThan(benchmark, size):
+    # formulas like "T<Tc": every '<' starts a tag that is never closed
+    description = "The samples were measured at T<Tc and p<p0 (see a<b). " * SIZES[size] * 8
+    assert benchmark(stripHTML, description) == description
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_lxmlTextContent(benchmark, size):
+    lxmlHtml = pytest.importorskip("lxml.html")
+    description = PARAGRAPH * SIZES[size]
+    benchmark(lambda text: lxmlHtml.fromstring(text).text_content(), description)
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_removeHtmlMarkupQuadratic(benchmark, size):
+    description = PARAGRAPH * SIZES[size]
+    benchmark(remove_html_markup_quadratic, description)
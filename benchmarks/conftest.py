@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from stubServer import StubCatalog, StubHandler, StubServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def stubServer():
+    server = StubServer().start()
+    yield server
+    server.stop()
+
+
+def genCredentials(baseUrl, stateFile):
+    return {"darus": {"apiKey": "benchmark", "apiBaseUrl": baseUrl, "pageWorkers": 4},
+            "puma": {"baseUrl": baseUrl + "puma/api/", "user": "benchmark", "apiKey": "benchmark",
+                     "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib"), "jsonTemplate": os.path.join(REPO, "tpl_puma.txt"),
+                     "mailHost": "localhost", "mailer": "False", "snapshotFile": None},
+            "unibiblio": {"email": "benchmark@localhost"},
+            "export": {"workers": 8, "cacheFile": None, "stateFile": stateFile}}
+
+
+@pytest.fixture()
+def workdir(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "output")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture()
+def catalogFactory(stubServer, workdir):
+    """Returns (credentials, catalog) for a stub catalog of the given size"""
+
+    def factory(size):
+        if size not in StubHandler.catalogs:
+            StubHandler.catalogs[size] = StubCatalog(size)
+        credentials = genCredentials(stubServer.getBaseUrl(size), str(workdir / "output" / "state.json"))
+        return credentials, StubHandler.catalogs[size]
+
+    return factory
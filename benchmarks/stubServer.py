@@ -0,0 +1,198 @@
+"""Local stand-in for the DaRUS (Dataverse) and PUMA APIs used by the benchmarks.
+
+The responses are the recorded ones in benchmarks/fixtures, replicated to a catalog of the requested
+size. Every catalog is served under its own prefix: /<size>/api/... for DaRUS and /<size>/puma/api/...
+for PUMA.
+"""
+import copy
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from pumaExport import Exporter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+ROOT_DATAVERSE = "darus"
+DATAVERSE_COUNT = 20
+CATALOG_SIZES = [100, 1000, 3000]
+NEWEST_POST = datetime(2022, 12, 31, 12, 0, 0)
+
+
+def loadFixture(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf_8") as fixture:
+        return json.load(fixture)
+
+
+class StubCatalog:
+    """A catalog of size datasets in DATAVERSE_COUNT dataverses below ROOT_DATAVERSE.
+
+    Two thirds of the datasets are already in the Uni-Bibliography, a tenth of those with a changed title.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.datasetTemplate = loadFixture("dataset.json")
+        self.searchTemplate = loadFixture("searchDataset.json")
+        self.dataverseTemplate = loadFixture("searchDataverse.json")
+        self.postTemplate = loadFixture("pumaPost.json")
+        self.parser = Exporter({"export": {"cacheFile": None}})
+        self.pumaIndexes = [i for i in range(size) if self.isInPuma(i)]
+        self.postCache = {}
+
+    @staticmethod
+    def getNumber(index):
+        return 1000 + index
+
+    def getDOI(self, index):
+        return "doi:10.18419/darus-{}".format(self.getNumber(index))
+
+    def isInPuma(self, index):
+        return index % 3 != 0
+
+    def genDataset(self, index):
+        dataset = copy.deepcopy(self.datasetTemplate)
+        data = dataset["data"]
+        number = self.getNumber(index)
+        data["id"] = number
+        data["identifier"] = "DARUS-{}".format(number)
+        data["persistentUrl"] = "https://doi.org/10.18419/darus-{}".format(number)
+        for field in data["latestVersion"]["metadataBlocks"]["citation"]["fields"]:
+            if field["typeName"] == "title":
+                field["value"] = "{} ({})".format(field["value"], number)
+        return dataset
+
+    def genSearchItem(self, index, withMetadata=False):
+        item = dict(self.searchTemplate)
+        item["global_id"] = self.getDOI(index)
+        item["url"] = "https://doi.org/10.18419/darus-{}".format(self.getNumber(index))
+        item["storageIdentifier"] = "file://10.18419/DARUS-{}".format(self.getNumber(index))
+        item["identifier_of_dataverse"] = "dv{}".format(index % DATAVERSE_COUNT)
+        if withMetadata:
+            # what api/search returns with metadata_fields=citation:*
+            item["metadataBlocks"] = self.genDataset(index)["data"]["latestVersion"]["metadataBlocks"]
+        return item
+
+    def genDataverseItem(self, index):
+        item = dict(self.dataverseTemplate)
+        item["identifier"] = "dv{}".format(index)
+        item["name"] = "Institute {}".format(index)
+        item["parentDataverseIdentifier"] = ROOT_DATAVERSE
+        return item
+
+    def genPost(self, index):
+        record = self.parser.parseDarusSet(self.genDataset(index)["data"], self.getDOI(index))
+        post = copy.deepcopy(self.postTemplate)
+        bibtex = post["bibtex"]
+        bibtex["intrahash"] = "{:032x}".format(index)
+        bibtex["title"] = Exporter.genTitle(record.datasetTitle, record.datasetSubTitle)
+        if index % 10 == 1:
+            bibtex["title"] += " (old title)"
+        bibtex["author"] = Exporter.joinAuthors(list(record.authors))
+        bibtex["year"] = record.year
+        bibtex["howpublished"] = record.howpublished
+        bibtex["note"] = record.relatedPub
+        bibtex["misc"] = "  affiliation = {{{}}},\n  doi = {{{}}},\n  orcid-numbers = {{{}}}".format(
+            ", ".join(record.authorAffiliation), record.doi, ", ".join(record.authorOrcids))
+        return post
+
+    def search(self, params):
+        start = int(params.get("start", ["0"])[0])
+        perPage = int(params.get("per_page", ["10"])[0])
+        if params.get("type", ["dataset"])[0] == "dataverse":
+            total = DATAVERSE_COUNT
+            items = [self.genDataverseItem(i) for i in range(start, min(start + perPage, total))]
+        else:
+            total = self.size
+            withMetadata = "metadata_fields" in params
+            items = [self.genSearchItem(i, withMetadata) for i in range(start, min(start + perPage, total))]
+        return {"status": "OK", "data": {"q": "*", "total_count": total, "start": start, "count_in_response": len(items),
+                                         "items": items}}
+
+    def posts(self, params):
+        start = int(params.get("start", ["0"])[0])
+        end = int(params.get("end", ["20"])[0])
+        posts = [self.getPost(position) for position in range(start, min(end, len(self.pumaIndexes)))]
+        if len(posts) == 0:
+            return {"stat": "ok", "posts": {"start": start, "end": end}}
+        return {"stat": "ok", "posts": {"start": start, "end": end, "post": posts}}
+
+    def getPost(self, position):
+        if position not in self.postCache:
+            post = self.genPost(self.pumaIndexes[position])
+            # PUMA lists the newest posts first
+            date = NEWEST_POST - timedelta(minutes=position)
+            post["changedate"] = post["postingdate"] = date.strftime("%Y-%m-%d %H:%M:%S")
+            self.postCache[position] = post
+        return self.postCache[position]
+
+    def getPosts(self):
+        return [self.getPost(position) for position in range(len(self.pumaIndexes))]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    catalogs = {}
+
+    def do_GET(self):
+        # callPumaAPI sends a JSON body with its GET requests
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        params = parse_qs(url.query)
+        catalog = self.getCatalog(int(parts[0]))
+        route = "/".join(parts[1:])
+        if route == "api/search":
+            self.sendJson(catalog.search(params))
+        elif route.startswith("api/datasets/:persistentId"):
+            doi = params["persistentId"][0]
+            self.sendBody(getDatasetBody(catalog.size, int(doi.rsplit("-", 1)[1]) - 1000))
+        elif route == "puma/api/posts":
+            self.sendJson(catalog.posts(params))
+        else:
+            self.sendJson({"status": "ERROR", "message": "not recorded: {}".format(self.path)}, 404)
+
+    def getCatalog(self, size):
+        if size not in StubHandler.catalogs:
+            StubHandler.catalogs[size] = StubCatalog(size)
+        return StubHandler.catalogs[size]
+
+    def sendJson(self, data, code=200):
+        self.sendBody(json.dumps(data).encode("utf-8"), code)
+
+    def sendBody(self, body, code=200):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@lru_cache(maxsize=20000)
+def getDatasetBody(size, index):
+    return json.dumps(StubHandler.catalogs[size].genDataset(index)).encode("utf-8")
+
+
+class StubServer:
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def getBaseUrl(self, size):
+        return "http://127.0.0.1:{}/{}/".format(self.server.server_port, size)
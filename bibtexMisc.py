@@ -0,0 +1,66 @@
+import re
+
+FIELD_PATTERN = re.compile(r"[\s,]*([A-Za-z][\w.:-]*)\s*=\s*")
+BRACES_PATTERN = re.compile(r"[{}]")
+QUOTE_PATTERN = re.compile(r'[{}"\\]')
+BARE_PATTERN = re.compile(r"[^,]*")
+
+
+def parseMisc(misc):
+    """Parses the fields of a PUMA bibtex misc block ('key = {value}, ...') in a single pass.
+
+    Keys are lower-cased. Values may be wrapped in braces (nested braces are kept, only the outer
+    pair is removed), in double quotes or be bare words/numbers.
+    """
+    fields = {}
+    pos = 0
+    length = len(misc)
+    while pos < length:
+        match = FIELD_PATTERN.match(misc, pos)
+        if match is None:
+            break
+        key = match.group(1).lower()
+        pos = match.end()
+        if pos >= length:
+            fields[key] = ""
+            break
+        if misc[pos] == "{":
+            end = scanBraces(misc, pos)
+            fields[key] = misc[pos + 1:end - 1]
+        elif misc[pos] == '"':
+            end = scanQuotes(misc, pos)
+            fields[key] = misc[pos + 1:end - 1]
+        else:
+            end = BARE_PATTERN.match(misc, pos).end()
+            fields[key] = misc[pos:end].strip()
+        pos = end
+    return fields
+
+
+def scanBraces(text, pos):
+    """Returns the index after the brace that closes the one at pos (or the end of text)"""
+    depth = 0
+    for match in BRACES_PATTERN.finditer(text, pos):
+        depth += 1 if match.group() == "{" else -1
+        if depth == 0:
+            return match.end()
+    return len(text) + 1
+
+
+def scanQuotes(text, pos):
+    """Returns the index after the double quote that closes the one at pos, ignoring quotes inside braces"""
+    depth = 0
+    escaped = -1
+    for match in QUOTE_PATTERN.finditer(text, pos + 1):
+        char = match.group()
+        if match.start() == escaped:
+            continue
+        if char == "\\":
+            escaped = match.start() + 1
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif depth <= 0:
+            return match.end()
+    return len(text) + 1
@@ -0,0 +1,147 @@
+import json
+import os
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from exportState import TIMEFORMAT, writeJsonAtomic
+
+SEARCH_TIMEFORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class DataverseTree:
+    """Hierarchy of the published DaRUS dataverses, built from api/search results of type dataverse.
+
+    Maps aliases (and entity ids, if the search returns them) to their parents and children and
+    answers subtree membership with sets. highWaterMark is the newest published_at seen, so an
+    incremental refresh only has to search for dataverses published since then. Dataverses moved
+    or deleted in DaRUS are only noticed by a full refresh.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.nodes = {}
+        self.children = {}
+        self.ids = {}
+        self.subtrees = {}
+        self.highWaterMark = None
+        self.refreshedAt = None
+        self.fullRefreshAt = None
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as tree_file:
+                data = json.load(tree_file)
+            self.highWaterMark = data["highWaterMark"]
+            self.refreshedAt = data["refreshedAt"]
+            self.fullRefreshAt = data["fullRefreshAt"]
+            for node in data["dataverses"]:
+                self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, alias):
+        return alias in self.nodes
+
+    def add(self, item):
+        alias = item["identifier"]
+        node = {"identifier": alias, "parentDataverseIdentifier": item.get("parentDataverseIdentifier"),
+                "entity_id": item.get("entity_id"), "name": item.get("name"), "published_at": item.get("published_at")}
+        if alias in self.nodes:
+            self.children.get(self.nodes[alias]["parentDataverseIdentifier"], set()).discard(alias)
+        self.nodes[alias] = node
+        self.children.setdefault(node["parentDataverseIdentifier"], set()).add(alias)
+        if node["entity_id"] is not None:
+            self.ids[str(node["entity_id"])] = alias
+        self.subtrees = {}
+
+    def getAlias(self, dv):
+        """Returns the alias of a dataverse given by alias or entity id"""
+        dv = str(dv)
+        return self.ids.get(dv, dv)
+
+    def getParent(self, dv):
+        node = self.nodes.get(self.getAlias(dv))
+        return node["parentDataverseIdentifier"] if node is not None else None
+
+    def getSubtree(self, dv):
+        """Returns the aliases of dv and all dataverses below it as a frozenset"""
+        alias = self.getAlias(dv)
+        if alias not in self.subtrees:
+            subtree = {alias}
+            queue = deque([alias])
+            while len(queue) > 0:
+                for child in self.children.get(queue.popleft(), ()):
+                    if child not in subtree:
+                        subtree.add(child)
+                        queue.append(child)
+            self.subtrees[alias] = frozenset(subtree)
+        return self.subtrees[alias]
+
+    def getSubDataverses(self, dv):
+        alias = self.getAlias(dv)
+        return sorted(self.getSubtree(alias) - {alias})
+
+    def getRoots(self):
+        """Returns the parents that are not published dataverses themselves, i.e. the DaRUS root"""
+        return sorted(parent for parent in self.children if parent is not None and parent not in self.nodes)
+
+    def getTopLevel(self):
+        return sorted(alias for root in self.getRoots() for alias in self.children[root])
+
+    def getRefreshSince(self):
+        if self.highWaterMark is None:
+            return None
+        # published_at of the search is UTC
+        return datetime.strptime(self.highWaterMark, SEARCH_TIMEFORMAT).replace(tzinfo=timezone.utc)
+
+    def isStale(self, ttlHours):
+        if self.refreshedAt is None:
+            return True
+        return datetime.strptime(self.refreshedAt, TIMEFORMAT) < datetime.now() - timedelta(hours=ttlHours)
+
+    def needsFullRefresh(self, maxAgeDays):
+        if self.fullRefreshAt is None or self.highWaterMark is None:
+            return True
+        return datetime.strptime(self.fullRefreshAt, TIMEFORMAT) < datetime.now() - timedelta(days=maxAgeDays)
+
+    def replace(self, other):
+        self.nodes = other.nodes
+        self.children = other.children
+        self.ids = other.ids
+        self.subtrees = {}
+
+    def markRefreshed(self, full):
+        now = datetime.now().strftime(TIMEFORMAT)
+        published = [node["published_at"] for node in self.nodes.values() if node["published_at"]]
+        if len(published) > 0:
+            self.highWaterMark = max(published)
+        self.refreshedAt = now
+        if full:
+            self.fullRefreshAt = now
+
+    def save(self):
+        if self.path is None:
+            return
+        writeJsonAtomic(self.path, {"highWaterMark": self.highWaterMark, "refreshedAt": self.refreshedAt,
+                                    "fullRefreshAt": self.fullRefreshAt, "dataverses": list(self.nodes.values())})
+
+
+class SubtreeFilter:
+    """Set-like view of the subtree of root. A dataverse alias the tree does not know yet triggers
+    one call of refresh (an incremental refresh of the tree) before it is rejected."""
+
+    def __init__(self, tree, root, refresh=None):
+        self.tree = tree
+        self.root = root
+        self.refresh = refresh
+
+    def __len__(self):
+        return len(self.tree.getSubtree(self.root))
+
+    def __contains__(self, alias):
+        if alias in self.tree.getSubtree(self.root):
+            return True
+        if alias not in self.tree and self.refresh is not None:
+            refresh, self.refresh = self.refresh, None
+            refresh()
+            return alias in self.tree.getSubtree(self.root)
+        return False
@@ -0,0 +1,76 @@
+import json
+import os
+
+from exportState import writeJsonAtomic
+
+# pages of the search are re-read from this many entries before the checkpoint, in case the index shifted
+LISTING_OVERLAP = 100
+# the order of a listing that is resumed at an offset must not change between runs: oldest first, so
+# datasets published or updated in between move to the end instead of shifting the ones before the offset
+LISTING_SORT = "&sort=date&order=asc"
+
+
+class ExportCheckpoint:
+    """Progress of writeExportFiles for one dataverse, persisted as JSON (default
+    output/checkpoints/<dataverse>.json).
+
+    Holds the processed DOIs in listing order, those of them that could not be fetched and the sizes of
+    the two .part files after the last of them was written. A checkpoint is only resumed by a run for
+    the same dataverse and watermark.
+    """
+
+    def __init__(self, path, dv, since=None):
+        self.path = path
+        self.dv = dv
+        self.since = since
+        self.exportDate = None
+        self.processed = []
+        self.processedSet = set()
+        self.failed = []
+        self.offsets = {"export": 0, "changes": 0}
+        self.resumed = False
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as checkpoint_file:
+                data = json.load(checkpoint_file)
+            if data["dataverse"] == dv and data["since"] == since:
+                self.exportDate = data["exportDate"]
+                self.processed = data["processed"]
+                self.processedSet = set(self.processed)
+                self.failed = data.get("failed", [])
+                self.offsets = data["offsets"]
+                self.resumed = True
+            else:
+                print("checkpoint {} is for another run of dataverse {}, starting over".format(path, dv))
+
+    def __contains__(self, ds):
+        return ds in self.processedSet
+
+    def __len__(self):
+        return len(self.processed)
+
+    def getListingStart(self):
+        return max(len(self.processed) - LISTING_OVERLAP, 0)
+
+    def add(self, ds, failed=False):
+        self.processed.append(ds)
+        self.processedSet.add(ds)
+        if failed:
+            self.failed.append(ds)
+
+    def reset(self):
+        self.processed = []
+        self.processedSet = set()
+        self.failed = []
+        self.offsets = {"export": 0, "changes": 0}
+        self.resumed = False
+
+    def save(self, offsets):
+        self.offsets = dict(offsets)
+        if self.path:
+            writeJsonAtomic(self.path, {"dataverse": self.dv, "since": self.since, "exportDate": self.exportDate,
+                                        "offsets": self.offsets, "processed": self.processed,
+                                        "failed": self.failed})
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,25 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def orderedMap(fn, items, workers=1, window=None):
+    """Yields fn(item) for every item in input order, computed by a pool of workers.
+
+    Unlike ThreadPoolExecutor.map, items are pulled lazily: at most window calls (default
+    2 * workers) are in flight or waiting to be consumed, so a slow consumer holds back the
+    producer instead of letting results pile up in memory.
+    """
+    workers = max(int(workers), 1)
+    window = max(int(window or 2 * workers), 1)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
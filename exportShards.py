@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from exportPipeline import orderedMap
+from exportState import TIMEFORMAT, writeJsonAtomic
+from pumaSnapshot import normalizeDOI
+
+
+def getShard(doi, shards):
+    """Shard 0..shards-1 of a DOI. The hash of the normalized DOI is the same in every process and on
+    every machine (unlike hash()), so a dataset always lands in the same shard."""
+    digest = hashlib.sha1(normalizeDOI(doi).encode("utf_8")).hexdigest()
+    return int(digest, 16) % shards
+
+
+def parseShard(value):
+    """Parses "I/N" (1 <= I <= N) into the zero-based shard and the number of shards"""
+    shard, _, shards = value.partition("/")
+    shard, shards = int(shard), int(shards)
+    if shards < 1 or not 1 <= shard <= shards:
+        raise ValueError("shard must be I/N with 1 <= I <= N: {}".format(value))
+    return shard - 1, shards
+
+
+def getShardFile(directory, dv, shard, shards):
+    return os.path.join(directory, "{}_{}of{}.json".format(dv, shard + 1, shards))
+
+
+def getShardPath(path, shard, shards):
+    """path with the shard inserted before the extension, e.g. output/darusCache.2of4.json: every shard
+    keeps its own cache, which stays valid because it always gets the same datasets"""
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}.{}of{}{}".format(root, shard + 1, shards, extension)
+
+
+def exportShard(exporter, dv, p_datasets, shard, shards, since=None, directory="output/shards", retries=()):
+    """Fetches, compares and renders the datasets of dv that fall into shard and writes the results with
+    their position in the listing to the shard file. Every shard lists the whole dataverse (followed by
+    the retries, see Exporter.iterWithRetries), so the positions of all shards together give the order of
+    a single-process export. The datasets are also recorded in the state database, which all shards of a
+    machine share."""
+    startedAt = datetime.now()
+    workers = max(int(exporter.getOption("export", "workers", 1)), 1)
+    window = int(exporter.getOption("export", "queueSize", 2 * workers))
+
+    def own(datasets):
+        for index, ds in enumerate(datasets):
+            if getShard(ds, shards) == shard:
+                yield index, ds
+            else:
+                exporter.releaseDarusSet(ds)
+
+    entries = []
+    count = 0
+    for index, ds, (status, text) in orderedMap(
+            lambda item: item + (exporter.getTimedExportEntry(item[1], p_datasets),),
+            own(exporter.iterWithRetries(exporter.iterDatasetsByDataverse(dv, since), retries)), workers, window):
+        count += 1
+        if status is not None:
+            entries.append([index, ds, status, text])
+        if exporter.stateStore is not None:
+            exporter.stateStore.recordDataset(ds, dv, exporter.datasetVersions.get(ds), status or "unchanged",
+                                              exporter.peekDarusSet(ds))
+        exporter.releaseDarusSet(ds)
+    path = getShardFile(directory, dv, shard, shards)
+    writeJsonAtomic(path, {"dataverse": dv, "shard": shard + 1, "shards": shards,
+                           "since": since.strftime(TIMEFORMAT) if since is not None else None,
+                           "startedAt": startedAt.strftime(TIMEFORMAT), "datasets": count, "entries": entries})
+    print("shard {}/{} of dataverse {}: {} datasets, {} new or changed, written to {}".format(
+        shard + 1, shards, dv, count, len(entries), path))
+    return path
+
+
+def loadShards(dv, shards, directory="output/shards"):
+    """Loads the shard files of dv. Raises ValueError unless all shards are there and were run with the
+    same watermark."""
+    results = []
+    for shard in range(shards):
+        path = getShardFile(directory, dv, shard, shards)
+        if not os.path.exists(path):
+            raise ValueError("shard {}/{} of dataverse {} is missing: {}".format(shard + 1, shards, dv, path))
+        with open(path, "r", encoding="utf_8") as shard_file:
+            results.append(json.load(shard_file))
+    if len({result["since"] for result in results}) > 1:
+        raise ValueError("the shards of dataverse {} were run with different watermarks: {}".format(
+            dv, sorted({str(result["since"]) for result in results})))
+    return results
+
+
+def getFailedDatasets(dv, shards, directory="output/shards"):
+    """The datasets of dv that the shards could not fetch, in listing order"""
+    entries = sorted(tuple(entry) for result in loadShards(dv, shards, directory) for entry in result["entries"])
+    return [ds for _, ds, status, _ in entries if status == "failed"]
+
+
+def writeMergedFile(path, texts):
+    with open(path + ".part", "wb") as out:
+        for text in texts:
+            out.write(text.encode("utf_8"))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(path + ".part", path)
+
+
+def mergeShards(dv, shards, directory="output/shards", outputDir="output"):
+    """Writes the export and the changes file of dv from its shard files, ordered by listing position
+    (then DOI), with the content writeExportFiles writes for the same run. The files are dated with the
+    start of the first shard. Returns the file names and the start of the first shard."""
+    results = loadShards(dv, shards, directory)
+    entries = sorted((tuple(entry) for result in results for entry in result["entries"]),
+                     key=lambda entry: (entry[0], entry[1]))
+    startedAt = min(datetime.strptime(result["startedAt"], TIMEFORMAT) for result in results)
+    exportDate = startedAt.strftime("%Y-%m-%d")
+    filename = os.path.join(outputDir, "{}_{}_export.bib".format(exportDate, dv))
+    filename_changes = os.path.join(outputDir, "{}_{}_changes.txt".format(exportDate, dv))
+    # genBibTex returns an empty value for datasets it cannot render
+    writeMergedFile(filename, (text for _, _, status, text in entries if status == "new" and text))
+    writeMergedFile(filename_changes, (text for _, _, status, text in entries if status == "changed"))
+    print("merged {} shards of dataverse {}: {} datasets, {} new or changed".format(
+        shards, dv, sum(result["datasets"] for result in results), len(entries)))
+    return [filename, filename_changes], startedAt
+
+
+def removeShards(dv, shards, directory="output/shards"):
+    for shard in range(shards):
+        path = getShardFile(directory, dv, shard, shards)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+TIMEFORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def writeTextAtomic(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # a unique temporary file per writer: concurrent processes writing the same path must not share it.
+    # Created with mode 0666 like open() does, so the umask applies to it.
+    tmpPath = "{}.{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident(), uuid.uuid4().hex)
+    fd = os.open(tmpPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    try:
+        with os.fdopen(fd, "w", encoding="utf_8") as out:
+            out.write(text)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+
+def writeJsonAtomic(path, data):
+    writeTextAtomic(path, json.dumps(data, indent=2, ensure_ascii=False))
+
+
+class ExportState:
+    """Per-dataverse state of the export runs, persisted as JSON (default output/state.json)"""
+
+    def __init__(self, path="output/state.json"):
+        self.path = path
+        self.state = {"dataverses": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as state_file:
+                self.state = json.load(state_file)
+            self.state.setdefault("dataverses", {})
+
+    def getLastRun(self, dv):
+        if dv in self.state["dataverses"] and "lastRun" in self.state["dataverses"][dv]:
+            return datetime.strptime(self.state["dataverses"][dv]["lastRun"], TIMEFORMAT)
+        return None
+
+    def setLastRun(self, dv, date):
+        self.state["dataverses"].setdefault(dv, {})["lastRun"] = date.strftime(TIMEFORMAT)
+
+    def getRetries(self, dv):
+        """The datasets of dv whose fetch failed in the last run, see setRetries"""
+        return self.state["dataverses"].get(dv, {}).get("retry", [])
+
+    def setRetries(self, dv, datasets):
+        """Keeps the datasets of dv that could not be fetched: they fall out of the dateSort window of the
+        next incremental listing once the watermark advances, so that run has to add them itself"""
+        entry = self.state["dataverses"].setdefault(dv, {})
+        if datasets:
+            entry["retry"] = list(datasets)
+        else:
+            entry.pop("retry", None)
+
+    def save(self):
+        writeJsonAtomic(self.path, self.state)
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import threading
+
+from exportState import writeJsonAtomic
+
+# bump when the normalization of the compared fields changes, so stored fingerprints are discarded
+FINGERPRINT_VERSION = 1
+
+
+def fingerprint(fields):
+    """Stable hash of the normalized comparison fields (a list of (name, value) pairs)"""
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False).encode("utf_8")).hexdigest()
+
+
+class FingerprintStore:
+    """Fingerprints of the DaRUS records, keyed by DOI and valid as long as the version key of the
+    dataset does not change, persisted as JSON (default output/fingerprints.json)"""
+
+    def __init__(self, path="output/fingerprints.json"):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.unchanged = 0
+        self.compared = 0
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as fingerprint_file:
+                data = json.load(fingerprint_file)
+            if data.get("version") == FINGERPRINT_VERSION:
+                self.entries = data["entries"]
+
+    def get(self, doi, version):
+        with self.lock:
+            entry = self.entries.get(doi)
+            if entry is None or version is None or entry["version"] != version:
+                return None
+            return entry["fingerprint"]
+
+    def put(self, doi, version, value):
+        if version is None:
+            return
+        with self.lock:
+            self.entries[doi] = {"version": version, "fingerprint": value}
+
+    def count(self, unchanged):
+        with self.lock:
+            if unchanged:
+                self.unchanged += 1
+            else:
+                self.compared += 1
+
+    def stats(self):
+        with self.lock:
+            return {"unchanged": self.unchanged, "compared": self.compared, "size": len(self.entries)}
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {"version": FINGERPRINT_VERSION, "entries": dict(self.entries)}
+        writeJsonAtomic(self.path, data)
@@ -0,0 +1,258 @@
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from runMetrics import getEndpoint
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class ObservedRetry(Retry):
+    """Retry that reports every retried attempt to onRetry(url, response, error, retryAfter)"""
+
+    def __init__(self, *args, onRetry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.onRetry = onRetry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.onRetry = self.onRetry
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.onRetry is not None:
+            retryAfter = self.get_retry_after(response) if response is not None else None
+            self.onRetry(url, response, error, retryAfter)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def getCongestionReason(status=None, error=None):
+    """Returns why a response or error signals an overloaded backend (429, 5xx, timeout), else None"""
+    if error is not None:
+        return "timeout" if isinstance(error, (TimeoutError, requests.Timeout, urllib3.exceptions.TimeoutError)) else \
+            type(error).__name__
+    if status is not None and (status == 429 or status >= 500):
+        return str(status)
+    return None
+
+
+def getResponseSize(response, stream=False):
+    """Size of the response body; a streamed body is not read here, its Content-Length is used"""
+    if not stream:
+        return len(response.content)
+    try:
+        return int(response.headers.get("Content-Length", 0))
+    except ValueError:
+        return 0
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the concurrent requests to one backend.
+
+    Every successful request whose latency stays within tolerance times the fastest latency seen for
+    its endpoint raises the limit by 1/limit, i.e. by one per round of requests. A 429, 5xx or timeout
+    halves it, at most once per round: only requests started after the last decrease can cause the
+    next one. A Retry-After header stops all new requests to the backend for the given time.
+    Changes of the limit are printed and reported to metrics.recordLimit.
+    """
+
+    def __init__(self, name, initial=2, minimum=1, maximum=10, tolerance=2.0, metrics=None):
+        self.name = name
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = float(min(max(int(initial), self.minimum), self.maximum))
+        self.tolerance = float(tolerance)
+        self.metrics = metrics
+        self.inFlight = 0
+        self.baselines = {}
+        self.lastDecrease = 0.0
+        self.pausedUntil = 0.0
+        self.condition = threading.Condition()
+        self.reportLimit("initial")
+
+    def acquire(self):
+        """Blocks until a request may be sent and returns its start time"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    self.condition.wait(self.pausedUntil - now)
+                elif self.inFlight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.inFlight += 1
+                    return now
+
+    def release(self, start, endpoint, latency=None, congestion=None):
+        """Ends a request. latency is None if it is not comparable (e.g. the request was retried)."""
+        with self.condition:
+            self.inFlight -= 1
+            if congestion is not None:
+                self.decrease(start, congestion)
+            elif latency is not None:
+                baseline = self.baselines.get(endpoint)
+                if baseline is None or latency < baseline:
+                    self.baselines[endpoint] = latency
+                elif latency <= baseline * self.tolerance:
+                    self.increase()
+                else:
+                    # the fastest latency may have been a lucky one, let the baseline follow slowly
+                    self.baselines[endpoint] = baseline + (latency - baseline) * 0.05
+            self.condition.notify_all()
+
+    def onCongestion(self, start, reason, retryAfter=None):
+        with self.condition:
+            if retryAfter:
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+                print("{}: backend asked to retry after {:.1f}s, pausing new requests".format(self.name, retryAfter))
+            self.decrease(start, reason)
+            self.condition.notify_all()
+
+    def increase(self):
+        old = int(self.limit)
+        self.limit = min(self.limit + 1.0 / self.limit, float(self.maximum))
+        if int(self.limit) != old:
+            self.reportLimit("latency stable")
+
+    def decrease(self, start, reason):
+        if start is not None and start < self.lastDecrease:
+            return
+        self.lastDecrease = time.monotonic()
+        old = int(self.limit)
+        self.limit = max(self.limit / 2, float(self.minimum))
+        if int(self.limit) != old:
+            self.reportLimit(reason)
+
+    def reportLimit(self, reason):
+        print("{}: concurrency limit {} ({})".format(self.name, int(self.limit), reason))
+        if self.metrics is not None:
+            self.metrics.recordLimit(self.name, int(self.limit), reason)
+
+
+class RateLimiter:
+    """Token bucket shared between threads: acquire() blocks until the next of rate requests per
+    second is allowed, with bursts of up to burst requests. A rate <= 0 disables the limit."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(float(burst), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Transport:
+    """Pooled keep-alive HTTP session for one backend (DaRUS or PUMA).
+
+    Idempotent requests are retried with exponential backoff on connection errors, timeouts and
+    the status codes in RETRY_STATUS. A Retry-After header sent with a 429/503 is honoured. With a
+    limiter, the number of concurrent requests adapts to the load of the backend (AdaptiveLimiter).
+    """
+
+    def __init__(self, name, poolSize=10, retries=5, backoff=0.5, auth=None, metrics=None, limiter=None):
+        self.name = name
+        self.metrics = metrics
+        self.limiter = limiter
+        # start time and retry flag of the request running in the current thread, for onRetry
+        self.current = threading.local()
+        self.session = requests.Session()
+        self.session.auth = auth
+        retry = ObservedRetry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                              status_forcelist=RETRY_STATUS, respect_retry_after_header=True, raise_on_status=False,
+                              onRetry=self.onRetry)
+        self.adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        started = self.limiter.acquire() if self.limiter is not None else None
+        self.current.started = started
+        self.current.retried = False
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            if self.limiter is not None:
+                self.limiter.release(started, getEndpoint(url), congestion=getCongestionReason(error=e))
+            if self.metrics is not None:
+                self.metrics.recordRequest(self.name, url, time.perf_counter() - start, 0, True)
+            raise
+        latency = time.perf_counter() - start
+        if self.limiter is not None:
+            congestion = getCongestionReason(status=response.status_code)
+            if congestion is not None and response.headers.get("Retry-After") is not None:
+                # retries are used up, but the backend still asks to wait
+                self.limiter.onCongestion(started, congestion, Retry().parse_retry_after(response.headers["Retry-After"]))
+            self.limiter.release(started, getEndpoint(url), None if self.current.retried else latency, congestion)
+        if self.metrics is not None:
+            self.metrics.recordRequest(self.name, url, latency, getResponseSize(response, kwargs.get("stream", False)),
+                                       response.status_code >= 400)
+        return response
+
+    def onRetry(self, url, response, error, retryAfter=None):
+        self.current.retried = True
+        if self.metrics is not None:
+            self.metrics.recordRetry(self.name, url or "")
+        if self.limiter is not None:
+            reason = getCongestionReason(response.status if response is not None else None, error)
+            self.limiter.onCongestion(getattr(self.current, "started", None), reason or "retry", retryAfter)
+
+    def stats(self):
+        requestCount = 0
+        connectionCount = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requestCount += pool.num_requests
+                connectionCount += pool.num_connections
+        stats = {"requests": requestCount, "connections": connectionCount,
+                 "reused": max(requestCount - connectionCount, 0)}
+        if self.limiter is not None:
+            stats["concurrencyLimit"] = int(self.limiter.limit)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+class TransportRegistry:
+    """Creates one Transport per backend on first use and shares it between threads"""
+
+    def __init__(self):
+        self.transports = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, factory):
+        with self.lock:
+            if name not in self.transports:
+                self.transports[name] = factory()
+            return self.transports[name]
+
+    def stats(self):
+        with self.lock:
+            return {name: transport.stats() for name, transport in self.transports.items()}
+
+    def close(self):
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports = {}
@@ -0,0 +1,73 @@
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r"\s*")
+
+
+class JsonArrayStream:
+    """Decodes the items of the first JSON array under key while the chunks of a document arrive,
+    e.g. the posts of a PUMA page from response.iter_content, so the whole document is never held
+    as text and objects at the same time.
+
+    Iterating yields the items in order. Afterwards document holds the rest of the document, with an
+    empty list in place of the array. A document without the array is decoded as a whole.
+    """
+
+    def __init__(self, chunks, key):
+        self.chunks = chunks
+        self.arrayStart = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+        self.decoder = json.JSONDecoder()
+        self.document = None
+
+    def iterText(self):
+        decoder = codecs.getincrementaldecoder("utf_8")()
+        for chunk in self.chunks:
+            text = decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def __iter__(self):
+        chunks = self.iterText()
+        buffer = ""
+        match = None
+        for text in chunks:
+            buffer += text
+            match = self.arrayStart.search(buffer)
+            if match is not None:
+                break
+        if match is None:
+            self.document = json.loads(buffer)
+            return
+        prefix = buffer[:match.end()]
+        buffer = buffer[match.end():]
+        position = 0
+        exhausted = False
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                break
+            if position < len(buffer) and buffer[position] == ",":
+                position = WHITESPACE.match(buffer, position + 1).end()
+            try:
+                if position >= len(buffer):
+                    raise ValueError("incomplete")
+                item, end = self.decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise ValueError("JSON document ends inside the array")
+                text = next(chunks, None)
+                if text is None:
+                    exhausted = True
+                else:
+                    # drop what is decoded already, so the buffer never grows beyond one item and a chunk
+                    buffer = buffer[position:] + text
+                    position = 0
+                continue
+            yield item
+            position = end
+        suffix = buffer[position:] + "".join(chunks)
+        self.document = json.loads(prefix + suffix)
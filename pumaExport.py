@@ -1,42 +1,39 @@
+import itertools
 import os
 import random
 import re
-import smtplib
 import string
-from email.header import Header
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import threading
+import time
+from concurrent.futures import Future
 from string import Template
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-import lxml.html
 import json
 
-import requests
-from requests.auth import HTTPBasicAuth
-
+from dataverseTree import DataverseTree, SubtreeFilter
+from exportCheckpoint import LISTING_SORT, ExportCheckpoint
+from exportPipeline import orderedMap
+from exportState import TIMEFORMAT
+from fingerprints import FingerprintStore, fingerprint
 from exporterExceptions import ApiCallFailedException
+from jsonStream import JsonArrayStream
+from pumaSnapshot import DoiIndex, PumaSnapshot, compactPost, getMiscDOI, getPostDate, normalizeDOI
+from recordCache import RecordCache
+from records import RECORD_VERSION, DarusRecord, PumaRecord
+from runMetrics import RunMetrics
+from stateStore import StateStore
+from textSanitizer import stripHTML
+
+PAGE_CHUNK_SIZE = 64 * 1024
+CITATION_YEAR_PATTERN = re.compile(r', (\d{4}), "')
+
 
 def remove_html_markup(s):
-    tag = False
-    quote = False
-    out = ""
-
-    for c in s:
-        if c == "<" and not quote:
-            tag = True
-        elif c == ">" and not quote:
-            tag = False
-        elif (c == '"' or c == "'") and tag:
-            quote = not quote
-        elif not tag:
-            out = out + c
-
-    return out
+    return stripHTML(s)
 
 def cleanString(toBeCleaned):
-    return remove_html_markup(str(toBeCleaned).replace("\r", "").replace("\n", " ").replace('"', "'"))
+    return stripHTML(str(toBeCleaned).replace("\r", "").replace("\n", " ").replace('"', "'"))
 
 
 def isDaRUSdoi(doi: str):
@@ -65,112 +62,264 @@ class Exporter:
 
 
         self.credentials = credentials
+        # created with the first request, so commands that do not call a backend never import requests
+        self.transports = None
+        self.transportsLock = threading.Lock()
+        self.metrics = RunMetrics()
+        # version keys of the datasets seen by the last search, used to validate cached records
+        self.datasetVersions = {}
+        self.recordCache = None
+        cacheFile = self.getOption("export", "cacheFile", "output/darusCache.json")
+        if cacheFile:
+            self.recordCache = RecordCache(cacheFile, int(self.getOption("export", "cacheSize", 20000)))
+        self.fingerprints = None
+        fingerprintFile = self.getOption("export", "fingerprintFile", "output/fingerprints.json")
+        if fingerprintFile:
+            self.fingerprints = FingerprintStore(fingerprintFile)
+        self.stateStore = None
+        stateDatabase = self.getOption("export", "stateDatabase", "output/pumaexport.sqlite")
+        if stateDatabase:
+            self.stateStore = StateStore(stateDatabase)
+        self.pumaSnapshot = None
+        self.dataverseTree = None
+        self.dataverseTreeRefreshed = False
+        self.dataverseTreeLock = threading.RLock()
+        self.runRecords = {}
+        # metadata of listed datasets from their search items, parsed by loadDarusSet when needed
+        self.searchRecords = {}
+        # number of listings (and uploads) that still need the record of a dataset, see retainDarusSet
+        self.runRecordUses = {}
+        # the dataverses listed by this run and the datasets already retained for several of them
+        self.runDataverses = []
+        self.sharedRecords = set()
+        # datasets whose api/datasets call failed in this run, see isFailedDarusSet
+        self.failedDatasets = set()
+        self.runRecordsLock = threading.Lock()
+        # runProfiler.DatasetTimings while a run is profiled
+        self.datasetTimings = None
+
+    def getOption(self, section, key, default=None):
+        if section in self.credentials and key in self.credentials[section]:
+            return self.credentials[section][key]
+        return default
+
+    @staticmethod
+    def newDarusSet():
+        return {"authors": [], "affiliation": [], "authorAffiliation": [], "authorOrcids": [], "key": "",
+                "datasetDescription": "", "howpublished": "Dataset", "relatedPub": "", "datasetSubTitle": ""}
 
     def getDarusSet(self, pid):
-        keysAndValues = {"authors": [], "affiliation": [], "authorAffiliation": [], "authorOrcids": [], "key": "",
-                         "datasetDescription": "", "howpublished": "Dataset", "relatedPub": "", "datasetSubTitle": ""}
+        """Returns the parsed record of a DaRUS dataset, fetched at most once per run even if several
+        threads or dataverses ask for it at the same time"""
+        if not isDaRUSdoi(pid):
+            return None
+        with self.runRecordsLock:
+            future = self.runRecords.get(pid)
+            isOwner = future is None
+            if isOwner:
+                future = Future()
+                self.runRecords[pid] = future
+        if isOwner:
+            try:
+                future.set_result(self.loadDarusSet(pid))
+            except BaseException as e:
+                future.set_exception(e)
+                with self.runRecordsLock:
+                    if self.runRecords.get(pid) is future:
+                        del self.runRecords[pid]
+                raise
+        # records are immutable, so all callers can share one
+        return future.result()
+
+    def setRunDataverses(self, dvs):
+        """The dataverses this run lists, see retainDarusSet"""
+        self.runDataverses = list(dvs)
+
+    def getListingCount(self, dataverse):
+        """Number of the run's dataverses whose subtree contains dataverse, i.e. of its listings that
+        yield a dataset of dataverse (at least 1)"""
+        if len(self.runDataverses) < 2:
+            return 1
+        tree = self.getDataverseTree()
+        return max(sum(1 for dv in self.runDataverses if dataverse in tree.getSubtree(dv)), 1)
+
+    def retainDarusSet(self, pid, dataverse=None):
+        """Marks the record of a dataset as needed: iterDatasets retains every dataset it yields, the
+        consumer of the listing releases it once the entry is written.
+
+        iterDatasets passes the dataverse of the dataset: the first listing that yields it retains it
+        once for every listing of the run that contains it (setRunDataverses), so it stays in memory and
+        is fetched once even if it lies in the subtrees of several exported dataverses. A listing that does
+        not yield it after all (e.g. one with another watermark) leaves it in memory until the run ends."""
+        uses = 1 if dataverse is None else self.getListingCount(dataverse)
+        with self.runRecordsLock:
+            if dataverse is not None and pid in self.sharedRecords:
+                return
+            if uses > 1:
+                self.sharedRecords.add(pid)
+            self.runRecordUses[pid] = self.runRecordUses.get(pid, 0) + uses
+
+    def releaseDarusSet(self, pid):
+        """Drops the record and search metadata of a dataset from the run once no listing or upload that
+        retained it still needs it; a later getDarusSet reads it again (from the record cache if enabled)"""
+        with self.runRecordsLock:
+            uses = self.runRecordUses.get(pid, 0) - 1
+            if uses > 0:
+                self.runRecordUses[pid] = uses
+                return
+            self.runRecordUses.pop(pid, None)
+            self.runRecords.pop(pid, None)
+            self.searchRecords.pop(pid, None)
+
+    def isFailedDarusSet(self, pid):
+        """True if the record of pid could not be fetched in this run; getDarusSet then returns an empty
+        record, which must not pass for a dataset that is not released"""
+        with self.runRecordsLock:
+            return pid in self.failedDatasets
+
+    def peekDarusSet(self, pid):
+        """The record of getDarusSet if this run has read it already, else None (never fetches)"""
+        with self.runRecordsLock:
+            future = self.runRecords.get(pid)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
 
+    def loadDarusSet(self, pid):
         if isDaRUSdoi(pid):
+            versionKey = self.datasetVersions.get(pid)
+            if versionKey is not None:
+                versionKey = "{}#{}".format(versionKey, RECORD_VERSION)
+            if self.recordCache is not None and versionKey is not None:
+                cached = self.recordCache.get(pid, versionKey)
+                if cached is not None:
+                    return DarusRecord.fromDict(cached)
+            with self.runRecordsLock:
+                resFields = self.searchRecords.pop(pid, None)
+            if resFields is not None:
+                record = self.parseDarusSet(resFields, pid)
+                # unreleased versions are fetched on their own
+                if record.doi is not None:
+                    return record
+            start = time.perf_counter()
             try:
                 resFields = self.callDarusAPI(
                     url="{}api/datasets/:persistentId/?persistentId={}".format(self.credentials["darus"]["apiBaseUrl"], pid),
                     ApiKey=False, )
-                version = self.getVersion(resFields)
-                if version == "DRAFT" or version == "0.0":
-                    return keysAndValues
-                if "1.0" != self.getVersion(resFields):
-                    keysAndValues["url"] = "{}?version={}.{}".format(resFields['persistentUrl'],
-                        resFields['latestVersion']['versionNumber'], resFields['latestVersion']['versionMinorNumber'])
-                keysAndValues["year"] = resFields['publicationDate'][:4]
-                if resFields['protocol'] == "doi":
-                    keysAndValues["doi"] = '{}/{}'.format(resFields['authority'], resFields['identifier'])
-                if 'codeMeta20' in resFields['latestVersion']['metadataBlocks'] and len(
-                        resFields['latestVersion']['metadataBlocks']['codeMeta20']['fields']) > 0:
-                    keysAndValues["howpublished"] = "Software"
-                fields = resFields['latestVersion']['metadataBlocks']['citation']['fields']
-                for f in fields:
-                    if f["typeName"] == "dsDescription":
-                        for d in f["value"]:
-                            keysAndValues["datasetDescription"] += (self.removeHTML(d["dsDescriptionValue"]["value"]) + " ")
-                    if f["typeName"] == "author":
-                        for a in f["value"]:
-                            if "authors" not in keysAndValues:
-                                keysAndValues["authors"] = []
-                            if "affiliation" not in keysAndValues:
-                                keysAndValues["affiliation"] = []
-                            keysAndValues["authors"].append(a["authorName"]["value"])
-                            keysAndValues["key"] += a["authorName"]["value"].split(", ")[0]
-                            affil = ""
-                            if "authorAffiliation" in a:
-                                if "expandedvalue" in a["authorAffiliation"]:
-                                    affil = a["authorAffiliation"]["expandedvalue"]["termName"]
-                                else:
-                                    affil = a["authorAffiliation"]["value"]
-                            if affil not in keysAndValues["affiliation"] and affil != '':
-                                keysAndValues["affiliation"].append(
-                                    affil if "University of Stuttgart" not in affil and "Universität Stuttgart" not in affil else "University of Stuttgart")
-                            keysAndValues["authorAffiliation"].append("{}/{}".format(a["authorName"]["value"], affil))
-
-                            if "authorIdentifier" in a:
-                                if "authorIdentifierScheme" not in a or a["authorIdentifierScheme"]["value"] != "ORCID":
-                                    print("no orcid id for {} in dataset {}".format(a["authorIdentifier"]["value"], pid))
-                                else:
-                                    keysAndValues["authorOrcids"].append(
-                                        "{}/{}".format(a["authorName"]["value"], a["authorIdentifier"]["value"], ))
-
-                    if f["typeName"] == "title":
-                        keysAndValues["datasetTitle"] = f["value"]
-
-                    if f["typeName"] == "subtitle":
-                        keysAndValues["datasetSubTitle"] = f["value"]
-
-                    if f["typeName"] == "publication":
-                        pub = f["value"][0]
-                        relatedPub = "Related to: "
-                        if "publicationCitation" in pub:
-                            relatedPub = "{}{}".format(relatedPub, pub["publicationCitation"]["value"])
-                            relatedPub = (relatedPub if relatedPub[-1:] != "." else relatedPub[:-1])
-                        if "publicationIDNumber" in pub and "publicationIDType" in pub:
-                            relPubId = "{}: {}".format(pub["publicationIDType"]["value"], pub["publicationIDNumber"]["value"], )
-                            if relatedPub.find(relPubId) == -1:
-                                relatedPub = "{}. {}".format(relatedPub, relPubId)
-                        keysAndValues["relatedPub"] = self.removeNewLines(self.removeHTML(relatedPub))
             except ApiCallFailedException as e:
                 print("502", str(e))
-            return keysAndValues
+                with self.runRecordsLock:
+                    self.failedDatasets.add(pid)
+                return DarusRecord.fromDict(self.newDarusSet())
+            finally:
+                if self.datasetTimings is not None:
+                    self.datasetTimings.add(pid, "fetch", time.perf_counter() - start)
+            with self.runRecordsLock:
+                self.failedDatasets.discard(pid)
+            record = self.parseDarusSet(resFields, pid)
+            if self.recordCache is not None and versionKey is not None and record.doi is not None:
+                self.recordCache.put(pid, versionKey, record.toDict())
+            return record
         return None
 
+    def parseDarusSet(self, resFields, pid):
+        keysAndValues = self.newDarusSet()
+        version = self.getVersion(resFields)
+        if version == "DRAFT" or version == "0.0":
+            return DarusRecord.fromDict(keysAndValues)
+        keysAndValues["version"] = version
+        keysAndValues["persistentUrl"] = resFields['persistentUrl']
+        if "1.0" != version:
+            keysAndValues["url"] = "{}?version={}.{}".format(resFields['persistentUrl'],
+                resFields['latestVersion']['versionNumber'], resFields['latestVersion']['versionMinorNumber'])
+        keysAndValues["year"] = resFields['publicationDate'][:4]
+        if resFields['protocol'] == "doi":
+            keysAndValues["doi"] = '{}/{}'.format(resFields['authority'], resFields['identifier'])
+        if 'codeMeta20' in resFields['latestVersion']['metadataBlocks'] and len(
+                resFields['latestVersion']['metadataBlocks']['codeMeta20']['fields']) > 0:
+            keysAndValues["howpublished"] = "Software"
+        fields = resFields['latestVersion']['metadataBlocks']['citation']['fields']
+        for f in fields:
+            if f["typeName"] == "dsDescription":
+                for d in f["value"]:
+                    keysAndValues["datasetDescription"] += (self.removeHTML(d["dsDescriptionValue"]["value"]) + " ")
+            if f["typeName"] == "author":
+                for a in f["value"]:
+                    if "authors" not in keysAndValues:
+                        keysAndValues["authors"] = []
+                    if "affiliation" not in keysAndValues:
+                        keysAndValues["affiliation"] = []
+                    keysAndValues["authors"].append(a["authorName"]["value"])
+                    keysAndValues["key"] += a["authorName"]["value"].split(", ")[0]
+                    affil = ""
+                    if "authorAffiliation" in a:
+                        if "expandedvalue" in a["authorAffiliation"]:
+                            affil = a["authorAffiliation"]["expandedvalue"]["termName"]
+                        else:
+                            affil = a["authorAffiliation"]["value"]
+                    if affil not in keysAndValues["affiliation"] and affil != '':
+                        keysAndValues["affiliation"].append(
+                            affil if "University of Stuttgart" not in affil and "Universität Stuttgart" not in affil else "University of Stuttgart")
+                    keysAndValues["authorAffiliation"].append("{}/{}".format(a["authorName"]["value"], affil))
+
+                    if "authorIdentifier" in a:
+                        if "authorIdentifierScheme" not in a or a["authorIdentifierScheme"]["value"] != "ORCID":
+                            print("no orcid id for {} in dataset {}".format(a["authorIdentifier"]["value"], pid))
+                        else:
+                            keysAndValues["authorOrcids"].append(
+                                "{}/{}".format(a["authorName"]["value"], a["authorIdentifier"]["value"], ))
+
+            if f["typeName"] == "title":
+                keysAndValues["datasetTitle"] = f["value"]
+
+            if f["typeName"] == "subtitle":
+                keysAndValues["datasetSubTitle"] = f["value"]
+
+            if f["typeName"] == "publication":
+                pub = f["value"][0]
+                relatedPub = "Related to: "
+                if "publicationCitation" in pub:
+                    relatedPub = "{}{}".format(relatedPub, pub["publicationCitation"]["value"])
+                    relatedPub = (relatedPub if relatedPub[-1:] != "." else relatedPub[:-1])
+                if "publicationIDNumber" in pub and "publicationIDType" in pub:
+                    relPubId = "{}: {}".format(pub["publicationIDType"]["value"], pub["publicationIDNumber"]["value"], )
+                    if relatedPub.find(relPubId) == -1:
+                        relatedPub = "{}. {}".format(relatedPub, relPubId)
+                keysAndValues["relatedPub"] = self.removeNewLines(self.removeHTML(relatedPub))
+        return DarusRecord.fromDict(keysAndValues)
+
+    @staticmethod
+    def isUniStuttgartRecord(record):
+        """True if an author of the record is affiliated with the University of Stuttgart; only those
+        datasets belong into the Uni-Bibliography, in the export mail as well as uploaded to PUMA"""
+        return "University of Stuttgart" in record.affiliation or "Universität Stuttgart" in record.affiliation
+
     def genBibTex(self, pid):
-        setList = self.getDarusSet(pid)
-        if not setList is None:
-            authors = setList["authors"]
-            datasetTitle = setList["datasetTitle"] if "datasetTitle" in setList else ""
-            datasetSubTitle = setList["datasetSubTitle"] if "datasetSubTitle" in setList else ""
-            datasetDescription = (setList["datasetDescription"] if "datasetDescription" in setList else "")
-            year = setList["year"] if "year" in setList else ""
-            doi = setList["doi"] if "doi" in setList else ""
-            url = setList["url"] if "url" in setList else ""
-            authorOrcids = setList["authorOrcids"]
-            authorAffiliation = setList["authorAffiliation"]
-            key = setList["key"]
-            howpublished = setList["howpublished"]
-            relatedPub = setList["relatedPub"] if "relatedPub" in setList else ""
+        record = self.getDarusSet(pid)
+        if not record is None:
             bibtexStr = ""
 
-            if "University of Stuttgart" in setList["affiliation"] or "Universität Stuttgart" in setList["affiliation"]:
-                key += year + datasetTitle.split(" ")[0] + self.randomString(8)
-                template = self.credentials["puma"]["bibTexTemplate"]
-                datasetTitle = self.genTitle(datasetTitle, datasetSubTitle)
-                values = {"authors": self.joinAuthors(authors), "key": key.replace(" ", ""),
-                          "description": self.removeNewLines(datasetDescription), "doi": doi, "howpublished": howpublished,
-                          "relatedPub": relatedPub, "title": datasetTitle, "year": year, "url": url,
-                          "affiliation": ", ".join(authorAffiliation), "orcid": ", ".join(authorOrcids), }
-                fh = open(template)
-                bibtexStr = Template(fh.read()).safe_substitute(values)
-                fh.close()
+            if self.isUniStuttgartRecord(record):
+                bibtexStr = self.renderTemplate(self.credentials["puma"]["bibTexTemplate"], self.getBibTexValues(record))
             return bibtexStr
         return {}
 
+    def getBibTexValues(self, record):
+        """The template values of a record, the same for the BibTeX entry of the export mail and the one
+        uploaded to PUMA, so an uploaded post compares equal to its dataset in getChanges"""
+        key = record.key + record.year + record.datasetTitle.split(" ")[0] + self.randomString(8)
+        return {"authors": self.joinAuthors(list(record.authors)), "key": key.replace(" ", ""),
+                "description": self.removeNewLines(record.datasetDescription), "doi": record.doi or "",
+                "howpublished": record.howpublished, "relatedPub": record.relatedPub,
+                "title": self.genTitle(record.datasetTitle, record.datasetSubTitle), "year": record.year,
+                "url": record.url, "affiliation": ", ".join(record.authorAffiliation),
+                "orcid": ", ".join(record.authorOrcids), }
+
+    @staticmethod
+    def renderTemplate(path, values):
+        with open(path, encoding="utf_8") as fh:
+            return Template(fh.read()).safe_substitute(values)
+
     @staticmethod
     def getVersion(resFields):
         if "latestVersion" in resFields:
@@ -187,95 +336,216 @@ class Exporter:
             print("no latest version for dataset", "{}/{}".format(resFields["authority"], resFields["identifier"]), )
             return "0.0"
 
+    @staticmethod
+    def getVersionKey(searchItem):
+        if "majorVersion" not in searchItem or "minorVersion" not in searchItem or "updatedAt" not in searchItem:
+            return None
+        return "{}.{}@{}".format(searchItem["majorVersion"], searchItem["minorVersion"], searchItem["updatedAt"])
+
     @staticmethod
     def removeHTML(strElement):
-        return lxml.html.fromstring(strElement).text_content()
+        return stripHTML(strElement)
 
     @staticmethod
     def randomString(stringLength=6):
         return "".join([random.choice(string.ascii_letters) for _ in range(stringLength)])
 
-    def getDatasets(self, toFilter, validDataverses):
-        datasets = []
-        start = 0
-        # total = 0
+    def searchDarus(self, toFilter, searchType="dataset", key="global_id", startAt=0):
+        """Yields all items of a paginated api/search query in result order, deduplicated on key.
+
+        The first page tells the total count, the remaining pages are then requested concurrently
+        (darus pageWorkers, default 4). Raises ApiCallFailedException after all items of the pages
+        before the failed one have been yielded. startAt skips the pages before that item.
+        """
         perPage = 100
-        test = True
-        while test:
-            url = ("{}api/search?q=*&fq=publicationStatus:Published&start={}&per_page={}&type=dataset{}".format(
-                self.credentials["darus"]["apiBaseUrl"], start, perPage, toFilter))
-            try:
-                data = self.callDarusAPI(url)
-                total = data["total_count"]
-                start = start + perPage
-                for ds in data["items"]:
-                    if len(validDataverses) == 0 or ds["identifier_of_dataverse"] in validDataverses:
-                        datasets.append(ds["global_id"])
-                    else:
-                        print("dataset {}: dataverse_id {} not in valid dataverses {}".format(ds["global_id"],
-                                                                                              ds["identifier_of_dataverse"],
-                                                                                              validDataverses))
-                test = start < total
-            except ApiCallFailedException as e:
-                print("Call failed:", str(e))
-                test = False
-        return datasets
+        first = startAt - startAt % perPage
+
+        def getPage(start):
+            url = "{}api/search?q=*&fq=publicationStatus:Published&start={}&per_page={}&type={}{}".format(
+                self.credentials["darus"]["apiBaseUrl"], start, perPage, searchType, toFilter)
+            return self.callDarusAPI(url)
+
+        data = getPage(first)
+        seen = set()
+        workers = max(int(self.getOption("darus", "pageWorkers", 4)), 1)
+        pages = orderedMap(lambda start: getPage(start)["items"], range(first + perPage, data["total_count"], perPage),
+                           workers)
+        for items in itertools.chain([data["items"]], pages):
+            for item in items:
+                if item[key] not in seen:
+                    seen.add(item[key])
+                    yield item
+
+    def getMetadataFilter(self):
+        """Search parameters asking for the metadata blocks parseDarusSet reads (darus metadataBlocks),
+        empty if darus bulkMetadata is switched off"""
+        if not self.getOption("darus", "bulkMetadata", True):
+            return ""
+        blocks = self.getOption("darus", "metadataBlocks", ["citation", "codeMeta20"])
+        return "".join("&metadata_fields={}:*".format(block) for block in blocks)
 
-    def getDatasetsSince(self, date):
-        now = datetime.now() + timedelta(days=1)
-        timeformat = "%Y-%m-%dT00:00:00Z"
-        toFilter = "&fq=dateSort:[{}+TO+{}]".format(date.strftime(timeformat), now.strftime(timeformat))
-        return self.getDatasets(toFilter, {})
+    @staticmethod
+    def getSearchRecord(searchItem):
+        """Builds the part of an api/datasets response parseDarusSet needs from a search item with
+        metadata blocks. Returns None if the search index lacks something, the dataset then has to be
+        fetched on its own."""
+        blocks = searchItem.get("metadataBlocks", {})
+        if "citation" not in blocks or "fields" not in blocks["citation"]:
+            return None
+        if not any(f["typeName"] == "title" for f in blocks["citation"]["fields"]):
+            return None
+        if any(key not in searchItem for key in ["url", "versionState", "majorVersion", "minorVersion", "citation"]):
+            return None
+        # the year of the citation is the one of the first publication, like publicationDate of api/datasets
+        year = CITATION_YEAR_PATTERN.search(searchItem["citation"])
+        if year is None:
+            return None
+        # the search lower-cases global_id, the storage identifier keeps the case of the DOI
+        globalId = searchItem["global_id"]
+        storageIdentifier = searchItem.get("storageIdentifier", "")
+        doi = storageIdentifier[storageIdentifier.find("://") + 3:] if "://" in storageIdentifier else ""
+        if not globalId.startswith("doi:") or doi.lower() != globalId[4:].lower() or "/" not in doi:
+            return None
+        authority, identifier = doi.split("/", 1)
+        return {"persistentUrl": searchItem["url"], "protocol": "doi", "authority": authority, "identifier": identifier,
+                "publicationDate": year.group(1),
+                "latestVersion": {"versionState": searchItem["versionState"], "versionNumber": searchItem["majorVersion"],
+                                  "versionMinorNumber": searchItem["minorVersion"], "metadataBlocks": blocks}}
+
+    def addSearchRecord(self, searchItem):
+        """Keeps the metadata of a search item for getDarusSet, which only parses it if the record is
+        needed (not for datasets whose fingerprint is unchanged). Returns False if the dataset has to be
+        fetched with api/datasets instead."""
+        resFields = self.getSearchRecord(searchItem)
+        if resFields is None:
+            return False
+        pid = searchItem["global_id"]
+        with self.runRecordsLock:
+            if pid not in self.runRecords:
+                self.searchRecords[pid] = resFields
+        return True
 
-    def getDatasetsByDataverse(self, dataverse):
-        dvs = self.getSubDataverses(dataverse)
-        dvs.append(dataverse)
+    def iterDatasets(self, toFilter, validDataverses, startAt=0):
+        """Yields the global ids of the matching datasets while the search pages are still being fetched.
 
-        toFilter = "&subtree={}".format(dataverse)
-        return self.getDatasets(toFilter, dvs)
+        With darus bulkMetadata (default) the search returns the metadata of the datasets as well, so
+        getDarusSet only calls api/datasets for datasets the search index has incomplete data for. Every
+        yielded dataset is retained (retainDarusSet) until the consumer releases it.
 
-    def getTopLevelDataverses(self):
-        url = "{}/api/dataverses/{}/contents".format(self.credentials["darus"]["apiBaseUrl"], ":root")
-        dvs = []
+        Raises ApiCallFailedException if a search page still fails after all retries, once the datasets
+        of the pages before it are yielded: a shortened listing must not pass for a complete one.
+        """
         try:
-            results = self.callDarusAPI(url, ApiKey=False)
-            for dv in results:
-                if dv["type"] == "dataverse":
-                    url_dv = "{}/api/dataverses/{}".format(self.credentials["darus"]["apiBaseUrl"], dv["id"])
-                    details = self.callDarusAPI(url_dv)
-                    dvs.append(details["alias"])
-            return dvs
+            for ds in self.searchDarus(toFilter + self.getMetadataFilter(), startAt=startAt):
+                if len(validDataverses) == 0 or ds["identifier_of_dataverse"] in validDataverses:
+                    versionKey = self.getVersionKey(ds)
+                    if versionKey is not None:
+                        self.datasetVersions[ds["global_id"]] = versionKey
+                    self.addSearchRecord(ds)
+                    self.retainDarusSet(ds["global_id"], ds["identifier_of_dataverse"])
+                    yield ds["global_id"]
+                else:
+                    print("dataset {}: dataverse_id {} not in valid dataverses {}".format(ds["global_id"],
+                                                                                          ds["identifier_of_dataverse"],
+                                                                                          validDataverses))
         except ApiCallFailedException as e:
             print("Call failed:", str(e))
+            raise
+
+    def iterWithRetries(self, datasets, retries):
+        """Yields the datasets of a listing, then those of retries (see ExportState.getRetries) the listing
+        did not contain, retained like the listed ones"""
+        listed = set()
+        for ds in datasets:
+            listed.add(ds)
+            yield ds
+        for ds in retries:
+            if ds not in listed:
+                self.retainDarusSet(ds)
+                yield ds
 
-    def getSubDataverses(self, dv):
-        dvs = []
-        start = 0
-        # total = 0
-        perPage = 100
-        test = True
-        while test:
-            url = "{}api/search?q=*&fq=publicationStatus:Published&start={}&per_page={}&type=dataverse&subtree={}".format(
-                self.credentials["darus"]["apiBaseUrl"], start, perPage, dv)
+    def getDatasets(self, toFilter, validDataverses):
+        return list(self.iterDatasets(toFilter, validDataverses))
+
+    @staticmethod
+    def getDateFilter(date):
+        """Search filter for the datasets or dataverses dated on or after the day of date. The search
+        dates are UTC; a naive date is local time (like the watermarks of ExportState) and is converted
+        before it is cut to the day, so the window never starts after date."""
+        now = datetime.now(timezone.utc) + timedelta(days=1)
+        timeformat = "%Y-%m-%dT00:00:00Z"
+        return "&fq=dateSort:[{}+TO+{}]".format(date.astimezone(timezone.utc).strftime(timeformat),
+                                                now.strftime(timeformat))
+
+    def getDatasetsSince(self, date):
+        return self.getDatasets(self.getDateFilter(date), {})
+
+    def iterDatasetsByDataverse(self, dataverse, since=None, startAt=0):
+        toFilter = "&subtree={}".format(dataverse)
+        if since is not None:
+            toFilter += self.getDateFilter(since)
+        toFilter += LISTING_SORT
+        validDataverses = SubtreeFilter(self.getDataverseTree(), dataverse, self.refreshUnknownDataverses)
+        return self.iterDatasets(toFilter, validDataverses, startAt)
+
+    def getDatasetsByDataverse(self, dataverse, since=None):
+        return list(self.iterDatasetsByDataverse(dataverse, since))
+
+    def getDataverseTree(self, full=False):
+        """Returns the dataverse tree, loaded from darus treeFile and refreshed once per run if it is
+        older than treeTtlHours (default 24), fully after treeMaxAgeDays (default 7) or if full is set"""
+        with self.dataverseTreeLock:
+            if self.dataverseTree is None:
+                self.dataverseTree = DataverseTree(self.getOption("darus", "treeFile", "output/dataverseTree.json"))
+            if not self.dataverseTreeRefreshed and (full or self.dataverseTree.isStale(
+                    float(self.getOption("darus", "treeTtlHours", 24)))):
+                self.refreshDataverseTree(full)
+            return self.dataverseTree
+
+    def refreshDataverseTree(self, full=False):
+        with self.dataverseTreeLock:
+            tree = self.dataverseTree
+            full = full or tree.needsFullRefresh(int(self.getOption("darus", "treeMaxAgeDays", 7)))
+            # the refresh is built on a copy, so concurrent subtree lookups never see a half-updated tree
+            target = DataverseTree()
+            toFilter = ""
+            if not full:
+                for node in tree.nodes.values():
+                    target.add(node)
+                toFilter = self.getDateFilter(tree.getRefreshSince())
+            self.dataverseTreeRefreshed = True
             try:
-                data = self.callDarusAPI(url)
-                total = data["total_count"]
-                start = start + perPage
-                for subdv in data["items"]:
-                    dvs.append(subdv["identifier"])
-                test = start < total
+                for item in self.searchDarus(toFilter, searchType="dataverse", key="identifier"):
+                    target.add(item)
             except ApiCallFailedException as e:
-                print("Call failed:", str(e))
-                test = False
-        return dvs
+                print("Refresh of dataverse tree failed, using tree of {}: {}".format(tree.refreshedAt, e))
+                return tree
+            tree.replace(target)
+            tree.markRefreshed(full)
+            tree.save()
+            print("{} refresh of dataverse tree: {} dataverses".format("full" if full else "incremental", len(tree)))
+            return tree
+
+    def refreshUnknownDataverses(self):
+        # a dataset in a dataverse the tree does not know: refresh, unless that already happened in this run
+        with self.dataverseTreeLock:
+            if not self.dataverseTreeRefreshed:
+                self.refreshDataverseTree()
+
+    def getTopLevelDataverses(self):
+        return self.getDataverseTree().getTopLevel()
+
+    def getSubDataverses(self, dv):
+        return self.getDataverseTree().getSubDataverses(dv)
 
     def getPumaEntryByDOI(self, posts, doi):
-        result = []
-        for post in posts:
-            # print("post:", post)
-            if self.checkDOI(post, doi):
-                result.append(post)
-        return result
+        return DoiIndex(posts).get(doi)
+
+    def getPumaEntriesByDOIs(self, posts, dois):
+        index = DoiIndex(posts)
+        for post in index.invalid:
+            print("No valid PUMA post:", post)
+        return index.lookupMany(dois)
 
     def checkDOI(self, post, doi):
         if "bibtex" not in post or "misc" not in post["bibtex"]:
@@ -285,13 +555,7 @@ class Exporter:
 
     @staticmethod
     def getDOI(stringValue):
-        doi = ""
-        result = re.search(r"doi\s*=\s*\{(.*?)}", stringValue)
-
-        if result is not None:
-            doi = result.group(1)
-
-        return doi
+        return getMiscDOI(stringValue)
 
     @staticmethod
     def getShortDOI(stringValue):
@@ -301,59 +565,120 @@ class Exporter:
             doi = "DARUS+" + result.group(1)
         return doi
 
-    def getAllDatasetsFromUniBiblio(self):
-        posts = {}
-        start = 0
+    def iterUniBiblioPages(self, search=None, start=0):
+        import requests
+
         step = 100
-        ok = True
-        while ok:
+        while True:
             end = start + step
             url = ("{}posts?user=unibiblio&tags=unibibliografie+darus&resourcetype=publication&format=json&start={}&end={"
                    "}").format(
                 self.credentials["puma"]["baseUrl"], start, end)
+            if search is not None:
+                url += "&search={}".format(search)
             start = end
             # print(url)
 
+            # the page is parsed while it arrives and each post is compacted right away, so a page is
+            # never held as text, full posts and compact posts at the same time
+            response = self.callPumaAPI(url, {}, expectedCode=200, method="get", stream=True)
             try:
-                data = self.callPumaAPI(url, {}, expectedCode=200, method="get")
-            except ApiCallFailedException as e:
-                print("Call failed:", str(e))
-                return None
+                with response:
+                    page = JsonArrayStream(response.iter_content(PAGE_CHUNK_SIZE), "post")
+                    posts = [compactPost(post) for post in page]
+            except (requests.RequestException, ValueError) as e:
+                raise ApiCallFailedException("PUMA-Call of {} raised Exception: {}".format(url, e))
+            data = page.document
             if data["stat"] != "ok":
-                print("Call not ok:", data["stat"])
-                return None
+                raise ApiCallFailedException("PUMA-Call not ok: {}".format(data["stat"]))
             if "post" not in data["posts"]:
-                ok = False
-            else:
-                for post in data["posts"]["post"]:
-                    posts[self.getDOI(post["bibtex"]["misc"])] = self.genDatasetFromPost(post)
+                return
+            yield posts
+
+    def getPumaSnapshot(self):
+        if self.pumaSnapshot is None:
+            self.pumaSnapshot = PumaSnapshot(self.getOption("puma", "snapshotFile", "output/pumaSnapshot.json"))
+        return self.pumaSnapshot
+
+    def refreshPumaSnapshot(self, full=False):
+        """Loads all posts into the snapshot, or with puma snapshotIncremental only those posted since the
+        last refresh. A full refresh that breaks off keeps the pages read so far and is continued by the
+        next one; until then the old snapshot is used.
+
+        PUMA lists the posts by posting date, so an incremental refresh does not see the library correct
+        an existing post: that only changes its changedate. Incremental snapshots therefore pick up such
+        corrections with the next full refresh (snapshotMaxAgeDays, default 7); by default every refresh
+        is full, the DaRUS posts of the Uni-Bibliography are only a few pages."""
+        snapshot = self.getPumaSnapshot()
+        full = full or not self.getOption("puma", "snapshotIncremental", False) or snapshot.needsFullRefresh(
+            int(self.getOption("puma", "snapshotMaxAgeDays", 7)))
+        target = PumaSnapshot() if full else snapshot
+        newest = None
+        start = 0
+        resumed = full and snapshot.partial is not None
+        keepNewest = False
+        if resumed:
+            for post in snapshot.partial["posts"]:
+                target.add(post)
+            newest = snapshot.partial["highWaterMark"]
+            keepNewest = newest is not None
+            # PUMA lists the newest posts first, new posts push the rest back: re-read one page
+            start = max(snapshot.partial["start"] - 100, 0)
+            print("continuing full refresh of PUMA snapshot at post {}".format(start))
+        position = start
+        try:
+            for posts in self.iterUniBiblioPages(start=start):
+                position += 100
+                reachedKnown = False
+                for post in posts:
+                    postDate = getPostDate(post)
+                    if not keepNewest and postDate is not None and (newest is None or postDate > newest):
+                        newest = postDate
+                    if not full and postDate is not None and postDate <= snapshot.highWaterMark:
+                        reachedKnown = True
+                    else:
+                        target.add(post)
+                if reachedKnown:
+                    break
+        except ApiCallFailedException as e:
+            if full:
+                snapshot.savePartial(list(target.posts.values()), position, newest)
+            print("Refresh of PUMA snapshot failed, using snapshot of {}: {}".format(snapshot.refreshedAt, e))
+            return snapshot
+        if full:
+            snapshot.replace(target)
+        # a continued refresh keeps the high-water mark of its first part, so the next incremental
+        # refresh picks up posts changed in between
+        snapshot.markRefreshed(newest, full)
+        snapshot.save()
+        print("{} refresh of PUMA snapshot: {} posts".format("full" if full else "incremental", len(snapshot)))
+        return snapshot
+
+    def getAllDatasetsFromUniBiblio(self, full=False, refresh=True):
+        snapshot = self.refreshPumaSnapshot(full) if refresh else self.getPumaSnapshot()
+        if len(snapshot) == 0:
+            return None
+        for doi, duplicates in snapshot.dois.duplicates().items():
+            print("More than one entry of doi {} in Uni-Bibliography: {} entries".format(doi, len(duplicates)))
+        posts = {}
+        for doi, post in snapshot.iterByDOI():
+            posts[doi] = self.genDatasetFromPost(post)
+        if self.stateStore is not None:
+            self.stateStore.syncPumaPosts(snapshot, {doi: fingerprint(self.getPumaComparison(puma_ds))
+                                                     for doi, puma_ds in posts.items()})
         return posts
 
     def getDatasetFromUniBiblio(self, doi):
-        posts = []
-        start = 0
-        step = 100
-        ok = True
-        while ok:
-            end = start + step
-            url = ("{}posts?user=unibiblio&search={"
-                   "}&tags=unibibliografie+darus&resourcetype=publication&format=json&start={}&end={}").format(
-                self.credentials["puma"]["baseUrl"], self.getShortDOI(doi), start, end)
-            start = end
-            # print(url)
-
+        if self.pumaSnapshot is not None and len(self.pumaSnapshot) > 0:
+            posts = self.pumaSnapshot.getAllByDOI(doi)
+        else:
+            posts = []
             try:
-                data = self.callPumaAPI(url, {}, expectedCode=200, method="get")
+                for page in self.iterUniBiblioPages(self.getShortDOI(doi)):
+                    posts.extend(self.getPumaEntryByDOI(page, doi))
             except ApiCallFailedException as e:
                 print("Call failed:", str(e))
                 return None
-            if data["stat"] != "ok":
-                print("Call not ok:", data["stat"])
-                return None
-            if "post" not in data["posts"]:
-                ok = False
-            else:
-                posts.extend(self.getPumaEntryByDOI(data["posts"]["post"], doi))
         if len(posts) == 0:
             print("No entry of doi {} in Uni-Bibliography".format(doi))
             return None
@@ -364,10 +689,7 @@ class Exporter:
 
     @staticmethod
     def genDatasetFromPost(post):
-        dataset = {"bibtex": post["bibtex"], "tags": [], "user": post["user"]}
-        for tag in post["tag"]:
-            dataset["tags"].append(tag["name"])
-        return dataset
+        return PumaRecord.fromPost(post)
 
     @staticmethod
     def joinAuthors(authorlist, joinstr=" and "):
@@ -385,8 +707,8 @@ class Exporter:
         return datasetTitle
 
     def genPumaURL(self, puma_ds):
-        return "{}bibtex/{}/{}".format(self.credentials["puma"]["baseUrl"].replace("/api", ""), puma_ds["bibtex"]["intrahash"],
-                                       puma_ds["user"]["name"], )
+        return "{}bibtex/{}/{}".format(self.credentials["puma"]["baseUrl"].replace("/api", ""), puma_ds.intrahash,
+                                       puma_ds.user, )
 
     @staticmethod
     def genChangeMessage(field, version_ub, version_darus):
@@ -406,91 +728,209 @@ class Exporter:
     def replaceDash(text):
         return text.replace("‐", "-").replace("‑", "-")
 
+    def getPumaComparison(self, puma_ds):
+        """The fields of a PUMA post in the normalized form getChanges compares them"""
+        return [("Titel", self.removeBrackets(puma_ds.title)),
+                ("Author", self.removeBrackets(puma_ds.author)),
+                ("howpublished", puma_ds.howpublished),
+                ("year", puma_ds.year),
+                ("affiliation", self.removeNewLines(puma_ds.affiliation)),
+                ("orcid", self.removeNewLines(puma_ds.orcidNumbers)),
+                ("doi", self.removeNewLines(puma_ds.doi)),
+                ("related publication", puma_ds.note)]
+
+    def getDarusComparison(self, darus_ds):
+        """The fields of a DaRUS record in the normalized form getChanges compares them"""
+        return [("Titel", self.replaceDash(self.genTitle(darus_ds.datasetTitle, darus_ds.datasetSubTitle))),
+                ("Author", self.joinAuthors(list(darus_ds.authors))),
+                ("howpublished", darus_ds.howpublished),
+                ("year", darus_ds.year),
+                ("affiliation", ", ".join(darus_ds.authorAffiliation)),
+                ("orcid", ", ".join(darus_ds.authorOrcids)),
+                ("doi", darus_ds.doi),
+                ("related publication", self.replaceDash(self.removeNewLines(darus_ds.relatedPub)))]
+
     def getChanges(self, darus_ds, puma_ds):
         changes = []
-        p_ds = puma_ds["bibtex"]
-
-        p_title = self.removeBrackets(p_ds["title"])
-        d_title = self.replaceDash(self.genTitle(darus_ds["datasetTitle"], darus_ds["datasetSubTitle"]))
-        if p_title != d_title:
-            changes.append(self.genChangeMessage("Titel", p_title, d_title))
-
-        p_author = self.removeBrackets(p_ds["author"])
-        if p_author != self.joinAuthors(darus_ds["authors"]):
-            changes.append(self.genChangeMessage("Author", p_ds["author"], self.joinAuthors(darus_ds["authors"])))
-
-        if p_ds["howpublished"] != darus_ds["howpublished"]:
-            changes.append(self.genChangeMessage("howpublished", p_ds["howpublished"], darus_ds["howpublished"]))
-
-        if p_ds["year"] != darus_ds["year"]:
-            changes.append(self.genChangeMessage("year", p_ds["year"], darus_ds["year"]))
-
-        misc = self.removeNewLines(p_ds["misc"])
-        p_a = re.search(r"affiliation\s*=\s*\{(.*?)}", misc)
-
-        p_affiliation = ""
-        if p_a is not None:
-            p_affiliation = p_a.group(1)
-
-        p_o = re.search(r"orcid-numbers\s*=\s*\{(.*?)}", misc)
-
-        p_orcid = ""
-        if p_o is not None:
-            p_orcid = p_o.group(1)
-
-        p_doi = self.getDOI(misc)
-
-        d_affiliation = ", ".join(darus_ds["authorAffiliation"])
-        d_orcid = ", ".join(darus_ds["authorOrcids"])
-
-        if p_affiliation != d_affiliation:
-            changes.append(self.genChangeMessage("affiliation", p_affiliation, d_affiliation))
-
-        if p_orcid != d_orcid:
-            changes.append(self.genChangeMessage("orcid", p_orcid, d_orcid))
-
-        if p_doi != darus_ds["doi"]:
-            changes.append(self.genChangeMessage("doi", p_doi, darus_ds["doi"]))
+        for (field, p_value), (_, d_value) in zip(self.getPumaComparison(puma_ds), self.getDarusComparison(darus_ds)):
+            if p_value != d_value:
+                # the author change shows the PUMA value as stored, with its brackets
+                shown = puma_ds.author if field == "Author" else p_value
+                changes.append(self.genChangeMessage(field, shown, d_value))
+        return changes
 
-        p_relpub = p_ds["note"] if "note" in p_ds else ""
-        d_relpub = self.replaceDash(self.removeNewLines(darus_ds["relatedPub"]))
-        if p_relpub != d_relpub:
-            changes.append(self.genChangeMessage("related publication", p_relpub, d_relpub))
+    def getDarusFingerprint(self, ds):
+        """Fingerprint of the compared fields of a DaRUS dataset, from the fingerprint store if the
+        dataset version did not change, else from its record. None if the record is not available."""
+        versionKey = self.datasetVersions.get(ds)
+        if self.fingerprints is not None:
+            cached = self.fingerprints.get(ds, versionKey)
+            if cached is not None:
+                if self.stateStore is not None:
+                    self.stateStore.putFingerprint(ds, versionKey, cached)
+                return cached
+        darus_ds = self.getDarusSet(ds)
+        if darus_ds is None or darus_ds.doi is None:
+            return None
+        value = fingerprint(self.getDarusComparison(darus_ds))
+        if self.fingerprints is not None:
+            self.fingerprints.put(ds, versionKey, value)
+        if self.stateStore is not None:
+            self.stateStore.putFingerprint(ds, versionKey, value)
+        return value
+
+    def getExportEntry(self, ds, pumaDatasets):
+        doi = normalizeDOI(ds)
+
+        if doi not in pumaDatasets:
+            bibtex = self.genBibTex(ds)
+            if self.isFailedDarusSet(ds):
+                return "failed", ""
+            return "new", bibtex
+        puma_ds = pumaDatasets[doi]
+        with self.metrics.stage("diff"):
+            # equal fingerprints mean getChanges would not find anything
+            unchanged = self.getDarusFingerprint(ds) == fingerprint(self.getPumaComparison(puma_ds))
+        if self.fingerprints is not None:
+            self.fingerprints.count(unchanged)
+        if unchanged:
+            return None, ""
+        darus_ds = self.getDarusSet(ds)
+        if darus_ds is None or darus_ds.doi is None:
+            return "failed" if self.isFailedDarusSet(ds) else None, ""
+        with self.metrics.stage("diff"):
+            changes = self.getChanges(darus_ds, puma_ds)
+        if len(changes) == 0:
+            return None, ""
+        ch_str = "Änderungen in Datensatz {}:\n".format(ds)
+        ch_str += "\n".join(changes)
+        ch_str += "\nUnibibliolink: {}\n\n".format(self.genPumaURL(puma_ds))
+        return "changed", ch_str
+
+    def getTimedExportEntry(self, ds, pumaDatasets):
+        """getExportEntry, timed per dataset while the run is profiled"""
+        if self.datasetTimings is None:
+            return self.getExportEntry(ds, pumaDatasets)
+        start = time.perf_counter()
+        try:
+            return self.getExportEntry(ds, pumaDatasets)
+        finally:
+            self.datasetTimings.add(ds, "total", time.perf_counter() - start)
 
-        return changes
+    def getCheckpoint(self, dv, since=None):
+        """Returns the checkpoint of the export of dv for the watermark since, resumed if an earlier run
+        with the same parameters was interrupted"""
+        path = os.path.join(self.getOption("export", "checkpointDir", "output/checkpoints"), "{}.json".format(dv))
+        return ExportCheckpoint(path, dv, since.strftime(TIMEFORMAT) if since is not None else None)
 
-    def writeExportFiles(self, darusDatasets, pumaDatasets, dv="darus"):
-        now = datetime.now()
-        exportDate = now.strftime("%Y-%m-%d")
+    @staticmethod
+    def openPartFile(path, offset):
+        """Opens a .part file for appending after offset, or returns None if it is shorter than that"""
+        if offset == 0:
+            return open(path, "wb")
+        if not os.path.exists(path) or os.path.getsize(path) < offset:
+            return None
+        partFile = open(path, "r+b")
+        # entries written after the last checkpoint are written again
+        partFile.truncate(offset)
+        partFile.seek(offset)
+        return partFile
+
+    def writeExportFiles(self, darusDatasets, pumaDatasets, dv="darus", checkpoint=None):
+        """Writes the new datasets as BibTeX and the changed ones as change report.
+
+        darusDatasets may be any iterable, e.g. the generator of iterDatasetsByDataverse: ids are
+        fetched and compared by export workers while the listing continues, and every entry is
+        written as soon as all entries before it are done. At most export queueSize entries
+        (default 2 * workers) are buffered between the stages, and the record of a dataset is
+        released (releaseDarusSet) once its entry is written. Returns the two file names.
+
+        The files are written as .part files and renamed when complete. Every export checkpointEvery
+        entries (default 50) and on errors the progress is saved to the checkpoint, so an interrupted
+        run is continued by the next one without processing the written entries again. Datasets that
+        could not be fetched are written to neither file; they are collected in checkpoint.failed.
+        """
+        if checkpoint is None:
+            checkpoint = self.getCheckpoint(dv)
+        if checkpoint.exportDate is None:
+            checkpoint.exportDate = datetime.now().strftime("%Y-%m-%d")
+        exportDate = checkpoint.exportDate
 
         filename = "output/{}_{}_export.bib".format(exportDate, dv)
         filename_changes = "output/{}_{}_changes.txt".format(exportDate, dv)
-        # datasets = getDatasetsSince(last)
-        with open(filename, "w", encoding="utf_8") as out:
-            with open(filename_changes, "w", encoding="utf_8") as changes_out:
-                for ds in darusDatasets:
-                    doi = ds[4:] if ds[0:4] == "doi:" else ds
-                    doi = doi.lower()
-                    
-                    if doi not in pumaDatasets:
-                        bibtex = self.genBibTex(ds)
-                        print("new dataset {}".format(ds))
-                        out.writelines(bibtex)
-                    else:
-                        darus_ds = self.getDarusSet(ds)
-                        if not darus_ds is None:
-                            puma_ds = pumaDatasets[doi]
-                            changes = self.getChanges(darus_ds, puma_ds)
-                            if len(changes) > 0:
-                                print("changed dataset {}".format(ds))
-                                ch_str = "Änderungen in Datensatz {}:\n".format(ds)
-                                ch_str += "\n".join(changes)
-                                ch_str += "\nUnibibliolink: {}\n\n".format(self.genPumaURL(puma_ds))
-                                changes_out.writelines(ch_str)
+        workers = max(int(self.getOption("export", "workers", 1)), 1)
+        window = int(self.getOption("export", "queueSize", 2 * workers))
+        checkpointEvery = max(int(self.getOption("export", "checkpointEvery", 50)), 1)
+        out = self.openPartFile(filename + ".part", checkpoint.offsets["export"])
+        changes_out = self.openPartFile(filename_changes + ".part", checkpoint.offsets["changes"])
+        if out is None or changes_out is None:
+            print("part files of checkpoint for dataverse {} are missing, starting over".format(dv))
+            for partFile in [out, changes_out]:
+                if partFile is not None:
+                    partFile.close()
+            checkpoint.reset()
+            out = open(filename + ".part", "wb")
+            changes_out = open(filename_changes + ".part", "wb")
+        elif checkpoint.resumed:
+            print("resuming export of dataverse {} after {} datasets".format(dv, len(checkpoint)))
+
+        def pending(datasets):
+            for ds in datasets:
+                if ds in checkpoint:
+                    self.releaseDarusSet(ds)
+                else:
+                    yield ds
+
+        def saveCheckpoint():
+            out.flush()
+            changes_out.flush()
+            checkpoint.save({"export": out.tell(), "changes": changes_out.tell()})
+            if self.stateStore is not None:
+                self.stateStore.commit()
+
+        with out, changes_out:
+            try:
+                # orderedMap yields in input order, so the files are written in the order of darusDatasets
+                entries = orderedMap(lambda ds: (ds,) + self.getTimedExportEntry(ds, pumaDatasets),
+                                     pending(darusDatasets), workers, window)
+                for ds, status, text in entries:
+                    with self.metrics.stage("writing"):
+                        if status == "new":
+                            print("new dataset {}".format(ds))
+                            # genBibTex returns an empty value for datasets it cannot render
+                            if text:
+                                out.write(text.encode("utf_8"))
+                        elif status == "changed":
+                            print("changed dataset {}".format(ds))
+                            changes_out.write(text.encode("utf_8"))
+                        elif status == "failed":
+                            print("dataset {} could not be read, it is retried by the next run".format(ds))
+                        if self.stateStore is not None:
+                            self.stateStore.recordDataset(ds, dv, self.datasetVersions.get(ds), status or "unchanged",
+                                                          self.peekDarusSet(ds))
+                        checkpoint.add(ds, status == "failed")
+                        self.releaseDarusSet(ds)
+                        if len(checkpoint) % checkpointEvery == 0:
+                            saveCheckpoint()
+            except BaseException:
+                saveCheckpoint()
+                raise
+            for partFile in [out, changes_out]:
+                partFile.flush()
+                os.fsync(partFile.fileno())
+        os.replace(filename + ".part", filename)
+        os.replace(filename_changes + ".part", filename_changes)
+        checkpoint.remove()
         files = [filename, filename_changes]
         return files
 
     def sendMailToUniBiblio(self, files, mailHost):
+        import smtplib
+        from email.header import Header
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
         fromAdr = "Darus Export <fokus@izus.uni-stuttgart.de>"
         toAdr = self.credentials["unibiblio"]["email"]
         message = MIMEMultipart()
@@ -516,28 +956,57 @@ class Exporter:
         s.quit()
 
 
+    def getTransport(self, backend):
+        from httpTransport import AdaptiveLimiter, Transport, TransportRegistry
+
+        def factory():
+            from requests.auth import HTTPBasicAuth
+
+            auth = None
+            if backend == "puma":
+                auth = HTTPBasicAuth(self.credentials["puma"]["user"], self.credentials["puma"]["apiKey"])
+            poolSize = int(self.getOption(backend, "poolSize", 10))
+            limiter = None
+            if self.getOption(backend, "adaptive", True):
+                limiter = AdaptiveLimiter(backend, initial=int(self.getOption(backend, "initialConcurrency", 2)),
+                                          minimum=int(self.getOption(backend, "minConcurrency", 1)),
+                                          maximum=int(self.getOption(backend, "maxConcurrency", poolSize)),
+                                          tolerance=float(self.getOption(backend, "latencyTolerance", 2.0)),
+                                          metrics=self.metrics)
+            return Transport(backend, poolSize=poolSize, retries=int(self.getOption(backend, "retries", 5)),
+                             backoff=float(self.getOption(backend, "backoff", 0.5)), auth=auth, metrics=self.metrics,
+                             limiter=limiter)
+
+        with self.transportsLock:
+            if self.transports is None:
+                self.transports = TransportRegistry()
+        return self.transports.get(backend, factory)
+
+    def getTransportStats(self):
+        if self.transports is None:
+            return {}
+        return self.transports.stats()
+
     def callDarusAPI(self, url, method="get", data=None, expectedCode=200, nodata=False, contentType="application/json",
                      ApiKey=True, ):
-        dsReq = None
+        import requests
+
         if ApiKey:
             headers = {"content-type": contentType, "X-Dataverse-key": self.credentials["darus"]["apiKey"], }
         else:
             headers = {}
-        if method == "get":
-            dsReq = requests.get(url, headers=headers, timeout=80)
-        elif method == "post":
-            if data is not None:
-                dsReq = requests.post(url, headers=headers, data=json.dumps(data))
-            else:
-                dsReq = requests.post(url, headers=headers)
-        elif method == "put":
-            if data is not None:
-                dsReq = requests.put(url, headers=headers, data=json.dumps(data))
+        if method not in ["get", "post", "put", "delete"]:
+            raise ApiCallFailedException("Method {} not supported".format(method))
+        transport = self.getTransport("darus")
+        try:
+            if method == "get":
+                dsReq = transport.request("get", url, headers=headers, timeout=80)
+            elif method in ["post", "put"] and data is not None:
+                dsReq = transport.request(method, url, headers=headers, data=json.dumps(data))
             else:
-                dsReq = requests.put(url, headers=headers)
-        elif method == "delete":
-            dsReq = requests.delete(url, headers=headers)
-        # get authors
+                dsReq = transport.request(method, url, headers=headers)
+        except requests.RequestException as e:
+            raise ApiCallFailedException("DaRUS-Call of {} raised Exception: {}".format(url, e))
 
         if nodata:
             if dsReq.status_code == expectedCode:
@@ -545,13 +1014,17 @@ class Exporter:
             else:
                 raise ApiCallFailedException("DaRUS-Call of {} failed: {} {}".format(url, dsReq.reason, dsReq.text))
 
-        resDapi = dsReq.json()
+        try:
+            resDapi = dsReq.json()
+        except ValueError:
+            raise ApiCallFailedException("DaRUS-Call of {} failed: {} {}".format(url, dsReq.reason, dsReq.text))
         if dsReq.status_code == expectedCode and resDapi["status"] == "OK":
             return resDapi["data"]
         else:
             raise ApiCallFailedException("DaRUS-Call of {} failed: {} {}".format(url, dsReq.reason, dsReq.text))
 
-    def callPumaAPI(self, url, data, expectedCode=201, method="post", ):
+    def callPumaAPI(self, url, data, expectedCode=201, method="post", stream=False):
+        """Returns the decoded JSON response, or with stream the response itself, unread"""
         headers = {"Content-Type": "application/json"}
 
         user = self.credentials["puma"]["user"]
@@ -562,98 +1035,43 @@ class Exporter:
 
         if method not in ["multipart", "get", "post", "put", "delete"]:
             raise ApiCallFailedException("Method {} not supported".format(method))
+        transport = self.getTransport("puma")
         tr = None
         try:
             if method == "get":
-                tr = requests.get(url, data=json.dumps(data), auth=HTTPBasicAuth(user, pw)
-                                  , headers=headers
-                                  , timeout=40)
-            elif method == "post":
-                tr = requests.post(url, data=json.dumps(data), auth=HTTPBasicAuth(user, pw), headers=headers, )
+                tr = transport.request("get", url, data=json.dumps(data), headers=headers, timeout=40, stream=stream)
             elif method == "multipart":
-                tr = requests.post(url, files=data, auth=HTTPBasicAuth(user, pw))
-            elif method == "put":
-                tr = requests.put(url, data=json.dumps(data), auth=HTTPBasicAuth(user, pw), headers=headers, )
-            elif method == "delete":
-                tr = requests.delete(url, data=json.dumps(data), auth=HTTPBasicAuth(user, pw), headers=headers, )
+                tr = transport.request("post", url, files=data)
+            else:
+                tr = transport.request(method, url, data=json.dumps(data), headers=headers, )
         except Exception as e:
             raise ApiCallFailedException("PUMA-Call raised Exception: {}".format(e))
         if tr.status_code != expectedCode:
             raise ApiCallFailedException(
                 "PUMA-Call failed: {code} {reason} {text}".format(code=tr.status_code, reason=tr.reason, text=tr.text))
+        if stream:
+            return tr
         return tr.json()
 
     def getPUMAExport(self, datasetId):
-        authors = []
-        datasetTitle = ""
-        datasetDescription = ""
-        year = datetime.now().strftime("%Y")
-        doi = ""
-        # url = ""
-        authorOrcids = []
-        authorAffiliation = []
-        key = ""
-        relatedPublications = []
-
-        if isDaRUSdoi(datasetId):
-            try:
-                resFields = self.callDarusAPI(
-                    "{}/api/datasets/:persistentId/?persistentId={}".format(self.credentials["darus"]["apiBaseUrl"], datasetId))
-                url = resFields["persistentUrl"]
-                if resFields["protocol"] == "doi":
-                    doi = "{}/{}".format(resFields["authority"], resFields["identifier"])
-                fields = resFields["latestVersion"]["metadataBlocks"]["citation"]["fields"]
-                for f in fields:
-                    if f["typeName"] == "dsDescription":
-                        for d in f["value"]:
-                            datasetDescription += d["dsDescriptionValue"]["value"] + " "
-                    if f["typeName"] == "author":
-                        for a in f["value"]:
-                            authors.append(a["authorName"]["value"])
-                            key += a["authorName"]["value"].split(", ")[0]
-                            authorAffiliation.append(a["authorAffiliation"]["value"])
-                            if "authorIdentifier" in a and a["authorIdentifierScheme"]["value"] == "ORCID":
-                                authorOrcids.append("{}/{}".format(a["authorName"]["value"], a["authorIdentifier"]["value"], ))
-
-                    if f["typeName"] == "title":
-                        datasetTitle = f["value"]
-
-                    if f["typeName"] == "publication":
-                        for p in f["value"]:
-                            pubstring = p["publicationCitation"]["value"]
-                            if "publicationIDType" in p and "publicationIDNumber" in p:
-                                pubstring += " ({}:{})".format(p["publicationIDType"]["value"], p["publicationIDNumber"]["value"], )
-                            # logging.debug(pubstring)
-                            relatedPublications.append(pubstring)
-
-            except ApiCallFailedException as e:
-                ret = json.loads(str(e)[str(e).index('{"status"'):])
-                return ret
-
-
-            key += year + datasetTitle.split(" ")[0] + self.randomString(8)
-            dataType = "Dataset"
-            relPub = ("Related Publication: {}".format(cleanString(",\n ".join(relatedPublications))) if len(relatedPublications) > 0 else "")
-            template = self.credentials["puma"]["bibTexTemplate"]
-            index = 0
-            for author in authors:
-                if re.search(", \\b[\\D-]+", author) is None and not "{" in author and not "}" in author:
-                    authors[index] = "{" + author + "}"
-                index = index + 1
-            values = {"authors": " and ".join(authors), "user": self.credentials["puma"]["user"], "key": key,
-                      "description": cleanString(datasetDescription), "doi": doi, "title": cleanString(datasetTitle), "url": url, "year": year,
-                      "affiliation": cleanString(" and ".join(authorAffiliation)), "orcid": " and ".join(authorOrcids), "type": dataType,
-                      "relPub": relPub, }
-            fh = open(template)
-            bibtexStr = Template(fh.read()).safe_substitute(values)
-            fh.close()
-            template = self.credentials["puma"]["jsonTemplate"]
-            fh = open(template)
-            jsonStr = Template(fh.read()).safe_substitute(values)
-            fh.close()
-
-            # logging.debug('jsonStr: ' + jsonStr)
-            jsonDict = {"main": ("", jsonStr.encode().decode("utf-8-sig"), "application/json"),
-                        "bibtex": ("", bibtexStr.encode().decode("utf-8-sig"), "text/bibtex"), }
-            return jsonDict
-        return {}
+        """The multipart payload that posts a DaRUS dataset to PUMA, rendered from the record of
+        getDarusSet, so a dataset exported and uploaded in the same run is fetched once. Datasets
+        genBibTex leaves out of the export get {"status": "SKIPPED", ...} instead."""
+        if not isDaRUSdoi(datasetId):
+            return {}
+        record = self.getDarusSet(datasetId)
+        if record.doi is None:
+            return {"status": "ERROR", "message": "dataset {} could not be read or is not released".format(datasetId)}
+        if not self.isUniStuttgartRecord(record):
+            return {"status": "SKIPPED", "message": "no author affiliated with the University of Stuttgart"}
+        return self.genPumaPayload(record)
+
+    def genPumaPayload(self, record):
+        values = self.getBibTexValues(record)
+        bibtexStr = self.renderTemplate(self.credentials["puma"]["bibTexTemplate"], values)
+        # the post itself is JSON: no quotes or line breaks in its values
+        values = dict(values, user=self.credentials["puma"]["user"], url=record.url or record.persistentUrl,
+                      authors=cleanString(values["authors"]), title=cleanString(values["title"]))
+        jsonStr = self.renderTemplate(self.credentials["puma"]["jsonTemplate"], values)
+        return {"main": ("", jsonStr.encode().decode("utf-8-sig"), "application/json"),
+                "bibtex": ("", bibtexStr.encode().decode("utf-8-sig"), "text/bibtex"), }
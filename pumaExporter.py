@@ -1,28 +1,438 @@
+import argparse
+import contextlib
 import logging
 import json
-from pumaExport import Exporter
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-logging.basicConfig(filename="logs/pumaExport.log", level=logging.DEBUG)
+from exportShards import exportShard, getFailedDatasets, getShardPath, mergeShards, parseShard, removeShards
+from exportState import ExportState, writeJsonAtomic
+from exporterExceptions import ApiCallFailedException
+from pumaSnapshot import normalizeDOI
+from stateStore import CLASSIFICATIONS, REPORTS, StateStore
 
-with open("cred/credentials.json", "r") as cred_file:
-    credentials = json.load(cred_file)
+# pumaExport, pumaUploader and with them requests are imported by the commands that need them, so
+# "render" and "mail" start without loading the HTTP stack or the caches of a full export
 
-# exporter = Exporter()
-exporter = Exporter(credentials)
+COMMANDS = ["export", "diff", "shard", "merge", "report", "render", "mail"]
 
-def pumaExport(dv="darus"):
-    datasets = exporter.getDatasetsByDataverse(dv)
-    p_datasets = exporter.getAllDatasetsFromUniBiblio()
+
+def loadCredentials(path="cred/credentials.json"):
+    with open(path, "r") as cred_file:
+        return json.load(cred_file)
+
+
+def createExporter(credentials=None, caches=True):
+    """Exporter for the credentials (default cred/credentials.json). Without caches the record cache and
+    the fingerprint store are not loaded, which only pays off for exports of whole dataverses."""
+    from pumaExport import Exporter
+
+    if credentials is None:
+        credentials = loadCredentials()
+    if not caches:
+        credentials = dict(credentials, export=dict(credentials.get("export", {}), cacheFile=None, fingerprintFile=None))
+    return Exporter(credentials)
+
+
+def exportDataverse(exporter, state, dv, p_datasets, full=False, uploader=None):
+    since = None if full else state.getLastRun(dv)
+    if since is None:
+        print("full export of dataverse {}".format(dv))
+    else:
+        print("incremental export of dataverse {} since {}".format(dv, since))
+    listed = [0]
+    retained = []
+
+    def countListed(datasets):
+        for ds in datasets:
+            listed[0] += 1
+            if uploader is not None and normalizeDOI(ds) not in p_datasets:
+                # the upload renders the record again after the export has released it
+                exporter.retainDarusSet(ds)
+                retained.append(ds)
+            yield ds
+
+    checkpoint = exporter.getCheckpoint(dv, since)
+    # a full listing contains the datasets that could not be fetched last time anyway
+    retries = state.getRetries(dv) if since is not None else []
+    listing = exporter.iterWithRetries(exporter.iterDatasetsByDataverse(dv, since, checkpoint.getListingStart()),
+                                       retries)
+    result = {"dataverse": dv, "incremental": since is not None}
+    # the listing streams into the export, so both stages are timed together
+    try:
+        with exporter.metrics.stage("export"):
+            files = exporter.writeExportFiles(countListed(listing), p_datasets, dv, checkpoint)
+    except ApiCallFailedException as e:
+        # the checkpoint and the .part files are kept and the watermark stays, so the next run lists the
+        # same window again and continues after the datasets written so far
+        print("listing of dataverse {} failed after {} datasets, continued by the next run: {}".format(
+            dv, listed[0], e))
+        for ds in retained:
+            exporter.releaseDarusSet(ds)
+        return dict(result, datasets=listed[0], files=[], failed=str(e))
+    print(files)
+    if checkpoint.failed:
+        print("{} datasets of dataverse {} could not be read, they are retried by the next run".format(
+            len(checkpoint.failed), dv))
+    result.update(datasets=listed[0], files=files, retry=list(checkpoint.failed))
+    if uploader is not None:
+        # all datasets of the export, also those an interrupted run wrote before this one resumed its
+        # listing after them; the ledger skips the ones already uploaded, the next run those not read
+        failed = set(checkpoint.failed)
+        newDatasets = [ds for ds in checkpoint.processed if normalizeDOI(ds) not in p_datasets and ds not in failed]
+        with exporter.metrics.stage("upload"):
+            report = uploader.upload(newDatasets, p_datasets)
+        for ds in retained:
+            exporter.releaseDarusSet(ds)
+        result["upload"] = writeUploadReport(uploader, report, dv)
+    return result
+
+
+def writeUploadReport(uploader, report, name):
+    reportFile = "output/{}_{}_upload.json".format(datetime.now().strftime("%Y-%m-%d"), name)
+    writeJsonAtomic(reportFile, report)
+    summary = dict(uploader.summarize(report), report=reportFile)
+    print("upload to PUMA: {uploaded} uploaded, {skipped} skipped, {failed} failed, see {report}".format(**summary))
+    return summary
+
+
+def pumaExportMany(dvs=None, full=False, exporter=None, upload=False):
+    """Exports several dataverses in one run: the PUMA posts are loaded once, the dataverses are
+    processed in parallel (export dataverseWorkers) and every dataset is fetched at most once, even if
+    it lies in the subtrees of more than one of them. dvs=None exports all top-level dataverses.
+    With upload the new datasets are also posted to PUMA (see PumaUploader). A dataverse whose listing
+    fails is not mailed and keeps its watermark and checkpoint; datasets that could not be fetched are
+    kept in the export state and retried by the next run (ExportState.getRetries)."""
+    if exporter is None:
+        exporter = createExporter()
+    credentials = exporter.credentials
+    state = ExportState(exporter.getOption("export", "stateFile", "output/state.json"))
+    runStart = datetime.now()
+    if exporter.stateStore is not None:
+        exporter.stateStore.startRun(dvs, full, runStart)
+    with exporter.metrics.stage("dataverseTree"):
+        exporter.getDataverseTree(full)
+    if dvs is None:
+        dvs = exporter.getTopLevelDataverses()
+        if not dvs:
+            exit("No dataverses to export. puma-export service will fail!")
+    exporter.setRunDataverses(dvs)
+    with exporter.metrics.stage("pumaDownload"):
+        p_datasets = exporter.getAllDatasetsFromUniBiblio(full)
     if not bool(p_datasets):
         exit("Dataset from PUMA is empty. puma-export service will fail!")
-    files = exporter.writeExportFiles(datasets, p_datasets, dv)
-    print(files)
+    uploader = None
+    retried = None
+    if upload:
+        from pumaUploader import PumaUploader
+
+        uploader = PumaUploader(exporter)
+        if len(uploader.ledger.getFailed()) > 0:
+            with exporter.metrics.stage("upload"):
+                retried = writeUploadReport(uploader, uploader.retryFailed(p_datasets), "retry")
+    workers = max(min(int(exporter.getOption("export", "dataverseWorkers", 4)), len(dvs)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda dv: exportDataverse(exporter, state, dv, p_datasets, full, uploader), dvs))
+    files = [file for result in results for file in result["files"]]
+    failed = [result["dataverse"] for result in results if "failed" in result]
+    printRunStats(exporter)
     if credentials["puma"]["mailer"] == "True":
-        exporter.sendMailToUniBiblio(files, credentials["puma"]["mailHost"])
-        return {"message": "PUMA Export was sent"}, 200
+        with exporter.metrics.stage("mail"):
+            exporter.sendMailToUniBiblio(files, credentials["puma"]["mailHost"])
+        msg = {"message": "PUMA Export was sent"}, 200
     else:
-        return {"message": "PUMA export result files were written, but not send due to configuration. To send the export result files set the puma-mailer configuration option to True in cred/credentials.json"}
-    
+        msg = {"message": "PUMA export result files were written, but not send due to configuration. To send the export result files set the puma-mailer configuration option to True in cred/credentials.json"}
+    for result in results:
+        if result["dataverse"] not in failed:
+            state.setLastRun(result["dataverse"], runStart)
+            state.setRetries(result["dataverse"], result["retry"])
+    state.save()
+    if failed:
+        print("export of dataverses {} is incomplete, their watermarks were not advanced".format(", ".join(failed)))
+    if exporter.stateStore is not None:
+        exporter.stateStore.finishRun()
+    exporter.metrics.write(exporter.getOption("export", "metricsFile", "output/metrics/pumaexport.prom"),
+                           exporter.getOption("export", "summaryFile", "output/metrics/summary.json"),
+                           {"dataverses": results, "uploadRetries": retried, "transport": exporter.getTransportStats(),
+                            "cache": exporter.recordCache.stats() if exporter.recordCache is not None else None,
+                            "fingerprints": exporter.fingerprints.stats() if exporter.fingerprints is not None else None})
+    return msg
+
+
+def printRunStats(exporter):
+    """Prints the connection, cache and fingerprint statistics of a run and saves cache, fingerprints and
+    the state database"""
+    for backend, stats in exporter.getTransportStats().items():
+        print("{}: {} requests over {} connections ({} reused)".format(backend, stats["requests"], stats["connections"],
+                                                                      stats["reused"]))
+    if exporter.recordCache is not None:
+        exporter.recordCache.save()
+        print("dataset cache: {hits} hits, {misses} misses, {evictions} evictions, {size} entries".format(
+            **exporter.recordCache.stats()))
+    if exporter.fingerprints is not None:
+        exporter.fingerprints.save()
+        print("fingerprints: {unchanged} datasets unchanged, {compared} compared field by field".format(
+            **exporter.fingerprints.stats()))
+    if exporter.stateStore is not None:
+        exporter.stateStore.commit()
+
+
+def diffDataverses(exporter, dvs=None, full=False):
+    """Prints the changes of the datasets of dvs that PUMA already holds, without writing export files,
+    checkpoints or the export state and without sending mail. Returns the number of changed datasets."""
+    from exportPipeline import orderedMap
+
+    state = ExportState(exporter.getOption("export", "stateFile", "output/state.json"))
+    exporter.getDataverseTree(full)
+    if dvs is None:
+        dvs = exporter.getTopLevelDataverses()
+    exporter.setRunDataverses(dvs)
+    p_datasets = exporter.getAllDatasetsFromUniBiblio(full)
+    workers = max(int(exporter.getOption("export", "workers", 1)), 1)
+    changed = 0
+    for dv in dvs:
+        since = None if full else state.getLastRun(dv)
+        new = [0]
+
+        def known(datasets):
+            for ds in datasets:
+                if normalizeDOI(ds) in p_datasets:
+                    yield ds
+                else:
+                    new[0] += 1
+                    exporter.releaseDarusSet(ds)
+
+        entries = orderedMap(lambda ds: (ds,) + exporter.getTimedExportEntry(ds, p_datasets),
+                             known(exporter.iterDatasetsByDataverse(dv, since)), workers)
+        for ds, status, text in entries:
+            if status == "changed":
+                changed += 1
+                print(text, end="")
+            exporter.releaseDarusSet(ds)
+        print("dataverse {}: {} datasets not in PUMA yet".format(dv, new[0]))
+    printRunStats(exporter)
+    return changed
+
+
+def exportShards(credentials, dvs=None, shard=0, shards=1, full=False, refresh=True):
+    """Runs one shard of an export (see exportShards.exportShard) for every dataverse of dvs (None: all
+    top-level dataverses). The export state is only read; mergeDataverses advances it. Without refresh the
+    dataverse tree and the PUMA snapshot are only read, see refreshSharedFiles."""
+    credentials = dict(credentials)
+    export = dict(credentials.get("export", {}))
+    for key, default in [("cacheFile", "output/darusCache.json"), ("fingerprintFile", "output/fingerprints.json")]:
+        export[key] = getShardPath(export.get(key, default), shard, shards)
+    credentials["export"] = export
+    exporter = createExporter(credentials)
+    state = ExportState(exporter.getOption("export", "stateFile", "output/state.json"))
+    directory = exporter.getOption("export", "shardDir", "output/shards")
+    if not refresh:
+        exporter.dataverseTreeRefreshed = True
+    exporter.getDataverseTree(full)
+    if dvs is None:
+        dvs = exporter.getTopLevelDataverses()
+    exporter.setRunDataverses(dvs)
+    p_datasets = exporter.getAllDatasetsFromUniBiblio(full, refresh)
+    files = [exportShard(exporter, dv, p_datasets, shard, shards, None if full else state.getLastRun(dv), directory,
+                         [] if full else state.getRetries(dv))
+             for dv in dvs]
+    printRunStats(exporter)
+    return files
+
+
+def refreshSharedFiles(credentials, full=False):
+    """Refreshes the dataverse tree and the PUMA snapshot once before the shard processes start, so they
+    only read darus treeFile and puma snapshotFile instead of all writing them. Returns False if one of
+    them is not kept in a file: then every shard has to refresh its own."""
+    exporter = createExporter(credentials, caches=False)
+    if exporter.getOption("darus", "treeFile", "output/dataverseTree.json") is None or \
+            exporter.getOption("puma", "snapshotFile", "output/pumaSnapshot.json") is None:
+        return False
+    exporter.getDataverseTree(full)
+    exporter.refreshPumaSnapshot(full)
+    return True
+
+
+def exportShardProcesses(argv, shards):
+    """Runs the shards 1/shards .. shards/shards as worker processes with the arguments argv and waits
+    for all of them. Returns True if all succeeded."""
+    processes = [subprocess.Popen([sys.executable, __file__, "shard", "--shard", "{}/{}".format(shard, shards)] + argv)
+                 for shard in range(1, shards + 1)]
+    failed = [shard + 1 for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print("shards {} of {} failed".format(", ".join(str(shard) for shard in failed), shards), file=sys.stderr)
+    return not failed
+
+
+def mergeDataverses(exporter, dvs=None, shards=1, keep=False):
+    """Merges the shard files of dvs (None: all top-level dataverses) into the export files, advances the
+    export state to the start of the shards and mails the files like pumaExportMany"""
+    credentials = exporter.credentials
+    state = ExportState(exporter.getOption("export", "stateFile", "output/state.json"))
+    directory = exporter.getOption("export", "shardDir", "output/shards")
+    if dvs is None:
+        exporter.getDataverseTree()
+        dvs = exporter.getTopLevelDataverses()
+    merged = [(dv,) + tuple(mergeShards(dv, shards, directory)) for dv in dvs]
+    files = [file for _, dvFiles, _ in merged for file in dvFiles]
+    print(files)
+    if credentials["puma"].get("mailer") == "True":
+        exporter.sendMailToUniBiblio(files, credentials["puma"]["mailHost"])
+    for dv, _, startedAt in merged:
+        state.setLastRun(dv, startedAt)
+        state.setRetries(dv, getFailedDatasets(dv, shards, directory))
+        if not keep:
+            removeShards(dv, shards, directory)
+    state.save()
+    return files
+
+
+def renderDataset(exporter, doi, outputFormat="bibtex"):
+    """Returns a DaRUS dataset rendered as BibTeX entry, as PUMA post (the JSON part of the upload) or
+    as its changes against PUMA, None if the dataset cannot be read"""
+    record = exporter.getDarusSet(doi)
+    if record is None or record.doi is None:
+        return None
+    if outputFormat == "post":
+        return exporter.genPumaPayload(record)["main"][1]
+    if outputFormat == "diff":
+        puma_ds = exporter.getDatasetFromUniBiblio(doi)
+        if puma_ds is None:
+            return "Datensatz {} ist nicht in der Unibibliographie\n".format(doi)
+        changes = exporter.getChanges(record, puma_ds)
+        return "\n".join(changes) + "\n" if changes else "Keine Änderungen in Datensatz {}\n".format(doi)
+    return exporter.renderTemplate(exporter.credentials["puma"]["bibTexTemplate"], exporter.getBibTexValues(record))
+
+
+def pumaExport(dv="darus", full=False, exporter=None, upload=False):
+    return pumaExportMany([dv], full, exporter, upload)
+
+
+def startProfiler(exporter):
+    """Starts a RunProfiler writing to export profileDir (default output/profile) with a sampling
+    interval of export profileInterval seconds (default 0.005), with per-dataset timings"""
+    from runProfiler import DatasetTimings, RunProfiler
+
+    exporter.datasetTimings = DatasetTimings()
+    return RunProfiler(exporter.getOption("export", "profileDir", "output/profile"),
+                       float(exporter.getOption("export", "profileInterval", 0.005))).start()
+
+
+def getArgumentParser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--credentials", default="cred/credentials.json", help="credentials and options (JSON)")
+    parser = argparse.ArgumentParser(prog="pumaExporter.py",
+                                     description="Export of new and changed DaRUS datasets to the PUMA Unibibliography. "
+                                                 "Without a command the arguments are those of export.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    for name, helpText in [("export", "export dataverses, write the export files and mail them"),
+                           ("diff", "only print the changes of the datasets PUMA already holds")]:
+        command = commands.add_parser(name, parents=[common], help=helpText)
+        command.add_argument("aliases", nargs="*", default=["darus"], help="dataverse aliases (default darus)")
+        command.add_argument("--all", action="store_true", help="all top-level dataverses")
+        command.add_argument("--full", action="store_true",
+                             help="ignore the stored watermarks, reload the dataverse tree and the PUMA snapshot")
+        if name == "export":
+            command.add_argument("--upload", action="store_true", help="also post the new datasets to PUMA")
+        command.add_argument("--profile", action="store_true",
+                             help="profile the run, see export profileDir (default output/profile)")
+    command = commands.add_parser("shard", parents=[common], help="run one shard of an export on this machine")
+    command.add_argument("aliases", nargs="*", default=["darus"], help="dataverse aliases (default darus)")
+    command.add_argument("--all", action="store_true", help="all top-level dataverses")
+    command.add_argument("--full", action="store_true", help="ignore the stored watermarks")
+    command.add_argument("--no-refresh", action="store_true",
+                         help="only read the dataverse tree and the PUMA snapshot (set by --processes)")
+    group = command.add_mutually_exclusive_group(required=True)
+    group.add_argument("--shard", help="the shard I/N to run, e.g. 2/4")
+    group.add_argument("--processes", type=int, help="run all shards as this many processes, then merge")
+    command = commands.add_parser("merge", parents=[common], help="merge the shard files into the export files")
+    command.add_argument("aliases", nargs="*", default=["darus"], help="dataverse aliases (default darus)")
+    command.add_argument("--all", action="store_true", help="all top-level dataverses")
+    command.add_argument("--shards", type=int, required=True, help="number of shards")
+    command.add_argument("--keep", action="store_true", help="keep the shard files")
+    command = commands.add_parser("report", parents=[common], help="query the state database of the export runs")
+    command.add_argument("name", choices=CLASSIFICATIONS + sorted(REPORTS),
+                         help="datasets classified new, changed or unchanged against PUMA or not fetched by the "
+                              "last export, all datasets, PUMA duplicates, versions or runs")
+    command.add_argument("--dataverse", help="only datasets exported with this dataverse")
+    command = commands.add_parser("render", parents=[common], help="render one dataset")
+    command.add_argument("doi", help="DOI of the dataset, e.g. doi:10.18419/darus-452")
+    command.add_argument("--format", dest="outputFormat", choices=["bibtex", "post", "diff"], default="bibtex",
+                         help="BibTeX entry, PUMA post or changes against PUMA (default bibtex)")
+    command = commands.add_parser("mail", parents=[common], help="mail export files to the Unibibliography")
+    command.add_argument("files", nargs="+", help="files to attach")
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # the earlier calling convention "pumaExporter.py [--full] [--all] [--upload] [aliases]" still exports
+    if not any(arg in COMMANDS for arg in argv) and "-h" not in argv and "--help" not in argv:
+        argv = ["export"] + argv
+    args = getArgumentParser().parse_args(argv)
+    credentials = loadCredentials(args.credentials)
+    if args.command in ["export", "diff"]:
+        logging.basicConfig(filename="logs/pumaExport.log", level=logging.DEBUG)
+        exporter = createExporter(credentials)
+        dvs = None if args.all else args.aliases
+        profiler = startProfiler(exporter) if args.profile else None
+        try:
+            if args.command == "diff":
+                diffDataverses(exporter, dvs, args.full)
+            else:
+                print(pumaExportMany(dvs, full=args.full, exporter=exporter, upload=args.upload))
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                files = profiler.write(exporter.metrics, exporter.datasetTimings)
+                print(exporter.datasetTimings.format(10))
+                print("profile written to {}".format(", ".join(files)))
+        return 0
+    if args.command == "shard":
+        logging.basicConfig(filename="logs/pumaExport.log", level=logging.DEBUG)
+        dvs = None if args.all else args.aliases
+        if args.shard is not None:
+            shard, shards = parseShard(args.shard)
+            exportShards(credentials, dvs, shard, shards, args.full, not args.no_refresh)
+            return 0
+        argv = ["--credentials", args.credentials] + (["--full"] if args.full else []) + \
+               (["--no-refresh"] if refreshSharedFiles(credentials, args.full) else []) + \
+               (["--all"] if args.all else args.aliases)
+        if not exportShardProcesses(argv, args.processes):
+            return 1
+        mergeDataverses(createExporter(credentials, caches=False), dvs, args.processes)
+        return 0
+    if args.command == "report":
+        path = credentials.get("export", {}).get("stateDatabase", "output/pumaexport.sqlite")
+        if not path or not os.path.exists(path):
+            print("no state database at {}, it is written by export".format(path), file=sys.stderr)
+            return 1
+        columns, rows = StateStore(path).report(args.name, args.dataverse)
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("" if value is None else str(value) for value in row))
+        return 0
+    exporter = createExporter(credentials, caches=False)
+    if args.command == "merge":
+        mergeDataverses(exporter, None if args.all else args.aliases, args.shards, args.keep)
+        return 0
+    if args.command == "render":
+        # progress messages go to stderr, stdout only gets the rendered dataset
+        with contextlib.redirect_stdout(sys.stderr):
+            text = renderDataset(exporter, args.doi, args.outputFormat)
+        if text is None:
+            print("dataset {} could not be read or is not released".format(args.doi), file=sys.stderr)
+            return 1
+        print(text, end="" if text.endswith("\n") else "\n")
+        return 0
+    exporter.sendMailToUniBiblio(args.files, credentials["puma"]["mailHost"])
+    print("sent {} to {}".format(", ".join(args.files), credentials["unibiblio"]["email"]))
+    return 0
+
 
-msg = pumaExport("darus")
-print(msg)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
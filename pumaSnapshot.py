@@ -0,0 +1,182 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+from bibtexMisc import parseMisc
+from exportState import writeJsonAtomic
+
+TIMEFORMAT = "%Y-%m-%dT%H:%M:%S"
+# the parts of a PUMA post the export reads, everything else is dropped when a post is loaded
+POST_BIBTEX_FIELDS = ["intrahash", "interhash", "title", "author", "howpublished", "year", "note", "misc", "bibtexKey",
+                      "entrytype"]
+POST_FIELDS = ["changedate", "postingdate"]
+
+
+def getMiscDOI(misc):
+    # the same parser PumaRecord reads the compared fields with, so index and comparison agree on the DOI
+    return parseMisc(misc).get("doi", "")
+
+
+def normalizeDOI(doi):
+    doi = doi.strip().lower()
+    for prefix in ["https://doi.org/", "http://doi.org/", "https://dx.doi.org/", "http://dx.doi.org/", "doi:"]:
+        if doi.startswith(prefix):
+            return doi[len(prefix):]
+    return doi
+
+
+def compactPost(post):
+    """Copies the fields of a PUMA post used by the export (POST_BIBTEX_FIELDS, the user name, the tag
+    names and the dates); the full posts of a page carry a multiple of that in documents, links and
+    group data. Compacting a compact post returns an equal post."""
+    bibtex = post.get("bibtex", {})
+    compact = {"bibtex": {field: bibtex[field] for field in POST_BIBTEX_FIELDS if field in bibtex}}
+    for field in POST_FIELDS:
+        if field in post:
+            compact[field] = post[field]
+    if "user" in post:
+        compact["user"] = {"name": post["user"].get("name")}
+    if "tag" in post:
+        compact["tag"] = [{"name": tag.get("name")} for tag in post["tag"]]
+    return compact
+
+
+def getPostDOI(post):
+    if "bibtex" not in post or "misc" not in post["bibtex"]:
+        return ""
+    return normalizeDOI(getMiscDOI(post["bibtex"]["misc"]))
+
+
+def getPostDate(post):
+    return post.get("changedate") or post.get("postingdate")
+
+
+def getNewestPost(posts):
+    return max(posts, key=lambda post: getPostDate(post) or "")
+
+
+class DoiIndex:
+    """Maps normalized DOIs to PUMA posts.
+
+    Built once in a single pass over the posts, so checking N DOIs against M posts costs O(N+M)
+    instead of one misc regex per post and DOI.
+    """
+
+    def __init__(self, posts=()):
+        self.entries = {}
+        self.invalid = []
+        for post in posts:
+            self.add(post)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, doi):
+        return normalizeDOI(doi) in self.entries
+
+    def add(self, post):
+        doi = getPostDOI(post)
+        if doi == "":
+            self.invalid.append(post)
+            return
+        posts = self.entries.setdefault(doi, [])
+        intrahash = post["bibtex"].get("intrahash")
+        for index, known in enumerate(posts):
+            if intrahash is not None and known["bibtex"].get("intrahash") == intrahash:
+                posts[index] = post
+                return
+        posts.append(post)
+
+    def get(self, doi):
+        return self.entries.get(normalizeDOI(doi), [])
+
+    def lookupMany(self, dois):
+        return {doi: self.get(doi) for doi in dois}
+
+    def duplicates(self):
+        return {doi: posts for doi, posts in self.entries.items() if len(posts) > 1}
+
+    def items(self):
+        return self.entries.items()
+
+
+class PumaSnapshot:
+    """Local copy of the DaRUS posts of the Uni-Bibliography, indexed by intrahash and normalized DOI.
+
+    highWaterMark is the newest changedate/postingdate seen by the last successful refresh. PUMA lists
+    the newest posts first, so an incremental refresh can stop at the first page that reaches it.
+    Posts deleted or re-hashed in PUMA are only dropped by a full refresh.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.posts = {}
+        self.dois = DoiIndex()
+        self.highWaterMark = None
+        self.refreshedAt = None
+        self.fullRefreshAt = None
+        # posts, next page start and high-water mark of a full refresh that broke off
+        self.partial = None
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as snapshot_file:
+                data = json.load(snapshot_file)
+            self.highWaterMark = data["highWaterMark"]
+            self.refreshedAt = data["refreshedAt"]
+            self.fullRefreshAt = data["fullRefreshAt"]
+            self.partial = data.get("partial")
+            for post in data["posts"]:
+                self.add(post)
+
+    def __len__(self):
+        return len(self.posts)
+
+    def add(self, post):
+        post = compactPost(post)
+        self.posts[post["bibtex"]["intrahash"]] = post
+        self.dois.add(post)
+
+    def getByIntrahash(self, intrahash):
+        return self.posts.get(intrahash)
+
+    def getAllByDOI(self, doi):
+        return self.dois.get(doi)
+
+    def getByDOI(self, doi):
+        posts = self.getAllByDOI(doi)
+        if len(posts) == 0:
+            return None
+        # the newest post wins if PUMA holds the DOI more than once
+        return getNewestPost(posts)
+
+    def iterByDOI(self):
+        for doi, posts in self.dois.items():
+            yield doi, getNewestPost(posts)
+
+    def needsFullRefresh(self, maxAgeDays):
+        if self.fullRefreshAt is None or self.highWaterMark is None:
+            return True
+        return datetime.strptime(self.fullRefreshAt, TIMEFORMAT) < datetime.now() - timedelta(days=maxAgeDays)
+
+    def replace(self, other):
+        self.posts = other.posts
+        self.dois = other.dois
+
+    def markRefreshed(self, highWaterMark, full):
+        now = datetime.now().strftime(TIMEFORMAT)
+        if full or self.highWaterMark is None or (highWaterMark is not None and highWaterMark > self.highWaterMark):
+            self.highWaterMark = highWaterMark
+        self.refreshedAt = now
+        if full:
+            self.fullRefreshAt = now
+            self.partial = None
+
+    def savePartial(self, posts, start, highWaterMark):
+        self.partial = {"start": start, "highWaterMark": highWaterMark, "posts": posts}
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        writeJsonAtomic(self.path, {"highWaterMark": self.highWaterMark, "refreshedAt": self.refreshedAt,
+                                    "fullRefreshAt": self.fullRefreshAt, "posts": list(self.posts.values()),
+                                    "partial": self.partial})
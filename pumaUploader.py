@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+from exportPipeline import orderedMap
+from exportState import TIMEFORMAT, writeJsonAtomic
+from exporterExceptions import ApiCallFailedException
+from httpTransport import RateLimiter
+from pumaSnapshot import normalizeDOI
+
+
+class UploadLedger:
+    """DOIs posted to PUMA by this exporter, and those whose upload failed, persisted as JSON
+    (default output/pumaUploads.json).
+
+    The uploads cover the gap until the posts show up in the PUMA snapshot, so a repeated run does not
+    post them again. Failed uploads are retried by the next upload run, even if an incremental listing
+    does not return the dataset any more.
+    """
+
+    def __init__(self, path="output/pumaUploads.json"):
+        self.path = path
+        self.uploads = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as ledger_file:
+                data = json.load(ledger_file)
+            self.uploads = data["uploads"]
+            self.failed = data["failed"]
+
+    def __contains__(self, doi):
+        with self.lock:
+            return normalizeDOI(doi) in self.uploads
+
+    def getFailed(self):
+        with self.lock:
+            return [entry["doi"] for entry in self.failed.values()]
+
+    def markUploaded(self, doi, resourceHash):
+        with self.lock:
+            self.failed.pop(normalizeDOI(doi), None)
+            self.uploads[normalizeDOI(doi)] = {"doi": doi, "resourcehash": resourceHash,
+                                               "uploadedAt": datetime.now().strftime(TIMEFORMAT)}
+            # saved after every post: a crash must not lose an upload that PUMA already accepted
+            self.save()
+
+    def markFailed(self, doi, reason):
+        with self.lock:
+            self.failed[normalizeDOI(doi)] = {"doi": doi, "reason": reason,
+                                              "failedAt": datetime.now().strftime(TIMEFORMAT)}
+            self.save()
+
+    def markDone(self, doi):
+        with self.lock:
+            if self.failed.pop(normalizeDOI(doi), None) is not None:
+                self.save()
+
+    def save(self):
+        if self.path:
+            writeJsonAtomic(self.path, {"uploads": self.uploads, "failed": self.failed})
+
+
+class PumaUploader:
+    """Posts the getPUMAExport payloads of new DaRUS datasets to PUMA.
+
+    Uploads run on puma uploadWorkers threads (default 4) and are capped at puma uploadRate posts per
+    second (default 2). A DOI is skipped if PUMA already holds it (pumaDatasets, keyed by normalized DOI)
+    or the ledger records an earlier upload, so a retried run never creates duplicates, and if the export
+    leaves it out (no author affiliated with the University of Stuttgart).
+    """
+
+    def __init__(self, exporter, ledger=None):
+        self.exporter = exporter
+        self.ledger = ledger if ledger is not None else UploadLedger(
+            exporter.getOption("puma", "uploadLedger", "output/pumaUploads.json"))
+        self.limiter = RateLimiter(float(exporter.getOption("puma", "uploadRate", 2)))
+        self.workers = int(exporter.getOption("puma", "uploadWorkers", 4))
+        # DOIs taken by this run, so overlapping dataverses exported in parallel do not post one twice
+        self.claimed = set()
+        self.claimedLock = threading.Lock()
+
+    def claim(self, doi):
+        with self.claimedLock:
+            if normalizeDOI(doi) in self.claimed:
+                return False
+            self.claimed.add(normalizeDOI(doi))
+            return True
+
+    def getUploadUrl(self):
+        credentials = self.exporter.credentials["puma"]
+        return "{}users/{}/posts".format(credentials["baseUrl"], credentials["user"])
+
+    def uploadDataset(self, doi, pumaDatasets):
+        if normalizeDOI(doi) in pumaDatasets:
+            self.ledger.markDone(doi)
+            return {"doi": doi, "status": "skipped", "reason": "already in PUMA"}
+        if doi in self.ledger:
+            return {"doi": doi, "status": "skipped", "reason": "uploaded by an earlier run"}
+        if not self.claim(doi):
+            return {"doi": doi, "status": "skipped", "reason": "uploaded in this run"}
+        payload = self.exporter.getPUMAExport(doi)
+        if payload.get("status") == "SKIPPED":
+            self.ledger.markDone(doi)
+            return {"doi": doi, "status": "skipped", "reason": payload["message"]}
+        if "main" not in payload or "bibtex" not in payload:
+            return self.fail(doi, "no PUMA export for dataset: {}".format(payload))
+        self.limiter.acquire()
+        try:
+            result = self.exporter.callPumaAPI(self.getUploadUrl(), payload, expectedCode=201, method="multipart")
+        except ApiCallFailedException as e:
+            return self.fail(doi, str(e))
+        resourceHash = result.get("resourcehash")
+        self.ledger.markUploaded(doi, resourceHash)
+        return {"doi": doi, "status": "uploaded", "resourcehash": resourceHash}
+
+    def fail(self, doi, reason):
+        self.ledger.markFailed(doi, reason)
+        return {"doi": doi, "status": "failed", "reason": reason}
+
+    def upload(self, dois, pumaDatasets):
+        """Uploads the datasets and returns one report entry per distinct DOI, in input order"""
+        seen = set()
+        distinct = []
+        for doi in dois:
+            if normalizeDOI(doi) not in seen:
+                seen.add(normalizeDOI(doi))
+                distinct.append(doi)
+        report = []
+        for entry in orderedMap(lambda doi: self.uploadDataset(doi, pumaDatasets), distinct, self.workers):
+            print("upload of dataset {}: {} {}".format(entry["doi"], entry["status"], entry.get("reason", "")).strip())
+            report.append(entry)
+        return report
+
+    def retryFailed(self, pumaDatasets):
+        """Uploads the datasets whose upload failed in an earlier run"""
+        return self.upload(self.ledger.getFailed(), pumaDatasets)
+
+    @staticmethod
+    def summarize(report):
+        summary = {"uploaded": 0, "skipped": 0, "failed": 0}
+        for entry in report:
+            summary[entry["status"]] += 1
+        return summary
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from exportState import writeJsonAtomic
+
+
+class RecordCache:
+    """Size-bounded LRU cache of parsed DaRUS dataset records, persisted as JSON.
+
+    An entry is only served while its version key (major.minor plus the last update time reported by
+    the search API) matches, so a new dataset version always triggers a fresh download.
+
+    The entries are the dicts of DarusRecord.toDict and are handed out as they are: callers only read
+    them into a DarusRecord, which copies the lists into tuples and is never modified.
+    """
+
+    def __init__(self, path, maxEntries=20000):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf_8") as cache_file:
+                for doi, version, record in json.load(cache_file)["entries"]:
+                    self.entries[doi] = (version, record)
+            self.evict()
+
+    def get(self, doi, version):
+        with self.lock:
+            entry = self.entries.get(doi)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(doi)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, doi, version, record):
+        with self.lock:
+            self.entries[doi] = (version, record)
+            self.entries.move_to_end(doi)
+            self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.entries)}
+
+    def save(self):
+        with self.lock:
+            entries = [[doi, version, record] for doi, (version, record) in self.entries.items()]
+        writeJsonAtomic(self.path, {"entries": entries})
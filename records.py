@@ -0,0 +1,86 @@
+from bibtexMisc import parseMisc
+
+# raised whenever DarusRecord gains or changes a field, so cached records of an older layout are parsed again
+RECORD_VERSION = 2
+
+
+class DarusRecord:
+    """The fields of a DaRUS dataset the export uses, parsed by parseDarusSet. The BibTeX entry, the
+    comparison with PUMA and the upload payload are all rendered from it.
+
+    Records are shared between threads and runs (getDarusSet, RecordCache), so they are never modified:
+    the list fields are tuples. doi is None if the dataset could not be read or is not released.
+    """
+
+    __slots__ = ("doi", "version", "url", "persistentUrl", "year", "datasetTitle", "datasetSubTitle",
+                 "datasetDescription", "authors", "affiliation", "authorAffiliation", "authorOrcids", "key",
+                 "howpublished", "relatedPub")
+
+    LIST_FIELDS = {"authors", "affiliation", "authorAffiliation", "authorOrcids"}
+
+    def __init__(self, doi=None, version="", url="", persistentUrl="", year="", datasetTitle="", datasetSubTitle="",
+                 datasetDescription="", authors=(), affiliation=(), authorAffiliation=(), authorOrcids=(), key="",
+                 howpublished="Dataset", relatedPub=""):
+        self.doi = doi
+        self.version = version
+        self.url = url
+        self.persistentUrl = persistentUrl
+        self.year = year
+        self.datasetTitle = datasetTitle
+        self.datasetSubTitle = datasetSubTitle
+        self.datasetDescription = datasetDescription
+        self.authors = tuple(authors)
+        self.affiliation = tuple(affiliation)
+        self.authorAffiliation = tuple(authorAffiliation)
+        self.authorOrcids = tuple(authorOrcids)
+        self.key = key
+        self.howpublished = howpublished
+        self.relatedPub = relatedPub
+
+    def __eq__(self, other):
+        return isinstance(other, DarusRecord) and self.toDict() == other.toDict()
+
+    def __repr__(self):
+        return "DarusRecord({})".format(self.doi)
+
+    def toDict(self):
+        return {name: list(getattr(self, name)) if name in self.LIST_FIELDS else getattr(self, name)
+                for name in self.__slots__}
+
+    @classmethod
+    def fromDict(cls, fields):
+        return cls(**{name: value for name, value in fields.items() if name in cls.__slots__})
+
+
+class PumaRecord:
+    """The fields of a PUMA post getChanges and genPumaURL use. The misc fields affiliation,
+    orcid-numbers and doi are parsed once, the rest of the post is not kept."""
+
+    __slots__ = ("intrahash", "user", "title", "author", "howpublished", "year", "note", "affiliation",
+                 "orcidNumbers", "doi", "tags")
+
+    def __init__(self, intrahash, user, title="", author="", howpublished="", year="", note="", affiliation="",
+                 orcidNumbers="", doi="", tags=()):
+        self.intrahash = intrahash
+        self.user = user
+        self.title = title
+        self.author = author
+        self.howpublished = howpublished
+        self.year = year
+        self.note = note
+        self.affiliation = affiliation
+        self.orcidNumbers = orcidNumbers
+        self.doi = doi
+        self.tags = tuple(tags)
+
+    def __repr__(self):
+        return "PumaRecord({})".format(self.intrahash)
+
+    @classmethod
+    def fromPost(cls, post):
+        bibtex = post["bibtex"]
+        misc = parseMisc(bibtex["misc"]) if "misc" in bibtex else {}
+        return cls(bibtex["intrahash"], post["user"]["name"], bibtex.get("title", ""), bibtex.get("author", ""),
+                   bibtex.get("howpublished", ""), bibtex.get("year", ""), bibtex.get("note", ""),
+                   misc.get("affiliation", ""), misc.get("orcid-numbers", ""), misc.get("doi", ""),
+                   [tag["name"] for tag in post.get("tag", [])])
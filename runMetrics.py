@@ -0,0 +1,173 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from exportState import writeTextAtomic
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+def getEndpoint(url):
+    """Reduces a request URL to the path below api/, e.g. search, datasets/:persistentId or posts"""
+    segments = [s for s in urlparse(url).path.split("/") if s != ""]
+    if "api" in segments:
+        segments = segments[len(segments) - segments[::-1].index("api"):]
+    if len(segments) == 0:
+        return "/"
+    endpoint = segments[0]
+    if len(segments) > 1 and segments[1].startswith(":"):
+        endpoint += "/" + segments[1]
+    return endpoint
+
+
+def getPeakMemory():
+    """Peak resident set size of the process in bytes, None where the platform does not report it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.responseBytes = 0
+        self.latencySum = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def toDict(self):
+        return {"requests": self.requests, "failures": self.failures, "retries": self.retries,
+                "responseBytes": self.responseBytes, "latencySum": round(self.latencySum, 6),
+                "latencyBuckets": dict(zip([str(b) for b in LATENCY_BUCKETS], self.buckets))}
+
+
+class RunMetrics:
+    """Request counts, latency histograms, response sizes, retries and failures per backend endpoint,
+    plus wall-clock timings per stage of one export run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startedAt = time.time()
+        self.endpoints = {}
+        self.stages = {}
+        self.limits = {}
+
+    def getEndpointMetrics(self, backend, url):
+        key = (backend, getEndpoint(url))
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointMetrics()
+        return self.endpoints[key]
+
+    def recordRequest(self, backend, url, latency, responseBytes, failed):
+        with self.lock:
+            metrics = self.getEndpointMetrics(backend, url)
+            metrics.requests += 1
+            metrics.responseBytes += responseBytes
+            metrics.latencySum += latency
+            if failed:
+                metrics.failures += 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    metrics.buckets[index] += 1
+                    break
+
+    def recordRetry(self, backend, url):
+        with self.lock:
+            self.getEndpointMetrics(backend, url).retries += 1
+
+    def recordLimit(self, backend, limit, reason):
+        with self.lock:
+            self.limits.setdefault(backend, []).append(
+                {"at": round(time.time() - self.startedAt, 3), "limit": limit, "reason": reason})
+
+    def addStageTime(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addStageTime(name, time.perf_counter() - start)
+
+    def summary(self, extra=None):
+        with self.lock:
+            summary = {"startedAt": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.startedAt)),
+                       "duration": round(time.time() - self.startedAt, 3),
+                       "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                       "endpoints": {"{}:{}".format(backend, endpoint): metrics.toDict() for (backend, endpoint), metrics in
+                                     sorted(self.endpoints.items())},
+                       "concurrencyLimits": {backend: list(changes) for backend, changes in sorted(self.limits.items())},
+                       "peakMemoryBytes": getPeakMemory()}
+        if extra is not None:
+            summary.update(extra)
+        return summary
+
+    def toPrometheus(self):
+        lines = []
+
+        def header(name, metricType, helpText):
+            lines.append("# HELP pumaexport_{} {}".format(name, helpText))
+            lines.append("# TYPE pumaexport_{} {}".format(name, metricType))
+
+        def sample(name, labels, value):
+            labelStr = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append("pumaexport_{}{} {}".format(name, "{" + labelStr + "}" if labelStr else "", value))
+
+        with self.lock:
+            endpoints = [([("backend", backend), ("endpoint", endpoint)], m) for (backend, endpoint), m in
+                         sorted(self.endpoints.items())]
+            for name, attribute, helpText in [("http_requests_total", "requests", "HTTP requests per backend endpoint"),
+                                              ("http_failures_total", "failures", "HTTP requests failed with an exception or status >= 400"),
+                                              ("http_retries_total", "retries", "Retried HTTP requests"),
+                                              ("http_response_bytes_total", "responseBytes", "Received response bytes")]:
+                header(name, "counter", helpText)
+                for labels, m in endpoints:
+                    sample(name, labels, getattr(m, attribute))
+            header("http_request_duration_seconds", "histogram", "HTTP request latency")
+            for labels, m in endpoints:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, m.buckets):
+                    cumulative += count
+                    sample("http_request_duration_seconds_bucket", labels + [("le", str(bound))], cumulative)
+                sample("http_request_duration_seconds_bucket", labels + [("le", "+Inf")], m.requests)
+                sample("http_request_duration_seconds_sum", labels, round(m.latencySum, 6))
+                sample("http_request_duration_seconds_count", labels, m.requests)
+            header("concurrency_limit", "gauge", "Concurrent requests allowed per backend at the end of the run")
+            for backend, changes in sorted(self.limits.items()):
+                sample("concurrency_limit", [("backend", backend)], changes[-1]["limit"])
+            header("concurrency_limit_changes_total", "counter", "Changes of the concurrency limit per backend")
+            for backend, changes in sorted(self.limits.items()):
+                sample("concurrency_limit_changes_total", [("backend", backend)], len(changes) - 1)
+            header("stage_duration_seconds", "gauge", "Wall-clock time per export stage")
+            for name, seconds in sorted(self.stages.items()):
+                sample("stage_duration_seconds", [("stage", name)], round(seconds, 3))
+        peakMemory = getPeakMemory()
+        if peakMemory is not None:
+            header("peak_memory_bytes", "gauge", "Peak resident memory of the export process")
+            sample("peak_memory_bytes", [], peakMemory)
+        header("run_duration_seconds", "gauge", "Duration of the last export run")
+        sample("run_duration_seconds", [], round(time.time() - self.startedAt, 3))
+        header("last_run_timestamp_seconds", "gauge", "Start time of the last export run")
+        sample("last_run_timestamp_seconds", [], int(self.startedAt))
+        return "\n".join(lines) + "\n"
+
+    def write(self, prometheusFile, summaryFile, extra=None):
+        if prometheusFile:
+            writeTextAtomic(prometheusFile, self.toPrometheus())
+        if summaryFile:
+            writeTextAtomic(summaryFile, json.dumps(self.summary(extra), indent=2, ensure_ascii=False))
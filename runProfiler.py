@@ -0,0 +1,164 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from exportState import writeTextAtomic
+
+
+def getFrameLabel(code):
+    return "{}.{}".format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+
+
+def getCollapsedStack(frame):
+    """The stack of frame, outermost call first, in the collapsed format of flamegraph.pl"""
+    labels = []
+    while frame is not None:
+        labels.append(getFrameLabel(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class DatasetTimings:
+    """Time per dataset: fetch is spent in api/datasets calls, total in getExportEntry, which includes the
+    fetch. Datasets parsed from the search results have no fetch time."""
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add(self, doi, kind, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(doi, {"fetch": 0.0, "total": 0.0})
+            timing[kind] += seconds
+
+    def rows(self):
+        """(doi, fetch, processing, total) per dataset"""
+        with self.lock:
+            return [(doi, t["fetch"], max(t["total"] - t["fetch"], 0.0), max(t["total"], t["fetch"]))
+                    for doi, t in self.timings.items()]
+
+    def format(self, limit=20):
+        rows = self.rows()
+        lines = []
+        for title, column in [("slowest datasets by fetch time", 1), ("slowest datasets by processing time", 2)]:
+            lines.append("{} ({} datasets):".format(title, len(rows)))
+            lines.append("{:<40} {:>10} {:>12} {:>10}".format("doi", "fetch s", "processing s", "total s"))
+            for doi, fetch, processing, total in sorted(rows, key=lambda row: row[column], reverse=True)[:limit]:
+                lines.append("{:<40} {:>10.3f} {:>12.3f} {:>10.3f}".format(doi, fetch, processing, total))
+            lines.append("")
+        return "\n".join(lines)
+
+    def toTSV(self):
+        lines = ["doi\tfetch\tprocessing\ttotal"]
+        for doi, fetch, processing, total in sorted(self.rows()):
+            lines.append("{}\t{:.6f}\t{:.6f}\t{:.6f}".format(doi, fetch, processing, total))
+        return "\n".join(lines) + "\n"
+
+
+class RunProfiler:
+    """Profiles an export run with cProfile and with a sampling thread.
+
+    cProfile counts every call, also in the worker threads started during the run, and is written as
+    pstats file. The sampling thread takes the stacks of all threads every interval seconds; the
+    collapsed stacks (input of flamegraph.pl or speedscope) show wall-clock time, so threads waiting
+    for DaRUS or PUMA appear with the call they wait in.
+    """
+
+    def __init__(self, directory="output/profile", interval=0.005):
+        self.directory = directory
+        self.interval = float(interval)
+        self.profiles = []
+        self.profilesLock = threading.Lock()
+        self.samples = Counter()
+        self.sampleCount = 0
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.startedAt = None
+        self.duration = None
+
+    def startThread(self, frame, event, arg):
+        # set by threading.setprofile in every new thread: replaces itself with a profiler for the thread
+        profile = cProfile.Profile()
+        with self.profilesLock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples[getCollapsedStack(frame)] += 1
+            self.sampleCount += 1
+
+    def start(self):
+        self.startedAt = time.perf_counter()
+        # started first, so the sampler itself is not profiled
+        self.sampler = threading.Thread(target=self.sample, name="profileSampler", daemon=True)
+        self.sampler.start()
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        # since 3.12 cProfile sees all threads and only one profiler may be active
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.startThread)
+        profile.enable()
+        return self
+
+    def stop(self):
+        self.profiles[0].disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        self.stopped.set()
+        self.sampler.join()
+        self.duration = time.perf_counter() - self.startedAt
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def getStats(self):
+        with self.profilesLock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def write(self, metrics=None, timings=None):
+        """Writes pumaexport.pstats, pumaexport.collapsed and profile.txt (the top functions, the export
+        stages of metrics and the slowest datasets of timings) plus datasets.tsv. Returns the file names."""
+        os.makedirs(self.directory, exist_ok=True)
+        stats = self.getStats()
+        pstatsFile = os.path.join(self.directory, "pumaexport.pstats")
+        stats.dump_stats(pstatsFile)
+        collapsedFile = os.path.join(self.directory, "pumaexport.collapsed")
+        writeTextAtomic(collapsedFile, "".join("{} {}\n".format(stack, count) for stack, count in
+                                               sorted(self.samples.items())))
+        report = io.StringIO()
+        report.write("run of {:.3f}s, {} samples every {}s\n\n".format(self.duration, self.sampleCount, self.interval))
+        if metrics is not None:
+            report.write("stages (wall-clock, summed over threads):\n")
+            for name, seconds in sorted(metrics.summary()["stages"].items(), key=lambda item: item[1], reverse=True):
+                report.write("  {:<20} {:>10.3f}s\n".format(name, seconds))
+            report.write("\n")
+        if timings is not None:
+            report.write(timings.format())
+            report.write("\n")
+        stats.stream = report
+        stats.sort_stats("cumulative").print_stats(40)
+        files = [pstatsFile, collapsedFile]
+        if timings is not None:
+            timingsFile = os.path.join(self.directory, "datasets.tsv")
+            writeTextAtomic(timingsFile, timings.toTSV())
+            files.append(timingsFile)
+        reportFile = os.path.join(self.directory, "profile.txt")
+        writeTextAtomic(reportFile, report.getvalue())
+        files.append(reportFile)
+        return files
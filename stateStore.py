@@ -0,0 +1,238 @@
+import os
+import threading
+from datetime import datetime
+
+from exportState import TIMEFORMAT
+from pumaSnapshot import getPostDOI, getPostDate, normalizeDOI
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    doi TEXT PRIMARY KEY,
+    global_id TEXT NOT NULL,
+    dataverse TEXT,
+    version_key TEXT,
+    status TEXT,
+    title TEXT,
+    year TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    last_run INTEGER
+);
+CREATE INDEX IF NOT EXISTS datasets_dataverse ON datasets (dataverse);
+CREATE TABLE IF NOT EXISTS versions (
+    doi TEXT NOT NULL,
+    version_key TEXT NOT NULL,
+    version TEXT,
+    first_seen TEXT NOT NULL,
+    PRIMARY KEY (doi, version_key)
+);
+CREATE TABLE IF NOT EXISTS puma_posts (
+    intrahash TEXT PRIMARY KEY,
+    doi TEXT NOT NULL,
+    newest INTEGER NOT NULL,
+    title TEXT,
+    author TEXT,
+    year TEXT,
+    changed TEXT,
+    user TEXT,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS puma_posts_doi ON puma_posts (doi);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    doi TEXT PRIMARY KEY,
+    version_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    computed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    dataverses TEXT,
+    full INTEGER NOT NULL,
+    datasets INTEGER,
+    new INTEGER,
+    changed INTEGER
+);
+"""
+
+# failed: the last export could not fetch the dataset; new: PUMA has no post with the DOI;
+# changed/unchanged: the fingerprints of the DaRUS dataset and the newest PUMA post differ/match; without
+# both fingerprints the status of the last export counts
+CLASSIFICATION = """
+SELECT d.doi, d.global_id, d.dataverse,
+       CASE WHEN d.status = 'failed' THEN 'failed'
+            WHEN p.doi IS NULL THEN 'new'
+            WHEN f.fingerprint IS NOT NULL AND p.fingerprint IS NOT NULL THEN
+                CASE WHEN f.fingerprint = p.fingerprint THEN 'unchanged' ELSE 'changed' END
+            ELSE d.status END AS classification,
+       d.title, d.last_seen
+FROM datasets d
+LEFT JOIN puma_posts p ON p.doi = d.doi AND p.newest = 1
+LEFT JOIN fingerprints f ON f.doi = d.doi AND f.version_key = d.version_key
+"""
+
+REPORTS = {
+    "datasets": (CLASSIFICATION + "WHERE (:dataverse IS NULL OR d.dataverse = :dataverse) ORDER BY d.doi",
+                 ["doi", "global_id", "dataverse", "classification", "title", "last_seen"]),
+    "duplicates": ("SELECT doi, COUNT(*), GROUP_CONCAT(intrahash, ' ') FROM puma_posts GROUP BY doi "
+                   "HAVING COUNT(*) > 1 ORDER BY doi", ["doi", "posts", "intrahashes"]),
+    "versions": ("SELECT v.doi, v.version, v.version_key, v.first_seen FROM versions v JOIN datasets d ON d.doi = v.doi "
+                 "WHERE (:dataverse IS NULL OR d.dataverse = :dataverse) ORDER BY v.first_seen DESC, v.doi",
+                 ["doi", "version", "version_key", "first_seen"]),
+    "runs": ("SELECT id, started_at, finished_at, dataverses, full, datasets, new, changed FROM runs ORDER BY id DESC",
+             ["id", "started_at", "finished_at", "dataverses", "full", "datasets", "new", "changed"]),
+}
+CLASSIFICATIONS = ["new", "changed", "unchanged", "failed"]
+
+
+class StateStore:
+    """SQLite copy of what the export runs learn about DaRUS and PUMA (default output/pumaexport.sqlite):
+    the listed datasets with their versions and last export status, the PUMA posts of the snapshot, the
+    fingerprints of the compared fields and the history of the runs, all indexed by normalized DOI.
+
+    The exporter queues rows while it runs (thread-safe) and writes them with commit(), so reports such as
+    the new and changed datasets of a dataverse are queries instead of API sweeps. The database is
+    created with the first write.
+    """
+
+    def __init__(self, path="output/pumaexport.sqlite"):
+        self.path = path
+        self.connection = None
+        self.lock = threading.RLock()
+        # id in runs of the run in progress, set by startRun
+        self.currentRun = None
+        # rows written by the next commit
+        self.pendingDatasets = []
+        self.pendingFingerprints = {}
+
+    def getConnection(self):
+        # sqlite3 is only imported by runs that use the store
+        import sqlite3
+
+        with self.lock:
+            if self.connection is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                self.connection.executescript(SCHEMA)
+            return self.connection
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.getConnection().execute(sql, parameters)
+
+    @staticmethod
+    def now():
+        return datetime.now().strftime(TIMEFORMAT)
+
+    def recordDataset(self, globalId, dataverse, versionKey, status, record=None):
+        """Queues the listing and export status of a dataset; record (a DarusRecord) if it was read"""
+        doi = normalizeDOI(globalId)
+        title = record.datasetTitle if record is not None and record.doi is not None else None
+        year = record.year if record is not None and record.doi is not None else None
+        version = record.version if record is not None and record.version else None
+        with self.lock:
+            self.pendingDatasets.append((doi, globalId, dataverse, versionKey, status, title, year, version, self.now(),
+                                         self.currentRun))
+
+    def putFingerprint(self, globalId, versionKey, value):
+        if versionKey is None:
+            return
+        with self.lock:
+            self.pendingFingerprints[normalizeDOI(globalId)] = (versionKey, value, self.now())
+
+    def syncPumaPosts(self, snapshot, fingerprints):
+        """Replaces the PUMA posts with those of the snapshot. fingerprints maps DOIs to the fingerprint
+        of their newest post."""
+        newest = {doi: post["bibtex"]["intrahash"] for doi, post in snapshot.iterByDOI()}
+        rows = []
+        for intrahash, post in snapshot.posts.items():
+            doi = getPostDOI(post)
+            if doi == "":
+                continue
+            bibtex = post["bibtex"]
+            isNewest = newest.get(doi) == intrahash
+            rows.append((intrahash, doi, int(isNewest), bibtex.get("title"), bibtex.get("author"), bibtex.get("year"),
+                         getPostDate(post), post.get("user", {}).get("name"),
+                         fingerprints.get(doi) if isNewest else None))
+        with self.lock:
+            connection = self.getConnection()
+            with connection:
+                connection.execute("DELETE FROM puma_posts")
+                connection.executemany("INSERT INTO puma_posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def startRun(self, dataverses, full, startedAt=None):
+        startedAt = (startedAt or datetime.now()).strftime(TIMEFORMAT)
+        with self.lock:
+            connection = self.getConnection()
+            with connection:
+                cursor = connection.execute("INSERT INTO runs (started_at, dataverses, full) VALUES (?, ?, ?)",
+                                            (startedAt, " ".join(dataverses) if dataverses else None, int(bool(full))))
+            self.currentRun = cursor.lastrowid
+            return self.currentRun
+
+    def finishRun(self):
+        """Writes the queued rows and the counts of the datasets exported by the current run"""
+        with self.lock:
+            self.commit()
+            run = self.currentRun
+            if run is None:
+                return
+            with self.getConnection() as connection:
+                connection.execute(
+                    "UPDATE runs SET finished_at = ?, datasets = (SELECT COUNT(*) FROM datasets WHERE last_run = ?), "
+                    "new = (SELECT COUNT(*) FROM datasets WHERE last_run = ? AND status = 'new'), "
+                    "changed = (SELECT COUNT(*) FROM datasets WHERE last_run = ? AND status = 'changed') "
+                    "WHERE id = ?", (self.now(), run, run, run, run))
+            self.currentRun = None
+
+    def classify(self, dataverse=None):
+        """(doi, classification) of the known datasets, new/changed/unchanged against the PUMA posts or
+        failed if the last export could not fetch them"""
+        return [(row[0], row[3]) for row in self.report("datasets", dataverse)[1]]
+
+    def report(self, name, dataverse=None):
+        """Returns (columns, rows) of a report: one of REPORTS or a classification (new, changed,
+        unchanged, failed), which lists the datasets with that classification"""
+        if name in CLASSIFICATIONS:
+            columns, rows = self.report("datasets", dataverse)
+            return columns, [row for row in rows if row[3] == name]
+        sql, columns = REPORTS[name]
+        with self.lock:
+            return columns, self.execute(sql, {"dataverse": dataverse}).fetchall()
+
+    def commit(self):
+        """Writes the queued datasets and fingerprints in one short transaction, so shards running in other
+        processes are held up only briefly"""
+        with self.lock:
+            datasets, self.pendingDatasets = self.pendingDatasets, []
+            fingerprints, self.pendingFingerprints = self.pendingFingerprints, {}
+            if not datasets and not fingerprints:
+                return
+            with self.getConnection() as connection:
+                connection.executemany(
+                    "INSERT INTO datasets (doi, global_id, dataverse, version_key, status, title, year, first_seen, "
+                    "last_seen, last_run) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?9, ?9, ?10) ON CONFLICT (doi) DO UPDATE "
+                    "SET global_id = excluded.global_id, dataverse = excluded.dataverse, "
+                    "version_key = excluded.version_key, status = excluded.status, "
+                    "title = COALESCE(excluded.title, title), year = COALESCE(excluded.year, year), "
+                    "last_seen = excluded.last_seen, last_run = excluded.last_run", datasets)
+                connection.executemany(
+                    "INSERT INTO versions (doi, version_key, version, first_seen) VALUES (?1, ?4, ?8, ?9) "
+                    "ON CONFLICT (doi, version_key) DO UPDATE SET version = COALESCE(excluded.version, version)",
+                    [row[:9] for row in datasets if row[3] is not None])
+                connection.executemany(
+                    "INSERT INTO fingerprints (doi, version_key, fingerprint, computed_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (doi) DO UPDATE SET version_key = excluded.version_key, "
+                    "fingerprint = excluded.fingerprint, computed_at = excluded.computed_at "
+                    "WHERE version_key != excluded.version_key OR fingerprint != excluded.fingerprint",
+                    [(doi,) + values for doi, values in fingerprints.items()])
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
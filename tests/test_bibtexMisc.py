@@ -0,0 +1,38 @@
+from bibtexMisc import parseMisc
+from pumaExport import Exporter
+from records import DarusRecord
+
+MISC = ('  affiliation = {Stegmüller, Michael/University of Stuttgart, Iglezakis, Dorothea/{IZUS} Stuttgart},\n'
+        '  doi = {10.18419/darus-452},\n'
+        '  Orcid-Numbers = {Stegmüller, Michael/0000-0000-0000-0001},\n'
+        '  note = "Related to: {A} \\"quoted\\" title",\n'
+        '  pages = 12')
+
+
+def test_parseMiscReturnsAllFields():
+    fields = parseMisc(MISC)
+
+    assert fields["affiliation"] == "Stegmüller, Michael/University of Stuttgart, Iglezakis, Dorothea/{IZUS} Stuttgart"
+    assert fields["doi"] == "10.18419/darus-452"
+    assert fields["orcid-numbers"] == "Stegmüller, Michael/0000-0000-0000-0001"
+    assert fields["note"] == 'Related to: {A} \\"quoted\\" title'
+    assert fields["pages"] == "12"
+
+
+def test_parseMiscToleratesBrokenInput():
+    assert parseMisc("") == {}
+    assert parseMisc("doi = {10.18419/darus-1") == {"doi": "10.18419/darus-1"}
+
+
+def test_getChangesUsesParsedMisc():
+    exporter = Exporter({"export": {"cacheFile": None}})
+    post = {"bibtex": {"title": "Testtitel", "author": "Stegmüller, Michael", "howpublished": "Dataset", "year": "2021",
+                       "misc": "affiliation = {Stegmüller, Michael/University of Stuttgart},\n doi = {10.18419/darus-452}",
+                       "intrahash": "abc"}, "user": {"name": "unibiblio"}, "tag": []}
+    darus = {"datasetTitle": "Testtitel", "datasetSubTitle": "", "authors": ["Stegmüller, Michael"],
+             "howpublished": "Dataset", "year": "2021", "authorAffiliation": ["Stegmüller, Michael/University of Stuttgart"],
+             "authorOrcids": [], "doi": "10.18419/darus-452", "relatedPub": ""}
+
+    assert exporter.getChanges(DarusRecord.fromDict(darus), exporter.genDatasetFromPost(post)) == []
+    darus["authorOrcids"] = ["Stegmüller, Michael/0000-0000-0000-0001"]
+    assert len(exporter.getChanges(DarusRecord.fromDict(darus), exporter.genDatasetFromPost(post))) == 1
@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pumaExport import Exporter
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATASET = {"persistentUrl": "https://doi.org/10.18419/darus-452", "protocol": "doi", "authority": "10.18419",
+           "identifier": "DARUS-452", "publicationDate": "2021-03-04",
+           "latestVersion": {"versionState": "RELEASED", "versionNumber": 1, "versionMinorNumber": 0, "metadataBlocks": {
+               "citation": {"fields": [{"typeName": "title", "value": "Testtitel"},
+                                       {"typeName": "author", "value": [
+                                           {"authorName": {"value": "Institute of Hydraulic Engineering"},
+                                            "authorAffiliation": {"value": "Universität Stuttgart"}}]}]}}}}
+
+
+def test_getDarusSetFetchesOncePerRun(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"}, "export": {"cacheFile": None}})
+    calls = []
+    lock = threading.Lock()
+
+    def callDarusAPI(url, **kwargs):
+        with lock:
+            calls.append(url)
+        time.sleep(0.05)
+        return DATASET
+
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=callDarusAPI)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        records = list(executor.map(exporter.getDarusSet, ["doi:10.18419/darus-452"] * 8))
+
+    assert len(calls) == 1
+    assert all(record.datasetTitle == "Testtitel" for record in records)
+    assert exporter.joinAuthors(list(records[0].authors)) == "{Institute of Hydraulic Engineering}"
+    assert records[1].authors == ("Institute of Hydraulic Engineering",)
+    assert exporter.getDarusSet("doi:10.18419/other-1") is None
+
+
+def test_bibTexAndPumaPayloadRenderFromOneRecord(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"}, "export": {"cacheFile": None},
+                         "puma": {"user": "darus", "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib"),
+                                  "jsonTemplate": os.path.join(REPO, "tpl_puma.txt")}})
+    call = mocker.patch.object(exporter, "callDarusAPI", return_value=DATASET)
+
+    bibtex = exporter.genBibTex("doi:10.18419/darus-452")
+    payload = exporter.getPUMAExport("doi:10.18419/darus-452")
+
+    assert call.call_count == 1
+    assert exporter.getDarusSet("doi:10.18419/darus-452").version == "1.0"
+    post = json.loads(payload["main"][1])["post"]
+    assert post["bibtex"]["url"] == "https://doi.org/10.18419/darus-452"
+    assert post["bibtex"]["year"] == "2021"
+    assert post["user"]["name"] == "darus"
+    # the uploaded entry differs from the one in the export mail only in the random part of the key
+    assert payload["bibtex"][1] == bibtex
+    assert "affiliation = {Institute of Hydraulic Engineering/Universität Stuttgart}" in bibtex
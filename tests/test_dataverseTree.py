@@ -0,0 +1,79 @@
+from dataverseTree import DataverseTree, SubtreeFilter
+from pumaExport import Exporter
+
+
+def genDataverse(alias, parent, entityId=None, published="2021-01-01T10:00:00Z"):
+    return {"identifier": alias, "parentDataverseIdentifier": parent, "entity_id": entityId, "name": alias,
+            "published_at": published, "type": "dataverse"}
+
+
+def genTree(path=None):
+    tree = DataverseTree(path)
+    for item in [genDataverse("f02", "darus", 2), genDataverse("iws", "f02", 3), genDataverse("iws_lh2", "iws", 4),
+                 genDataverse("ibc", "darus", 5, "2022-05-01T08:00:00Z")]:
+        tree.add(item)
+    return tree
+
+
+def test_subtreesAndTopLevel():
+    tree = genTree()
+
+    assert tree.getSubtree("f02") == {"f02", "iws", "iws_lh2"}
+    assert tree.getSubtree(3) == {"iws", "iws_lh2"}
+    assert tree.getSubDataverses("darus") == ["f02", "ibc", "iws", "iws_lh2"]
+    assert tree.getTopLevel() == ["f02", "ibc"]
+
+
+def test_moveUpdatesSubtrees():
+    tree = genTree()
+    assert "iws_lh2" in tree.getSubtree("f02")
+
+    tree.add(genDataverse("iws_lh2", "ibc", 4))
+
+    assert tree.getSubtree("f02") == {"f02", "iws"}
+    assert tree.getSubtree("ibc") == {"ibc", "iws_lh2"}
+
+
+def test_roundTrip(tmp_path):
+    path = str(tmp_path / "tree.json")
+    tree = genTree(path)
+    tree.markRefreshed(full=True)
+    tree.save()
+
+    reloaded = DataverseTree(path)
+    assert reloaded.highWaterMark == "2022-05-01T08:00:00Z"
+    assert reloaded.getSubtree("darus") == tree.getSubtree("darus")
+    assert not reloaded.isStale(24)
+    assert not reloaded.needsFullRefresh(7)
+
+
+def test_subtreeFilterRefreshesOnceForUnknownDataverse():
+    tree = genTree()
+    refreshes = []
+
+    def refresh():
+        refreshes.append(1)
+        tree.add(genDataverse("new", "iws"))
+
+    validDataverses = SubtreeFilter(tree, "f02", refresh)
+    assert "iws" in validDataverses
+    assert "ibc" not in validDataverses
+    assert "new" in validDataverses
+    assert "unknown" not in validDataverses
+    assert len(refreshes) == 1
+
+
+def test_exporterRefreshesTreeIncrementally(mocker, tmp_path):
+    path = str(tmp_path / "tree.json")
+    tree = genTree(path)
+    tree.markRefreshed(full=True)
+    tree.refreshedAt = "2000-01-01T00:00:00"
+    tree.save()
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/", "treeFile": path}, "export": {"cacheFile": None}})
+    search = mocker.patch.object(exporter, "searchDarus", return_value=iter([genDataverse("new", "ibc", 6)]))
+
+    assert exporter.getSubDataverses("ibc") == ["new"]
+    assert exporter.getTopLevelDataverses() == ["f02", "ibc"]
+    assert search.call_count == 1
+    assert search.call_args[0][0].startswith("&fq=dateSort:[2022-05-01T00:00:00Z")
+    assert len(DataverseTree(path)) == 5
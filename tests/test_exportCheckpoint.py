@@ -0,0 +1,246 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from exportState import ExportState
+from exporterExceptions import ApiCallFailedException
+from pumaExport import Exporter
+from pumaExporter import exportDataverse, pumaExportMany
+from pumaSnapshot import PumaSnapshot
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = ["doi:10.18419/darus-{}".format(i) for i in range(10)]
+
+
+class Crash(Exception):
+    pass
+
+
+def genExporter(tmp_path, credentials=None):
+    credentials = credentials or {}
+    credentials.setdefault("export", {}).update({"cacheFile": None, "fingerprintFile": None, "stateDatabase": None,
+                                                 "checkpointEvery": 3,
+                                                 "checkpointDir": str(tmp_path / "checkpoints"), "workers": 2})
+    return Exporter(credentials)
+
+
+def genEntry(ds, pumaDatasets):
+    return "new", "@misc{" + ds + "}\n"
+
+
+def test_interruptedExportIsResumed(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    exporter = genExporter(tmp_path)
+
+    def crashingEntry(ds, pumaDatasets):
+        if ds == DATASETS[7]:
+            raise Crash()
+        return genEntry(ds, pumaDatasets)
+
+    mocker.patch.object(exporter, "getExportEntry", side_effect=crashingEntry)
+    with pytest.raises(Crash):
+        exporter.writeExportFiles(iter(DATASETS), {}, "ibc")
+    assert sorted(os.listdir("output")) == ["{}_ibc_changes.txt.part".format(exporter.getCheckpoint("ibc").exportDate),
+                                            "{}_ibc_export.bib.part".format(exporter.getCheckpoint("ibc").exportDate)]
+
+    exporter = genExporter(tmp_path)
+    checkpoint = exporter.getCheckpoint("ibc")
+    assert checkpoint.resumed and len(checkpoint) == 7
+    entries = mocker.patch.object(exporter, "getExportEntry", side_effect=genEntry)
+    files = exporter.writeExportFiles(iter(DATASETS), {}, "ibc", checkpoint)
+
+    assert [call.args[0] for call in entries.call_args_list] == DATASETS[7:]
+    with open(files[0], encoding="utf_8") as bib:
+        assert bib.read() == "".join("@misc{" + ds + "}\n" for ds in DATASETS)
+    assert not os.path.exists(checkpoint.path)
+    assert not any(name.endswith(".part") for name in os.listdir("output"))
+
+
+def test_checkpointOfOtherWatermarkIsIgnored(tmp_path):
+    exporter = genExporter(tmp_path)
+    checkpoint = exporter.getCheckpoint("ibc")
+    checkpoint.exportDate = "2022-01-01"
+    checkpoint.add(DATASETS[0])
+    checkpoint.save({"export": 10, "changes": 0})
+
+    assert exporter.getCheckpoint("ibc").resumed
+    assert not exporter.getCheckpoint("ibc", datetime(2022, 1, 1)).resumed
+    assert not exporter.getCheckpoint("iws").resumed
+
+
+def genPost(i):
+    return {"bibtex": {"intrahash": "{:032x}".format(i), "misc": "doi = {10.18419/darus-" + str(i) + "}"},
+            "changedate": "2022-01-01 10:{:02d}:00".format(59 - i), "user": {"name": "unibiblio"}, "tag": []}
+
+
+def test_failedFullPumaRefreshIsContinued(mocker, tmp_path):
+    path = str(tmp_path / "snapshot.json")
+    exporter = genExporter(tmp_path, {"puma": {"baseUrl": "http://localhost/api/", "snapshotFile": path}})
+    pages = [[genPost(i) for i in range(start, start + 100)] for start in range(0, 300, 100)]
+    starts = []
+
+    def iterPages(search=None, start=0):
+        starts.append(start)
+        for page in pages[start // 100:]:
+            if page is pages[2] and len(starts) == 1:
+                raise ApiCallFailedException("PUMA-Call failed: 502")
+            yield page
+
+    mocker.patch.object(exporter, "iterUniBiblioPages", side_effect=iterPages)
+    assert len(exporter.refreshPumaSnapshot()) == 0
+    assert PumaSnapshot(path).partial["start"] == 200
+
+    exporter = genExporter(tmp_path, {"puma": {"baseUrl": "http://localhost/api/", "snapshotFile": path}})
+    mocker.patch.object(exporter, "iterUniBiblioPages", side_effect=iterPages)
+    snapshot = exporter.refreshPumaSnapshot()
+
+    assert starts == [0, 100]
+    assert len(snapshot) == 300
+    assert snapshot.partial is None
+    assert snapshot.highWaterMark == "2022-01-01 10:59:00"
+
+
+def test_failedListingKeepsCheckpointAndWatermark(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    exporter = genExporter(tmp_path, {"puma": {"mailer": "False"}, "export": {"stateFile": "output/state.json"}})
+    state = ExportState("output/state.json")
+    state.setLastRun("ibc", datetime(2024, 1, 1, 10))
+    state.setLastRun("iws", datetime(2024, 1, 1, 10))
+    state.save()
+
+    def listing(dv, since=None, startAt=0):
+        yield from DATASETS[:5]
+        if dv == "ibc":
+            raise ApiCallFailedException("DaRUS-Call failed: 502")
+
+    mocker.patch.object(exporter, "getDataverseTree")
+    mocker.patch.object(exporter, "getAllDatasetsFromUniBiblio", return_value={"10.18419/darus-99": None})
+    mocker.patch.object(exporter, "iterDatasetsByDataverse", side_effect=listing)
+    mocker.patch.object(exporter, "getExportEntry", side_effect=genEntry)
+    pumaExportMany(["ibc", "iws"], exporter=exporter)
+
+    state = ExportState("output/state.json")
+    assert state.getLastRun("ibc") == datetime(2024, 1, 1, 10)
+    assert state.getLastRun("iws") > datetime(2024, 1, 1, 10)
+    checkpoint = exporter.getCheckpoint("ibc", datetime(2024, 1, 1, 10))
+    # the datasets listed but not written yet are listed again by the next run
+    assert checkpoint.resumed and checkpoint.processed == DATASETS[:len(checkpoint)]
+    assert not exporter.getCheckpoint("iws", datetime(2024, 1, 1, 10)).resumed
+
+
+def test_pumaRefreshPicksUpCorrectedPosts(mocker, tmp_path):
+    path = str(tmp_path / "snapshot.json")
+    pages = [[genPost(i) for i in range(start, start + 100)] for start in range(0, 200, 100)]
+
+    def refresh(incremental=False):
+        exporter = genExporter(tmp_path, {"puma": {"baseUrl": "http://localhost/api/", "snapshotFile": path,
+                                                   "snapshotIncremental": incremental}})
+        mocker.patch.object(exporter, "iterUniBiblioPages", side_effect=lambda search=None, start=0: iter(pages))
+        return exporter.refreshPumaSnapshot()
+
+    refresh()
+    # the library corrects a post on the second page, PUMA keeps listing it by its posting date
+    corrected = dict(pages[1][50], bibtex=dict(pages[1][50]["bibtex"], title="corrected"),
+                     changedate="2022-01-02 10:00:00")
+    pages[1][50] = corrected
+    intrahash = corrected["bibtex"]["intrahash"]
+
+    assert "title" not in refresh(incremental=True).getByIntrahash(intrahash)["bibtex"]
+    snapshot = refresh()
+    assert snapshot.getByIntrahash(intrahash)["bibtex"]["title"] == "corrected"
+    assert len(snapshot) == 200
+
+
+def test_resumedExportUploadsDatasetsOfTheInterruptedRun(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    monkeypatch.setattr("exportCheckpoint.LISTING_OVERLAP", 0)
+    exporter = genExporter(tmp_path)
+
+    def crashingEntry(ds, pumaDatasets):
+        if ds == DATASETS[7]:
+            raise Crash()
+        return genEntry(ds, pumaDatasets)
+
+    mocker.patch.object(exporter, "getExportEntry", side_effect=crashingEntry)
+    with pytest.raises(Crash):
+        exporter.writeExportFiles(iter(DATASETS), {}, "ibc")
+
+    exporter = genExporter(tmp_path)
+    listing = mocker.patch.object(exporter, "iterDatasetsByDataverse",
+                                  side_effect=lambda dv, since=None, startAt=0: iter(DATASETS[startAt:]))
+    mocker.patch.object(exporter, "getExportEntry", side_effect=genEntry)
+    uploader = mocker.MagicMock()
+    uploader.upload.return_value = []
+    uploader.summarize.return_value = {"uploaded": 0, "skipped": 0, "failed": 0}
+    exportDataverse(exporter, ExportState("output/state.json"), "ibc", {"10.18419/darus-3": None}, uploader=uploader)
+
+    assert listing.call_args.args[2] == 7
+    assert uploader.upload.call_args.args[0] == [ds for ds in DATASETS if ds != DATASETS[3]]
+
+
+def genDataset(ds):
+    return {"persistentUrl": "https://doi.org/" + ds[4:], "protocol": "doi", "authority": "10.18419",
+            "identifier": ds[13:], "publicationDate": "2021-03-04",
+            "latestVersion": {"versionState": "RELEASED", "versionNumber": 1, "versionMinorNumber": 0,
+                              "metadataBlocks": {"citation": {"fields": [
+                                  {"typeName": "title", "value": "Title " + ds},
+                                  {"typeName": "author", "value": [{"authorName": {"value": "Test, Testine"},
+                                                                    "authorAffiliation": {
+                                                                        "value": "Universität Stuttgart"}}]}]}}}}
+
+
+def test_watermarkAndRetriesAreSavedAndReloaded(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = ExportState(path)
+    assert state.getLastRun("ibc") is None and state.getRetries("ibc") == []
+    state.setLastRun("ibc", datetime(2024, 1, 8, 10, 30, 15))
+    state.setRetries("ibc", DATASETS[:2])
+    state.save()
+
+    state = ExportState(path)
+    assert state.getLastRun("ibc") == datetime(2024, 1, 8, 10, 30, 15)
+    assert state.getRetries("ibc") == DATASETS[:2]
+    state.setRetries("ibc", [])
+    assert "retry" not in state.state["dataverses"]["ibc"]
+
+
+def test_datasetsThatCouldNotBeFetchedAreRetried(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    state = ExportState("output/state.json")
+    state.setLastRun("ibc", datetime(2024, 1, 1, 10))
+    state.save()
+
+    def run(listed, failing):
+        exporter = genExporter(tmp_path, {"darus": {"apiBaseUrl": "http://localhost/"},
+                                          "puma": {"mailer": "False", "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib")},
+                                          "export": {"stateFile": "output/state.json"}})
+
+        def callDarusAPI(url, **kwargs):
+            ds = url[url.index("persistentId=") + len("persistentId="):]
+            if ds in failing:
+                raise ApiCallFailedException("DaRUS-Call of {} failed: 502".format(url))
+            return genDataset(ds)
+
+        mocker.patch.object(exporter, "callDarusAPI", side_effect=callDarusAPI)
+        mocker.patch.object(exporter, "getDataverseTree")
+        mocker.patch.object(exporter, "getAllDatasetsFromUniBiblio", return_value={"10.18419/darus-99": None})
+        mocker.patch.object(exporter, "iterDatasetsByDataverse",
+                            side_effect=lambda dv, since=None, startAt=0: iter(listed))
+        pumaExportMany(["ibc"], exporter=exporter)
+        with open("output/{}_ibc_export.bib".format(datetime.now().strftime("%Y-%m-%d")), encoding="utf_8") as bib:
+            exported = bib.read()
+        return [ds for ds in DATASETS if "{" + ds[4:] + "}" in exported]
+
+    assert run(DATASETS[:3], {DATASETS[1]}) == [DATASETS[0], DATASETS[2]]
+    state = ExportState("output/state.json")
+    assert state.getLastRun("ibc") > datetime(2024, 1, 1, 10)
+    assert state.getRetries("ibc") == [DATASETS[1]]
+
+    # the next incremental listing no longer contains the dataset
+    assert run(DATASETS[3:4], set()) == [DATASETS[1], DATASETS[3]]
+    assert ExportState("output/state.json").getRetries("ibc") == []
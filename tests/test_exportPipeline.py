@@ -0,0 +1,98 @@
+import os
+import re
+import threading
+import time
+
+import pytest
+
+from exportPipeline import orderedMap
+from pumaExport import Exporter
+from records import PumaRecord
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_orderedMapKeepsInputOrder():
+    def slowFirst(i):
+        time.sleep(0.02 if i == 0 else 0)
+        return i * i
+
+    assert list(orderedMap(slowFirst, range(20), workers=4)) == [i * i for i in range(20)]
+
+
+def test_orderedMapPullsLazily():
+    pulled = []
+
+    def items():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    results = orderedMap(lambda i: i, items(), workers=2, window=3)
+    assert next(results) == 0
+    assert len(pulled) <= 4
+    results.close()
+
+
+def test_orderedMapRaisesInOrder():
+    lock = threading.Lock()
+    calls = []
+
+    def fail(i):
+        with lock:
+            calls.append(i)
+        if i == 3:
+            raise ValueError(i)
+        return i
+
+    results = orderedMap(fail, range(10), workers=2, window=2)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(results)
+    assert max(calls) < 6
+
+
+def genDataset(ds):
+    return {"persistentUrl": "https://doi.org/" + ds[4:], "protocol": "doi", "authority": "10.18419",
+            "identifier": ds[13:], "publicationDate": "2021-03-04",
+            "latestVersion": {"versionState": "RELEASED", "versionNumber": 1, "versionMinorNumber": 0,
+                              "metadataBlocks": {"citation": {"fields": [
+                                  {"typeName": "title", "value": "Title " + ds},
+                                  {"typeName": "author", "value": [{"authorName": {"value": "Test, Testine"},
+                                                                    "authorAffiliation": {
+                                                                        "value": "Universität Stuttgart"}}]}]}}}}
+
+
+def test_concurrentExportWritesInListingOrder(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"},
+                         "puma": {"baseUrl": "http://localhost/api/", "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib")},
+                         "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None, "workers": 4,
+                                    "checkpointDir": str(tmp_path / "checkpoints")}})
+    datasets = ["doi:10.18419/darus-{}".format(i) for i in range(12)]
+    fetched = []
+    lock = threading.Lock()
+
+    def callDarusAPI(url, **kwargs):
+        ds = url[url.index("persistentId=") + len("persistentId="):]
+        # the earlier datasets of the listing take longer, so the fetches finish in reverse order
+        time.sleep(0.01 * (len(datasets) - datasets.index(ds)) / len(datasets))
+        with lock:
+            fetched.append(ds)
+        return genDataset(ds)
+
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=callDarusAPI)
+    # every other dataset is in PUMA with another title
+    pumaDatasets = {ds[4:]: PumaRecord.fromPost({"bibtex": {"intrahash": "{:032x}".format(i), "title": "Old",
+                                                            "misc": "doi = {" + ds[4:] + "}"},
+                                                 "user": {"name": "unibiblio"}})
+                    for i, ds in enumerate(datasets) if i % 2 == 1}
+
+    files = exporter.writeExportFiles(iter(datasets), pumaDatasets, "ibc")
+
+    assert fetched != datasets and sorted(fetched) == sorted(datasets)
+    with open(files[0], encoding="utf_8") as bib:
+        assert ["doi:" + doi for doi in re.findall(r"doi = \{(\S+)\}", bib.read())] == datasets[0::2]
+    with open(files[1], encoding="utf_8") as changes:
+        assert re.findall(r"Datensatz (\S+):", changes.read()) == datasets[1::2]
@@ -0,0 +1,143 @@
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dataverseTree import DataverseTree
+from exportShards import getShard, getShardFile, mergeShards, parseShard
+from exportState import writeJsonAtomic
+from pumaExport import Exporter
+from pumaExporter import exportShards, mergeDataverses
+from records import PumaRecord
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = ["doi:10.18419/darus-{}".format(i) for i in range(30)]
+
+
+def writeShard(directory, shard, entries, since=None):
+    writeJsonAtomic(getShardFile(directory, "ibc", shard, 2),
+                    {"dataverse": "ibc", "shard": shard + 1, "shards": 2, "since": since,
+                     "startedAt": "2024-01-0{}T10:00:00".format(8 + shard), "datasets": len(entries), "entries": entries})
+
+
+def test_shardIsStableAndIgnoresDOIForm():
+    dois = ["doi:10.18419/darus-{}".format(i) for i in range(200)]
+    shards = [getShard(doi, 4) for doi in dois]
+
+    assert set(shards) == {0, 1, 2, 3}
+    assert getShard("doi:10.18419/darus-7", 4) == getShard("https://doi.org/10.18419/DARUS-7", 4) == shards[7]
+    assert parseShard("2/4") == (1, 4)
+    with pytest.raises(ValueError):
+        parseShard("5/4")
+
+
+def test_mergeOrdersByListingPosition(tmp_path):
+    directory = str(tmp_path / "shards")
+    writeShard(directory, 0, [[0, "doi:a", "new", "@misc{a}\n"], [3, "doi:d", "changed", "d changed\n"]])
+    writeShard(directory, 1, [[1, "doi:b", "changed", "b changed\n"], [2, "doi:c", "new", ""],
+                              [4, "doi:e", "new", "@misc{e}\n"]])
+
+    files, startedAt = mergeShards("ibc", 2, directory, str(tmp_path))
+
+    assert [f[len(str(tmp_path)) + 1:] for f in files] == ["2024-01-08_ibc_export.bib", "2024-01-08_ibc_changes.txt"]
+    assert open(files[0], encoding="utf_8").read() == "@misc{a}\n@misc{e}\n"
+    assert open(files[1], encoding="utf_8").read() == "b changed\nd changed\n"
+
+
+def test_mergeRefusesIncompleteOrMixedShards(tmp_path):
+    directory = str(tmp_path / "shards")
+    writeShard(directory, 0, [], since="2024-01-01T10:00:00")
+    with pytest.raises(ValueError, match="missing"):
+        mergeShards("ibc", 2, directory, str(tmp_path))
+    writeShard(directory, 1, [])
+    with pytest.raises(ValueError, match="watermarks"):
+        mergeShards("ibc", 2, directory, str(tmp_path))
+
+
+def test_concurrentWritersOfOneFile(tmp_path):
+    # every writer needs its own temporary file, or one renames the file another is still writing
+    path = str(tmp_path / "output" / "pumaSnapshot.json")
+
+    def write(i):
+        for _ in range(50):
+            writeJsonAtomic(path, {"writer": i, "posts": list(range(1000))})
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(write, range(8)))
+
+    with open(path, encoding="utf_8") as snapshotFile:
+        assert json.load(snapshotFile)["posts"] == list(range(1000))
+    assert os.listdir(str(tmp_path / "output")) == ["pumaSnapshot.json"]
+
+
+def test_writtenFilesFollowTheUmask(tmp_path):
+    path = str(tmp_path / "state.json")
+    umask = os.umask(0o027)
+    try:
+        writeJsonAtomic(path, {})
+    finally:
+        os.umask(umask)
+
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+
+def genDataset(ds):
+    return {"persistentUrl": "https://doi.org/" + ds[4:], "protocol": "doi", "authority": "10.18419",
+            "identifier": ds[13:], "publicationDate": "2021-03-04",
+            "latestVersion": {"versionState": "RELEASED", "versionNumber": 1, "versionMinorNumber": 0,
+                              "metadataBlocks": {"citation": {"fields": [
+                                  {"typeName": "title", "value": "Title " + ds},
+                                  {"typeName": "author", "value": [{"authorName": {"value": "Test, Testine"},
+                                                                    "authorAffiliation": {
+                                                                        "value": "Universität Stuttgart"}}]}]}}}}
+
+
+def callDarusAPI(self, url, **kwargs):
+    if "api/search" in url:
+        return {"total_count": len(DATASETS),
+                "items": [{"global_id": ds, "identifier_of_dataverse": "ibc"} for ds in DATASETS]}
+    # the fetches finish in another order than they were started
+    time.sleep(random.random() * 0.01)
+    return genDataset(url[url.index("persistentId=") + len("persistentId="):])
+
+
+def test_mergedShardsEqualSingleProcessExport(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    credentials = {"darus": {"apiBaseUrl": "http://localhost/", "bulkMetadata": False},
+                   "puma": {"mailer": "False", "baseUrl": "http://localhost/api/",
+                            "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib")},
+                   "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None, "workers": 4,
+                              "stateFile": "output/state.json", "checkpointDir": "output/checkpoints",
+                              "shardDir": "output/shards"}}
+    tree = DataverseTree()
+    tree.add({"identifier": "ibc", "parentDataverseIdentifier": "darus", "name": "ibc",
+              "published_at": "2021-01-01T10:00:00Z", "type": "dataverse"})
+    # every third dataset is in PUMA with another title
+    p_datasets = {ds[4:]: PumaRecord.fromPost({"bibtex": {"intrahash": "{:032x}".format(i), "title": "Old title",
+                                                          "misc": "doi = {" + ds[4:] + "}"},
+                                               "user": {"name": "unibiblio"}})
+                  for i, ds in enumerate(DATASETS) if i % 3 == 0}
+    mocker.patch.object(Exporter, "callDarusAPI", callDarusAPI)
+    mocker.patch.object(Exporter, "randomString", return_value="abcdefgh")
+    mocker.patch.object(Exporter, "getDataverseTree", return_value=tree)
+    mocker.patch.object(Exporter, "getAllDatasetsFromUniBiblio", return_value=p_datasets)
+
+    exporter = Exporter(credentials)
+    expected = []
+    for path in exporter.writeExportFiles(exporter.iterDatasetsByDataverse("ibc"), p_datasets, "ibc"):
+        with open(path, "rb") as exported:
+            expected.append(exported.read())
+        os.remove(path)
+    for shard in range(3):
+        exportShards(credentials, ["ibc"], shard, 3, full=True)
+    files = mergeDataverses(Exporter(credentials), ["ibc"], 3)
+
+    assert [os.path.basename(path).split("_", 1)[1] for path in files] == ["ibc_export.bib", "ibc_changes.txt"]
+    assert expected[0].count(b"@misc") == 20 and expected[1].count(b"Unibibliolink") == 10
+    for path, content in zip(files, expected):
+        with open(path, "rb") as merged:
+            assert merged.read() == content
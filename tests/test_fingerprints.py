@@ -0,0 +1,66 @@
+import copy
+
+from fingerprints import FingerprintStore, fingerprint
+from pumaExport import Exporter
+from records import DarusRecord
+
+DARUS_DS = DarusRecord.fromDict({"authors": ["Stegmüller, Michael", "Iglezakis, Dorothea"], "authorOrcids": ["Stegmüller, Michael/0000-0000-0000-0001"],
+            "authorAffiliation": ["Stegmüller, Michael/Universität Stuttgart", "Iglezakis, Dorothea/Universität Stuttgart"],
+            "datasetTitle": "Testtitel", "datasetSubTitle": "", "howpublished": "Dataset", "year": "2021",
+            "doi": "10.18419/DARUS-452", "relatedPub": ""})
+PUMA_POST = {
+    "bibtex": {"intrahash": "abc", "title": "{Testtitel}", "author": "Stegmüller, Michael and Iglezakis, Dorothea",
+               "howpublished": "Dataset", "year": "2021", "note": "",
+               "misc": "  affiliation = {Stegmüller, Michael/Universität Stuttgart, Iglezakis, Dorothea/Universität Stuttgart},\n"
+                       "  doi = {10.18419/DARUS-452},\n  orcid-numbers = {Stegmüller, Michael/0000-0000-0000-0001}"},
+    "user": {"name": "unibiblio"}, "tag": [{"name": "darus"}]}
+PUMA_DS = Exporter.genDatasetFromPost(PUMA_POST)
+
+
+def genExporter(path=None):
+    return Exporter({"puma": {"baseUrl": "http://localhost/api/"},
+                     "export": {"cacheFile": None, "fingerprintFile": path}})
+
+
+def test_fingerprintsMatchExactlyWhenThereAreNoChanges():
+    exporter = genExporter()
+    assert exporter.getChanges(DARUS_DS, PUMA_DS) == []
+    assert fingerprint(exporter.getDarusComparison(DARUS_DS)) == fingerprint(exporter.getPumaComparison(PUMA_DS))
+
+    changed = DarusRecord.fromDict(dict(DARUS_DS.toDict(), datasetSubTitle="Teil 2"))
+    assert fingerprint(exporter.getDarusComparison(changed)) != fingerprint(exporter.getPumaComparison(PUMA_DS))
+    assert exporter.getChanges(changed, PUMA_DS)[0].startswith("Geändertes Feld: Titel")
+
+
+def test_exportEntrySkipsUnchangedDatasetWithoutFetching(mocker, tmp_path):
+    path = str(tmp_path / "fingerprints.json")
+    exporter = genExporter(path)
+    exporter.datasetVersions["doi:10.18419/darus-452"] = "1.0@2021-03-04T10:00:00Z"
+    getDarusSet = mocker.patch.object(exporter, "getDarusSet", side_effect=lambda ds: DARUS_DS)
+
+    assert exporter.getExportEntry("doi:10.18419/darus-452", {"10.18419/darus-452": PUMA_DS}) == (None, "")
+    assert getDarusSet.call_count == 1
+    exporter.fingerprints.save()
+
+    exporter = genExporter(path)
+    exporter.datasetVersions["doi:10.18419/darus-452"] = "1.0@2021-03-04T10:00:00Z"
+    getDarusSet = mocker.patch.object(exporter, "getDarusSet")
+    assert exporter.getExportEntry("doi:10.18419/darus-452", {"10.18419/darus-452": PUMA_DS}) == (None, "")
+    assert getDarusSet.call_count == 0
+
+    changedPost = copy.deepcopy(PUMA_POST)
+    changedPost["bibtex"]["year"] = "2020"
+    getDarusSet.side_effect = lambda ds: DARUS_DS
+    status, text = exporter.getExportEntry("doi:10.18419/darus-452", {"10.18419/darus-452": Exporter.genDatasetFromPost(changedPost)})
+    assert status == "changed" and "Geändertes Feld: year" in text
+    assert exporter.fingerprints.stats() == {"unchanged": 1, "compared": 1, "size": 1}
+
+
+def test_storeIgnoresOtherVersions(tmp_path):
+    store = FingerprintStore(str(tmp_path / "fingerprints.json"))
+    store.put("doi:1", "1.0@a", "f1")
+    store.put("doi:2", None, "f2")
+
+    assert store.get("doi:1", "1.0@a") == "f1"
+    assert store.get("doi:1", "1.1@b") is None
+    assert store.get("doi:2", None) is None
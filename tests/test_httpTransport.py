@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from httpTransport import AdaptiveLimiter
+from pumaExport import Exporter
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    calls = 0
+
+    def do_GET(self):
+        FlakyHandler.calls += 1
+        if FlakyHandler.calls == 2:
+            self.send_response(503)
+            body = b"busy"
+        else:
+            self.send_response(200)
+            body = json.dumps({"status": "OK", "data": {"call": FlakyHandler.calls}}).encode()
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def flakyServer():
+    FlakyHandler.calls = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(server.server_port)
+    server.shutdown()
+
+
+def test_callDarusApiRetriesAndReusesConnection(flakyServer):
+    exporter = Exporter({"darus": {"apiKey": "test", "backoff": 0.01}})
+    results = [exporter.callDarusAPI(flakyServer + "api/info") for _ in range(3)]
+
+    assert [r["call"] for r in results] == [1, 3, 4]
+    stats = exporter.getTransportStats()["darus"]
+    assert stats["requests"] == 4
+    assert stats["connections"] == 1
+    assert stats["reused"] == 3
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    calls = []
+
+    def do_GET(self):
+        ThrottlingHandler.calls.append(time.monotonic())
+        if len(ThrottlingHandler.calls) == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            body = b"slow down"
+        else:
+            self.send_response(200)
+            body = json.dumps({"status": "OK", "data": {}}).encode()
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_adaptiveLimiterIncreasesAdditivelyAndHalvesOncePerRound():
+    limiter = AdaptiveLimiter("darus", initial=4, maximum=8)
+    for _ in range(8):
+        limiter.release(limiter.acquire(), "search", 0.1)
+    assert int(limiter.limit) == 5
+
+    starts = [limiter.acquire() for _ in range(3)]
+    for start in starts:
+        limiter.release(start, "search", congestion="503")
+    assert int(limiter.limit) == 2
+    limiter.release(limiter.acquire(), "search", congestion="timeout")
+    assert int(limiter.limit) == 1
+
+    limiter.release(limiter.acquire(), "search", 1.0)
+    assert int(limiter.limit) == 1
+
+
+def test_retryAfterPausesBackend():
+    ThrottlingHandler.calls = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    exporter = Exporter({"darus": {"apiKey": "test", "backoff": 0.01, "initialConcurrency": 4}})
+    try:
+        exporter.callDarusAPI("http://127.0.0.1:{}/api/info".format(server.server_port))
+    finally:
+        server.shutdown()
+
+    assert ThrottlingHandler.calls[1] - ThrottlingHandler.calls[0] >= 0.9
+    assert exporter.getTransportStats()["darus"]["concurrencyLimit"] == 2
+    assert [change["reason"] for change in exporter.metrics.summary()["concurrencyLimits"]["darus"]] == ["initial", "429"]
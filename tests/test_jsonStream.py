@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from jsonStream import JsonArrayStream
+
+PAGE = {"stat": "ok", "posts": {"start": 0, "end": 3,
+                                "post": [{"id": i, "title": "Über ] [ {" * i} for i in range(3)]}}
+
+
+@pytest.mark.parametrize("size", [1, 3, 17, 100000])
+def test_streamYieldsItemsForAnyChunking(size):
+    raw = json.dumps(PAGE, ensure_ascii=False).encode("utf_8")
+    stream = JsonArrayStream([raw[i:i + size] for i in range(0, len(raw), size)], "post")
+
+    assert list(stream) == PAGE["posts"]["post"]
+    assert stream.document == {"stat": "ok", "posts": {"start": 0, "end": 3, "post": []}}
+
+
+def test_streamWithoutArrayDecodesDocument():
+    stream = JsonArrayStream([b'{"stat": "ok", "posts": {"start": 100, "end": 200}}'], "post")
+
+    assert list(stream) == []
+    assert stream.document["posts"] == {"start": 100, "end": 200}
+
+
+def test_truncatedStreamRaises():
+    with pytest.raises(ValueError):
+        list(JsonArrayStream([b'{"stat": "ok", "posts": {"post": [{"id": 1}, {"id"'], "post"))
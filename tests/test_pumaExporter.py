@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+
+from pumaExport import Exporter
+from pumaExporter import getArgumentParser, main
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET = {"persistentUrl": "https://doi.org/10.18419/darus-452", "protocol": "doi", "authority": "10.18419",
+           "identifier": "DARUS-452", "publicationDate": "2021-03-04",
+           "latestVersion": {"versionState": "RELEASED", "versionNumber": 1, "versionMinorNumber": 0, "metadataBlocks": {
+               "citation": {"fields": [{"typeName": "title", "value": "Testtitel"},
+                                       {"typeName": "author", "value": [
+                                           {"authorName": {"value": "Test, Testine"},
+                                            "authorAffiliation": {"value": "Universität Stuttgart"}}]}]}}}}
+
+
+def test_importDoesNotLoadHttpOrMail():
+    code = "import sys, pumaExporter, pumaExport; print(sorted({'requests', 'smtplib', 'email.mime.multipart'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
+
+
+def test_argumentsWithoutCommandExport(mocker, tmp_path):
+    credentials = tmp_path / "credentials.json"
+    credentials.write_text(json.dumps({"puma": {}, "export": {"cacheFile": None}}))
+    exportMany = mocker.patch("pumaExporter.pumaExportMany", return_value={"message": "ok"})
+    mocker.patch("logging.basicConfig")
+
+    assert main(["--full", "ibc", "--credentials", str(credentials)]) == 0
+    assert exportMany.call_args.args[0] == ["ibc"]
+    assert exportMany.call_args.kwargs["full"] is True
+    assert getArgumentParser().parse_args(["diff", "--all"]).all is True
+
+
+def test_renderWritesOnlyTheEntryToStdout(mocker, tmp_path, capsys):
+    credentials = tmp_path / "credentials.json"
+    credentials.write_text(json.dumps({"darus": {"apiBaseUrl": "http://localhost/"},
+                                       "puma": {"user": "darus", "bibTexTemplate": os.path.join(REPO, "tpl_puma.bib"),
+                                                "jsonTemplate": os.path.join(REPO, "tpl_puma.txt")}}))
+
+    def callDarusAPI(self, url, **kwargs):
+        print("fetching", url)
+        return DATASET
+
+    mocker.patch.object(Exporter, "callDarusAPI", callDarusAPI)
+
+    assert main(["render", "doi:10.18419/darus-452", "--credentials", str(credentials)]) == 0
+    out, err = capsys.readouterr()
+    assert out.startswith("@misc{,\n  author = {Test, Testine},")
+    assert "fetching" in err
+    assert main(["render", "doi:10.18419/darus-452", "--format", "post", "--credentials", str(credentials)]) == 0
+    assert json.loads(capsys.readouterr().out)["post"]["bibtex"]["title"] == "Testtitel"
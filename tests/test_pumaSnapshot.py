@@ -0,0 +1,111 @@
+from pumaExport import Exporter
+from pumaSnapshot import DoiIndex, PumaSnapshot, compactPost
+from records import PumaRecord
+
+
+def genPost(intrahash, doi, postingdate="2021-01-01 10:00:00"):
+    return {"bibtex": {"intrahash": intrahash, "misc": "  affiliation = {University of Stuttgart},\n  doi = {" + doi + "}"},
+            "user": {"name": "unibiblio"}, "tag": [{"name": "darus"}], "postingdate": postingdate}
+
+
+def test_doiIndexNormalizesAndFindsDuplicates():
+    index = DoiIndex([genPost("a", "10.18419/DARUS-1"), genPost("b", "10.18419/darus-2"),
+                      genPost("c", "10.18419/darus-1"), {"bibtex": {"intrahash": "d"}}])
+
+    assert [p["bibtex"]["intrahash"] for p in index.get("doi:10.18419/darus-1")] == ["a", "c"]
+    assert list(index.duplicates().keys()) == ["10.18419/darus-1"]
+    assert len(index.invalid) == 1
+    found = index.lookupMany(["10.18419/DARUS-2", "10.18419/darus-3"])
+    assert len(found["10.18419/DARUS-2"]) == 1
+    assert found["10.18419/darus-3"] == []
+
+
+def test_doiIndexReplacesPostWithSameIntrahash():
+    index = DoiIndex([genPost("a", "10.18419/darus-1")])
+    index.add(genPost("a", "10.18419/darus-1", "2022-01-01 10:00:00"))
+
+    assert index.get("10.18419/darus-1")[0]["postingdate"] == "2022-01-01 10:00:00"
+    assert index.duplicates() == {}
+
+
+def test_snapshotRoundTrip(tmp_path):
+    path = str(tmp_path / "snapshot.json")
+    snapshot = PumaSnapshot(path)
+    snapshot.add(genPost("a", "10.18419/darus-1"))
+    snapshot.add(genPost("b", "10.18419/darus-1", "2022-01-01 10:00:00"))
+    snapshot.markRefreshed("2022-01-01 10:00:00", full=True)
+    snapshot.save()
+
+    reloaded = PumaSnapshot(path)
+    assert len(reloaded) == 2
+    assert reloaded.highWaterMark == "2022-01-01 10:00:00"
+    assert reloaded.getByDOI("10.18419/DARUS-1")["bibtex"]["intrahash"] == "b"
+    assert not reloaded.needsFullRefresh(28)
+
+
+def test_compactPostKeepsExportedFields():
+    post = genPost("a", "10.18419/darus-1")
+    post["bibtex"]["documents"] = [{"fileName": "data.pdf"}]
+    post["user"]["realname"] = "Uni Bibliographie"
+    post["groups"] = [{"name": "public"}]
+    compact = compactPost(post)
+
+    assert compact == {"bibtex": {"intrahash": "a", "misc": post["bibtex"]["misc"]}, "user": {"name": "unibiblio"},
+                       "tag": [{"name": "darus"}], "postingdate": "2021-01-01 10:00:00"}
+    assert compactPost(compact) == compact
+
+
+def test_newestPostPerDOI():
+    snapshot = PumaSnapshot()
+    newest = dict(genPost("b", "10.18419/darus-1", "2021-01-01 10:00:00"), changedate="2023-05-01 10:00:00")
+    for post in [newest, genPost("a", "10.18419/DARUS-1", "2022-01-01 10:00:00"),
+                 genPost("c", "10.18419/darus-2", "2020-01-01 10:00:00")]:
+        snapshot.add(post)
+
+    # the changedate of a corrected post counts, not the order the posts were added in
+    assert snapshot.getByDOI("doi:10.18419/darus-1")["bibtex"]["intrahash"] == "b"
+    assert {doi: post["bibtex"]["intrahash"] for doi, post in snapshot.iterByDOI()} == {
+        "10.18419/darus-1": "b", "10.18419/darus-2": "c"}
+    assert snapshot.getByDOI("10.18419/darus-3") is None
+
+
+def test_incrementalRefreshOnlyPullsPostsAfterTheHighWaterMark(mocker, tmp_path):
+    path = str(tmp_path / "snapshot.json")
+    snapshot = PumaSnapshot(path)
+    snapshot.add(genPost("a", "10.18419/darus-1", "2022-01-01 10:00:00"))
+    snapshot.markRefreshed("2022-01-01 10:00:00", full=True)
+    snapshot.save()
+    # PUMA lists the newest posts first; the second page is never needed
+    known = genPost("a", "10.18419/darus-1", "2022-01-01 10:00:00")
+    known["bibtex"]["title"] = "not read"
+    pages = [[genPost("c", "10.18419/darus-3", "2022-03-01 10:00:00"),
+              genPost("b", "10.18419/darus-2", "2022-02-01 10:00:00"), known],
+             [genPost("z", "10.18419/darus-26", "2021-01-01 10:00:00")]]
+    exporter = Exporter({"puma": {"snapshotFile": path, "snapshotIncremental": True},
+                         "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None}})
+    pulled = []
+
+    def iterPages(search=None, start=0):
+        for page in pages:
+            pulled.append(page)
+            yield page
+
+    mocker.patch.object(exporter, "iterUniBiblioPages", side_effect=iterPages)
+    snapshot = exporter.refreshPumaSnapshot()
+
+    assert pulled == pages[:1]
+    assert sorted(snapshot.posts) == ["a", "b", "c"]
+    assert "title" not in snapshot.getByIntrahash("a")["bibtex"]
+    assert snapshot.highWaterMark == "2022-03-01 10:00:00"
+    assert PumaSnapshot(path).highWaterMark == "2022-03-01 10:00:00"
+
+
+def test_doiIndexReadsMiscLikePumaRecord():
+    posts = [{"bibtex": {"intrahash": "a", "misc": '  note = {see doi = {10.1000/other}},\n  DOI = "10.18419/darus-5"'},
+              "user": {"name": "unibiblio"}},
+             {"bibtex": {"intrahash": "b", "misc": "  doi = {10.18419/{DARUS}-6}"}, "user": {"name": "unibiblio"}}]
+    index = DoiIndex(posts)
+
+    assert sorted(index.entries) == ["10.18419/darus-5", "10.18419/{darus}-6"]
+    for post in posts:
+        assert index.get(PumaRecord.fromPost(post).doi) == [post]
@@ -0,0 +1,86 @@
+import os
+import time
+
+from exporterExceptions import ApiCallFailedException
+from httpTransport import RateLimiter
+from pumaExport import Exporter
+from pumaUploader import PumaUploader, UploadLedger
+from records import DarusRecord
+
+PAYLOAD = {"main": ("", "{}", "application/json"), "bibtex": ("", "@misc{}", "text/bibtex")}
+
+
+def genExporter():
+    return Exporter({"puma": {"baseUrl": "http://localhost/api/", "user": "darus", "apiKey": "key", "uploadRate": 0,
+                              "uploadWorkers": 3}, "export": {"cacheFile": None}})
+
+
+def test_uploadSkipsKnownDoisAndReportsFailures(mocker, tmp_path):
+    exporter = genExporter()
+    ledger = UploadLedger(str(tmp_path / "uploads.json"))
+    ledger.markUploaded("doi:10.18419/darus-2", "hash2")
+
+    def callPumaAPI(url, data, expectedCode=201, method="post"):
+        assert url == "http://localhost/api/users/darus/posts" and method == "multipart"
+        if data is FAILING:
+            raise ApiCallFailedException("PUMA-Call failed: 500")
+        return {"stat": "ok", "resourcehash": "hash"}
+
+    FAILING = dict(PAYLOAD)
+    mocker.patch.object(exporter, "getPUMAExport",
+                        side_effect=lambda doi: FAILING if doi.endswith("-4") else PAYLOAD)
+    post = mocker.patch.object(exporter, "callPumaAPI", side_effect=callPumaAPI)
+    uploader = PumaUploader(exporter, ledger)
+
+    dois = ["doi:10.18419/darus-{}".format(i) for i in range(1, 5)] + ["doi:10.18419/DARUS-3"]
+    report = uploader.upload(dois, {"10.18419/darus-1": {}})
+
+    assert [(entry["doi"], entry["status"]) for entry in report] == [
+        ("doi:10.18419/darus-1", "skipped"), ("doi:10.18419/darus-2", "skipped"),
+        ("doi:10.18419/darus-3", "uploaded"), ("doi:10.18419/darus-4", "failed")]
+    assert post.call_count == 2
+    assert uploader.summarize(report) == {"uploaded": 1, "skipped": 2, "failed": 1}
+
+    reloaded = UploadLedger(str(tmp_path / "uploads.json"))
+    assert "doi:10.18419/darus-3" in reloaded
+    assert reloaded.getFailed() == ["doi:10.18419/darus-4"]
+
+
+def test_retryFailedClearsUploadsFoundInPuma(mocker, tmp_path):
+    exporter = genExporter()
+    ledger = UploadLedger(str(tmp_path / "uploads.json"))
+    ledger.markFailed("doi:10.18419/darus-4", "timeout")
+    mocker.patch.object(exporter, "getPUMAExport", return_value=PAYLOAD)
+    post = mocker.patch.object(exporter, "callPumaAPI")
+
+    report = PumaUploader(exporter, ledger).retryFailed({"10.18419/darus-4": {}})
+
+    assert report[0]["status"] == "skipped"
+    assert post.call_count == 0
+    assert ledger.getFailed() == []
+
+
+def test_uploadSkipsDatasetsLeftOutOfTheExport(mocker, tmp_path):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    exporter = Exporter({"puma": {"baseUrl": "http://localhost/api/", "user": "darus", "apiKey": "key", "uploadRate": 0,
+                                  "bibTexTemplate": os.path.join(repo, "tpl_puma.bib"),
+                                  "jsonTemplate": os.path.join(repo, "tpl_puma.txt")}, "export": {"cacheFile": None}})
+    records = {"doi:10.18419/darus-1": DarusRecord(doi="10.18419/darus-1", affiliation=["TU Munich"]),
+               "doi:10.18419/darus-2": DarusRecord(doi="10.18419/darus-2", affiliation=["University of Stuttgart"])}
+    mocker.patch.object(exporter, "getDarusSet", side_effect=records.get)
+    post = mocker.patch.object(exporter, "callPumaAPI", return_value={"stat": "ok", "resourcehash": "hash"})
+
+    report = PumaUploader(exporter, UploadLedger(str(tmp_path / "uploads.json"))).upload(list(records), {})
+
+    assert exporter.genBibTex("doi:10.18419/darus-1") == ""
+    assert [(entry["doi"], entry["status"]) for entry in report] == [
+        ("doi:10.18419/darus-1", "skipped"), ("doi:10.18419/darus-2", "uploaded")]
+    assert post.call_count == 1
+
+
+def test_rateLimiterSpacesRequests():
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
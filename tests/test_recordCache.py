@@ -0,0 +1,39 @@
+from pumaExport import Exporter
+from recordCache import RecordCache
+from records import DarusRecord
+
+
+def test_versionMismatchIsMiss(tmp_path):
+    cache = RecordCache(str(tmp_path / "cache.json"))
+    cache.put("doi:10.18419/darus-1", "1.0@2021-01-01", {"authors": ["Test, Testine"]})
+
+    assert cache.get("doi:10.18419/darus-1", "1.1@2021-02-01") is None
+    assert cache.get("doi:10.18419/darus-1", "1.0@2021-01-01") == {"authors": ["Test, Testine"]}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_recordsFromTheCacheDoNotChangeIt(tmp_path):
+    cache = RecordCache(str(tmp_path / "cache.json"))
+    cache.put("doi:10.18419/darus-1", "1.0", DarusRecord(doi="10.18419/darus-1", authors=["Testine"]).toDict())
+    record = DarusRecord.fromDict(cache.get("doi:10.18419/darus-1", "1.0"))
+
+    assert Exporter.joinAuthors(list(record.authors)) == "{Testine}"
+    assert record.authors == ("Testine",)
+    assert cache.get("doi:10.18419/darus-1", "1.0")["authors"] == ["Testine"]
+
+
+def test_leastRecentlyUsedIsEvictedAndSaved(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = RecordCache(path, maxEntries=2)
+    cache.put("a", "1.0", {})
+    cache.put("b", "1.0", {})
+    cache.get("a", "1.0")
+    cache.put("c", "1.0", {})
+    cache.save()
+
+    reloaded = RecordCache(path, maxEntries=2)
+    assert reloaded.get("b", "1.0") is None
+    assert reloaded.get("a", "1.0") == {}
+    assert reloaded.get("c", "1.0") == {}
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,26 @@
+from runMetrics import RunMetrics, getEndpoint
+
+
+def test_getEndpoint():
+    assert getEndpoint("https://darus.uni-stuttgart.de/api/search?q=*&start=100") == "search"
+    assert getEndpoint("http://localhost:8080/api/datasets/:persistentId/?persistentId=doi:10.18419/darus-1") == \
+           "datasets/:persistentId"
+    assert getEndpoint("http://localhost:8080//api/dataverses/1234") == "dataverses"
+    assert getEndpoint("https://puma.ub.uni-stuttgart.de/api/posts?user=unibiblio") == "posts"
+
+
+def test_prometheusHistogramIsCumulative():
+    metrics = RunMetrics()
+    metrics.recordRequest("darus", "http://localhost/api/search", 0.07, 100, False)
+    metrics.recordRequest("darus", "http://localhost/api/search", 3.0, 50, True)
+    metrics.recordRetry("darus", "/api/search?q=*")
+    metrics.addStageTime("listing", 1.5)
+    text = metrics.toPrometheus()
+
+    assert 'pumaexport_http_requests_total{backend="darus",endpoint="search"} 2' in text
+    assert 'pumaexport_http_failures_total{backend="darus",endpoint="search"} 1' in text
+    assert 'pumaexport_http_retries_total{backend="darus",endpoint="search"} 1' in text
+    assert 'pumaexport_http_request_duration_seconds_bucket{backend="darus",endpoint="search",le="0.1"} 1' in text
+    assert 'pumaexport_http_request_duration_seconds_bucket{backend="darus",endpoint="search",le="5.0"} 2' in text
+    assert 'pumaexport_stage_duration_seconds{stage="listing"} 1.5' in text
+    assert metrics.summary()["endpoints"]["darus:search"]["responseBytes"] == 150
@@ -0,0 +1,36 @@
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from runProfiler import DatasetTimings, RunProfiler
+
+
+def slowDataset(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_datasetTimingsRankFetchAndProcessing():
+    timings = DatasetTimings()
+    timings.add("doi:10.18419/darus-1", "fetch", 2.0)
+    timings.add("doi:10.18419/darus-1", "total", 2.5)
+    timings.add("doi:10.18419/darus-2", "total", 1.0)
+
+    assert sorted(timings.rows()) == [("doi:10.18419/darus-1", 2.0, 0.5, 2.5), ("doi:10.18419/darus-2", 0.0, 1.0, 1.0)]
+    byFetch, byProcessing = timings.format().split("\n\n")[:2]
+    assert byFetch.splitlines()[2].startswith("doi:10.18419/darus-1 ")
+    assert byProcessing.splitlines()[2].startswith("doi:10.18419/darus-2 ")
+
+
+def test_profilerCoversWorkerThreads(tmp_path):
+    with RunProfiler(str(tmp_path), interval=0.001) as profiler:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(slowDataset, [0.05, 0.05]))
+    files = profiler.write(timings=DatasetTimings())
+
+    assert [f[len(str(tmp_path)) + 1:] for f in files] == ["pumaexport.pstats", "pumaexport.collapsed", "datasets.tsv",
+                                                            "profile.txt"]
+    functions = {function for (_, _, function) in pstats.Stats(files[0]).stats}
+    assert "slowDataset" in functions
+    collapsed = (tmp_path / "pumaexport.collapsed").read_text()
+    assert "test_runProfiler.slowDataset" in collapsed
@@ -0,0 +1,67 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from dataverseTree import DataverseTree
+from exporterExceptions import ApiCallFailedException
+from pumaExport import Exporter
+
+TOTAL = 250
+
+
+def searchPage(url, **kwargs):
+    start = int(re.search(r"start=(\d+)", url).group(1))
+    if "fail" in url and start == 200:
+        raise ApiCallFailedException("DaRUS-Call of {} failed".format(url))
+    items = [{"global_id": "doi:10.18419/darus-{}".format(i), "identifier_of_dataverse": "ibc"} for i in
+             range(start, min(start + 100, TOTAL))]
+    if start == 100:
+        # the index shifted between two page requests
+        items.insert(0, {"global_id": "doi:10.18419/darus-99", "identifier_of_dataverse": "ibc"})
+    return {"total_count": TOTAL, "items": items}
+
+
+def test_searchDarusKeepsOrderAndDedupes(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/", "pageWorkers": 3}, "export": {"cacheFile": None}})
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=searchPage)
+
+    datasets = exporter.getDatasets("", ["ibc"])
+
+    assert datasets == ["doi:10.18419/darus-{}".format(i) for i in range(TOTAL)]
+
+
+def test_failedPageRaisesAfterEarlierPages(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"}, "export": {"cacheFile": None}})
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=searchPage)
+    listed = []
+
+    with pytest.raises(ApiCallFailedException):
+        listed.extend(exporter.iterDatasets("&fail", ["ibc"]))
+    assert len(listed) == 200
+
+
+def test_dateFilterStartsOnTheUtcDayOfTheWatermark():
+    # a run started at 00:30 in Stuttgart started on the day before in UTC
+    since = datetime(2024, 1, 8, 0, 30, tzinfo=timezone(timedelta(hours=1)))
+
+    assert Exporter.getDateFilter(since).startswith("&fq=dateSort:[2024-01-07T00:00:00Z+TO+")
+
+
+def test_dataverseListingSinceCombinesSubtreeAndDateFilter(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/", "bulkMetadata": False},
+                         "export": {"cacheFile": None}})
+    tree = DataverseTree()
+    tree.add({"identifier": "ibc", "parentDataverseIdentifier": "darus", "entity_id": 5, "name": "ibc",
+              "published_at": "2021-01-01T10:00:00Z", "type": "dataverse"})
+    exporter.dataverseTree = tree
+    exporter.dataverseTreeRefreshed = True
+    call = mocker.patch.object(exporter, "callDarusAPI", side_effect=searchPage)
+
+    datasets = exporter.getDatasetsByDataverse("ibc", datetime(2024, 1, 8, 10, tzinfo=timezone.utc))
+
+    assert len(datasets) == TOTAL
+    for url in [c.args[0] for c in call.call_args_list]:
+        assert "&subtree=ibc&fq=dateSort:[2024-01-08T00:00:00Z+TO+" in url
+        # checkpoints resume the listing at an offset, which needs a stable order
+        assert "&sort=date&order=asc" in url
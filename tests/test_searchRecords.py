@@ -0,0 +1,114 @@
+import copy
+import json
+import os
+
+from dataverseTree import DataverseTree
+from fingerprints import fingerprint
+from pumaExport import Exporter
+from pumaExporter import pumaExportMany
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "fixtures")
+
+
+def loadFixture(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf_8") as fixture:
+        return json.load(fixture)
+
+
+def genSearchItem():
+    item = loadFixture("searchDataset.json")
+    item["metadataBlocks"] = loadFixture("dataset.json")["data"]["latestVersion"]["metadataBlocks"]
+    return item
+
+
+def test_searchRecordParsesLikeDatasetResponse():
+    exporter = Exporter({"export": {"cacheFile": None}})
+    pid = "doi:10.18419/darus-452"
+
+    fromSearch = exporter.parseDarusSet(exporter.getSearchRecord(genSearchItem()), pid)
+
+    assert fromSearch == exporter.parseDarusSet(loadFixture("dataset.json")["data"], pid)
+    assert fromSearch.doi == "10.18419/DARUS-452"
+
+
+def test_incompleteSearchItemsFallBack():
+    item = genSearchItem()
+    assert Exporter.getSearchRecord(dict(item, metadataBlocks={})) is None
+    assert Exporter.getSearchRecord(dict(item, citation='Stegmüller, Michael, "Title"')) is None
+    assert Exporter.getSearchRecord({k: v for k, v in item.items() if k != "storageIdentifier"}) is None
+
+
+def test_listingWithMetadataSkipsDatasetCalls(mocker):
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"}, "export": {"cacheFile": None}})
+    items = [genSearchItem(), dict(genSearchItem(), global_id="doi:10.18419/darus-453", metadataBlocks={})]
+    dataset = copy.deepcopy(loadFixture("dataset.json")["data"])
+    urls = []
+
+    def callDarusAPI(url, **kwargs):
+        urls.append(url)
+        return {"total_count": 2, "items": items} if "api/search" in url else dataset
+
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=callDarusAPI)
+
+    assert exporter.getDatasets("", []) == ["doi:10.18419/darus-452", "doi:10.18419/darus-453"]
+    assert "&metadata_fields=citation:*&metadata_fields=codeMeta20:*" in urls[0]
+    assert exporter.getDarusSet("doi:10.18419/darus-452").datasetTitle == exporter.getDarusSet(
+        "doi:10.18419/darus-453").datasetTitle
+    assert [url for url in urls if "persistentId" in url] == [
+        "http://localhost/api/datasets/:persistentId/?persistentId=doi:10.18419/darus-453"]
+
+
+def test_searchRecordsAreParsedOnDemandAndReleased(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"},
+                         "puma": {"bibTexTemplate": os.path.join(FIXTURES, "..", "..", "tpl_puma.bib")},
+                         "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None,
+                                    "checkpointDir": str(tmp_path / "checkpoints")}})
+    items = [genSearchItem(), dict(genSearchItem(), global_id="doi:10.18419/darus-453", metadataBlocks={})]
+    dataset = copy.deepcopy(loadFixture("dataset.json")["data"])
+    mocker.patch.object(exporter, "callDarusAPI",
+                        side_effect=lambda url, **kwargs: {"total_count": 2, "items": items} if "api/search" in url
+                        else dataset)
+    # darus-452 is in PUMA and unchanged, darus-453 is new
+    mocker.patch.object(exporter, "getPumaComparison", return_value=[])
+    mocker.patch.object(exporter, "getDarusFingerprint", return_value=fingerprint([]))
+    parse = mocker.spy(exporter, "parseDarusSet")
+
+    exporter.writeExportFiles(exporter.iterDatasets("", []), {"10.18419/darus-452": None}, "ibc")
+
+    assert [call.args[1] for call in parse.call_args_list] == ["doi:10.18419/darus-453"]
+    assert exporter.runRecords == {} and exporter.searchRecords == {} and exporter.runRecordUses == {}
+
+
+def test_datasetInSeveralExportedSubtreesIsFetchedOnce(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/", "bulkMetadata": False},
+                         "puma": {"mailer": "False", "bibTexTemplate": os.path.join(FIXTURES, "..", "..", "tpl_puma.bib")},
+                         "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None,
+                                    "stateFile": "output/state.json", "checkpointDir": str(tmp_path / "checkpoints"),
+                                    "workers": 2}})
+    exporter.dataverseTree = DataverseTree()
+    for alias, parent in [("darus", None), ("ibc", "darus")]:
+        exporter.dataverseTree.add({"identifier": alias, "parentDataverseIdentifier": parent, "name": alias,
+                                    "published_at": "2021-01-01T10:00:00Z", "type": "dataverse"})
+    exporter.dataverseTreeRefreshed = True
+    dois = ["doi:10.18419/darus-{}".format(i) for i in range(5)]
+    items = [{"global_id": doi, "identifier_of_dataverse": "ibc"} for doi in dois]
+    dataset = loadFixture("dataset.json")["data"]
+    fetched = []
+
+    def callDarusAPI(url, **kwargs):
+        if "api/search" in url:
+            return {"total_count": len(items), "items": items}
+        fetched.append(url[url.index("persistentId=") + len("persistentId="):])
+        return dataset
+
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=callDarusAPI)
+    mocker.patch.object(exporter, "getAllDatasetsFromUniBiblio", return_value={"10.18419/darus-99": None})
+
+    pumaExportMany(["darus", "ibc"], full=True, exporter=exporter)
+
+    assert sorted(fetched) == dois
+    assert exporter.runRecords == {} and exporter.runRecordUses == {}
@@ -0,0 +1,86 @@
+import os
+from datetime import datetime
+
+from exporterExceptions import ApiCallFailedException
+from pumaExport import Exporter
+from pumaSnapshot import PumaSnapshot
+from records import DarusRecord, PumaRecord
+from stateStore import StateStore
+
+
+def genPost(intrahash, doi, changedate):
+    return {"bibtex": {"intrahash": intrahash, "title": "Title " + intrahash, "misc": "  doi = {" + doi + "}"},
+            "user": {"name": "unibiblio"}, "changedate": changedate}
+
+
+def genStore(tmp_path):
+    store = StateStore(str(tmp_path / "state" / "pumaexport.sqlite"))
+    snapshot = PumaSnapshot()
+    snapshot.add(genPost("a", "10.18419/darus-1", "2021-01-01 10:00:00"))
+    snapshot.add(genPost("b", "10.18419/darus-2", "2021-01-01 10:00:00"))
+    snapshot.add(genPost("c", "10.18419/DARUS-2", "2022-01-01 10:00:00"))
+    store.syncPumaPosts(snapshot, {"10.18419/darus-1": "f1", "10.18419/darus-2": "f2"})
+    return store
+
+
+def test_classificationComparesFingerprints(tmp_path):
+    store = genStore(tmp_path)
+    store.startRun(["ibc"], False, datetime(2024, 1, 8, 10))
+    store.recordDataset("doi:10.18419/darus-1", "ibc", "1.0", "unchanged", DarusRecord(doi="10.18419/darus-1",
+                                                                                     version="1.0", year="2021"))
+    store.recordDataset("doi:10.18419/darus-2", "ibc", "2.0", "changed")
+    store.recordDataset("doi:10.18419/darus-3", "ibc", "1.0", "new")
+    store.recordDataset("doi:10.18419/darus-4", "other", None, "unchanged")
+    store.putFingerprint("doi:10.18419/darus-1", "1.0", "f1")
+    store.putFingerprint("doi:10.18419/darus-2", "2.0", "f2 changed")
+    store.finishRun()
+
+    assert store.classify("ibc") == [("10.18419/darus-1", "unchanged"), ("10.18419/darus-2", "changed"),
+                                     ("10.18419/darus-3", "new")]
+    assert [row[0] for row in store.report("new")[1]] == ["10.18419/darus-3", "10.18419/darus-4"]
+    assert store.report("duplicates")[1] == [("10.18419/darus-2", 2, "b c")]
+    assert [row[:3] for row in store.report("versions", "ibc")[1]] == [
+        ("10.18419/darus-1", "1.0", "1.0"), ("10.18419/darus-2", None, "2.0"), ("10.18419/darus-3", None, "1.0")]
+    assert store.report("runs")[1][0][4:] == (0, 4, 1, 1)
+    store.close()
+
+
+def test_storeKeepsFirstSeenAcrossRuns(tmp_path):
+    store = genStore(tmp_path)
+    store.recordDataset("doi:10.18419/darus-1", "ibc", "1.0", "new")
+    store.commit()
+    firstSeen = store.execute("SELECT first_seen FROM datasets").fetchone()[0]
+    store.close()
+
+    store = StateStore(store.path)
+    store.recordDataset("doi:10.18419/darus-1", "ibc", "1.1", "changed")
+    store.close()
+    store = StateStore(store.path)
+
+    assert store.execute("SELECT first_seen, version_key, status FROM datasets").fetchall() == [
+        (firstSeen, "1.1", "changed")]
+    assert store.execute("SELECT COUNT(*) FROM versions").fetchone()[0] == 2
+    store.close()
+
+
+def test_failedFetchIsNotClassifiedUnchanged(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    store = genStore(tmp_path)
+    store.putFingerprint("doi:10.18419/darus-1", "1.0", "f1")
+    store.commit()
+    exporter = Exporter({"darus": {"apiBaseUrl": "http://localhost/"},
+                         "export": {"cacheFile": None, "fingerprintFile": None, "stateDatabase": None,
+                                    "checkpointDir": str(tmp_path / "checkpoints")}})
+    exporter.stateStore = store
+    exporter.datasetVersions["doi:10.18419/darus-1"] = "1.0"
+    mocker.patch.object(exporter, "callDarusAPI", side_effect=ApiCallFailedException("DaRUS-Call failed: 502"))
+
+    exporter.writeExportFiles(iter(["doi:10.18419/darus-1"]), {"10.18419/darus-1": PumaRecord.fromPost(
+        genPost("a", "10.18419/darus-1", "2021-01-01 10:00:00"))}, "ibc")
+    store.commit()
+
+    assert store.classify("ibc") == [("10.18419/darus-1", "failed")]
+    assert [row[0] for row in store.report("failed")[1]] == ["10.18419/darus-1"]
+    assert store.report("unchanged")[1] == []
+    store.close()
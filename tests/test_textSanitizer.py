@@ -0,0 +1,22 @@
+from pumaExport import Exporter, cleanString
+from textSanitizer import stripHTML
+
+
+def test_stripHTML():
+    assert stripHTML("<p>Flow &amp; transport</p>\n<ul><li>one</li><li>two</li></ul>") == "Flow & transport\nonetwo"
+    assert stripHTML('<a href="https://doi.org/a>b">link</a><!-- comment --> &lt;x&gt;') == "link <x>"
+    assert stripHTML("a < b and c > d") == "a < b and c > d"
+    assert stripHTML("") == ""
+
+
+def test_stripHTMLIsLinearForUnclosedLessThan():
+    # every "<T" without '>' used to scan to the end of the text: minutes for this text
+    text = "T<Tc and " * 20000
+
+    assert stripHTML(text) == text
+    assert stripHTML("T<Tc and <b>T</b> 'x' <i>y</i>") == "T<Tc and T 'x' y"
+
+
+def test_cleanStringAndRemoveHTMLShareStripping():
+    assert cleanString('<p>Test "quoted"\r\nline</p>') == "Test 'quoted' line"
+    assert Exporter.removeHTML("<b>Test</b>beschreibung") == "Testbeschreibung"
@@ -0,0 +1,19 @@
+import html
+import re
+
+# comments, CDATA sections and tags (quoted attribute values may contain '>'); a '<' that does not start
+# a tag, as in "a < b" or "T<Tc", is kept as text. Tags and their quoted values end before the next '<',
+# so a '<' without a closing '>' is only scanned up to the next '<' instead of to the end of the text
+MARKUP_PATTERN = re.compile(r"<(?:!--.*?(?:-->|$)|!\[CDATA\[|[A-Za-z/!?][^<>\"']*(?:(?:\"[^<\"]*\"|'[^<']*')[^<>\"']*)*>)|]]>",
+                            re.DOTALL)
+
+
+def stripHTML(text):
+    """Returns the text content of an HTML fragment in linear time.
+
+    Plain text (no '<') is not scanned for tags at all, only entities are decoded if there are any.
+    """
+    text = str(text)
+    if "<" in text:
+        text = MARKUP_PATTERN.sub("", text)
+    return html.unescape(text) if "&" in text else text